@@ -0,0 +1,34 @@
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License.
+# The base-py example API with its model call replaced by a short sleep, for benchmarks.
+# Run in-process through run_benchmarks.py, or under gunicorn with:
+#   gunicorn -b 127.0.0.1:8081 --workers 4 --chdir Benchmarks bench_app:app
+import os
+import sys
+import tempfile
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+
+# Simulated model time for the async /example endpoint, in seconds.
+BENCH_MODEL_SECONDS = float(os.getenv('BENCH_MODEL_SECONDS', '0.05'))
+
+os.environ.setdefault('API_PREFIX', '/v1/bench')
+if not os.getenv('LOCAL_BLOB_TEST_DIRECTORY'):
+    os.environ['LOCAL_BLOB_TEST_DIRECTORY'] = tempfile.mkdtemp(prefix='ai4e_bench_')
+# Keep benchmark telemetry local unless a sink is chosen explicitly.
+os.environ.setdefault('TELEMETRY_SINK', 'none')
+
+sys.path.insert(0, os.path.join(REPO_DIR, 'Containers', 'base-py', 'ai4e_api_tools'))
+sys.path.insert(0, os.path.join(REPO_DIR, 'Containers', 'common'))
+sys.path.insert(0, os.path.join(REPO_DIR, 'Examples', 'base-py'))
+
+import runserver
+
+# Stub model: the example sleeps for 10 seconds.
+runserver.sleep = lambda seconds: time.sleep(BENCH_MODEL_SECONDS)
+
+app = runserver.app
+ai4e_service = runserver.ai4e_service
+API_PREFIX = os.environ['API_PREFIX']
@@ -0,0 +1,373 @@
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License.
+# Load tests for APIService, TaskManager and the blob helpers. Results are printed
+# (or written) as JSON so they can be compared between versions.
+#
+#   python Benchmarks/run_benchmarks.py --concurrency 16 --duration 10
+#   python Benchmarks/run_benchmarks.py --server gunicorn --workers 4 --output results.json
+import argparse
+import http.client
+import json
+import os
+import platform
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+SCENARIOS = ['sync', 'async', 'poll', 'task_manager', 'blob']
+
+
+# Statistics..........................................
+def percentile(sorted_values, q):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, int(round(q * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def summarize(latencies, statuses, elapsed):
+    latencies = sorted(latencies)
+    total = sum(statuses.values())
+    rejected = statuses.get(503, 0)
+    return {
+        'requests': total,
+        'elapsed_seconds': round(elapsed, 3),
+        'throughput_rps': round(total / elapsed, 1) if elapsed > 0 else None,
+        'rejection_rate': round(rejected / total, 4) if total else None,
+        'status_counts': {str(status): count for status, count in sorted(statuses.items())},
+        'latency_ms': {
+            'p50': _ms(percentile(latencies, 0.5)),
+            'p90': _ms(percentile(latencies, 0.9)),
+            'p99': _ms(percentile(latencies, 0.99)),
+            'max': _ms(latencies[-1] if latencies else None),
+        },
+    }
+
+
+def _ms(seconds):
+    return None if seconds is None else round(seconds * 1000, 3)
+
+
+def get_rss_kb(pid):
+    try:
+        with open('/proc/{}/status'.format(pid)) as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1])
+    except (FileNotFoundError, ProcessLookupError):
+        pass
+    return None
+
+
+def get_child_pids(pid):
+    try:
+        with open('/proc/{}/task/{}/children'.format(pid, pid)) as f:
+            return [int(child) for child in f.read().split()]
+    except FileNotFoundError:
+        return []
+
+
+# Servers.............................................
+def _free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+class InProcessServer:
+    """Serves bench_app with a threaded Werkzeug server in this process."""
+    def __init__(self):
+        sys.path.insert(0, BENCH_DIR)
+        import bench_app
+        from werkzeug.serving import make_server
+
+        self.api_prefix = bench_app.API_PREFIX
+        self.port = _free_port()
+        self._server = make_server('127.0.0.1', self.port, bench_app.app, threaded=True)
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._server.shutdown()
+
+    def memory(self):
+        return {'server_rss_kb': get_rss_kb(os.getpid())}
+
+
+class GunicornServer:
+    """Runs bench_app under gunicorn in a subprocess."""
+    def __init__(self, workers):
+        self.api_prefix = os.getenv('API_PREFIX', '/v1/bench')
+        self.port = _free_port()
+        self.workers = workers
+        self._process = None
+
+    def start(self):
+        command = [sys.executable, '-m', 'gunicorn', '-b', '127.0.0.1:{}'.format(self.port), '--workers', str(self.workers), '--preload', '--chdir', BENCH_DIR, 'bench_app:app']
+        self._process = subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        deadline = time.time() + 60
+        while time.time() < deadline:
+            try:
+                status, _ = request('127.0.0.1', self.port, 'GET', self.api_prefix + '/')
+                if status == 200:
+                    return
+            except OSError:
+                pass
+            time.sleep(0.2)
+        self.stop()
+        raise RuntimeError('gunicorn did not start within 60 seconds.')
+
+    def stop(self):
+        if self._process:
+            self._process.terminate()
+            try:
+                self._process.wait(timeout=30)
+            except subprocess.TimeoutExpired:
+                self._process.kill()
+
+    def memory(self):
+        workers = get_child_pids(self._process.pid)
+        worker_rss = [get_rss_kb(pid) for pid in workers]
+        return {'master_rss_kb': get_rss_kb(self._process.pid), 'worker_rss_kb': worker_rss, 'total_rss_kb': sum(rss or 0 for rss in worker_rss) + (get_rss_kb(self._process.pid) or 0)}
+
+
+# Load generation.....................................
+_connections = threading.local()
+
+
+def request(host, port, method, path, body=None, headers=None):
+    """Sends one request on this thread's keep-alive connection. Returns (status, body)."""
+    connection = getattr(_connections, 'connection', None)
+    if connection is None:
+        connection = http.client.HTTPConnection(host, port, timeout=60)
+        _connections.connection = connection
+    try:
+        connection.request(method, path, body=body, headers=headers or {})
+        response = connection.getresponse()
+        return response.status, response.read()
+    except (http.client.HTTPException, OSError):
+        connection.close()
+        _connections.connection = None
+        raise
+
+
+def run_load(concurrency, duration, make_request):
+    """Calls make_request() from concurrency threads for duration seconds.
+
+    make_request returns an HTTP status; latencies and statuses are collected per call.
+    """
+    latencies = []
+    statuses = {}
+    lock = threading.Lock()
+    stop_at = time.monotonic() + duration
+
+    def worker():
+        local_latencies = []
+        local_statuses = {}
+        while time.monotonic() < stop_at:
+            started = time.monotonic()
+            try:
+                status = make_request()
+            except (http.client.HTTPException, OSError):
+                status = 'connection_error'
+            local_latencies.append(time.monotonic() - started)
+            local_statuses[status] = local_statuses.get(status, 0) + 1
+        with lock:
+            latencies.extend(local_latencies)
+            for status, count in local_statuses.items():
+                statuses[status] = statuses.get(status, 0) + count
+
+    started = time.monotonic()
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return summarize(latencies, statuses, time.monotonic() - started)
+
+
+# Scenarios...........................................
+def bench_sync(server, args):
+    path = server.api_prefix + '/echo/benchmark'
+    return run_load(args.concurrency, args.duration, lambda: request('127.0.0.1', server.port, 'GET', path)[0])
+
+
+def bench_async(server, args):
+    path = server.api_prefix + '/example'
+    body = json.dumps({'benchmark': True})
+    headers = {'Content-Type': 'application/json'}
+    return run_load(args.concurrency, args.duration, lambda: request('127.0.0.1', server.port, 'POST', path, body, headers)[0])
+
+
+def bench_poll(server, args):
+    """Submits async tasks and polls /task/<id> until each completes."""
+    submit_path = server.api_prefix + '/example'
+    body = json.dumps({'benchmark': True})
+    headers = {'Content-Type': 'application/json'}
+    completion_latencies = []
+    poll_counts = []
+    lock = threading.Lock()
+
+    def submit_and_wait():
+        started = time.monotonic()
+        status, response = request('127.0.0.1', server.port, 'POST', submit_path, body, headers)
+        if status != 200:
+            return status
+
+        task_id = response.decode('utf-8').strip().strip('"').split('TaskId: ')[-1]
+        polls = 0
+        while True:
+            polls += 1
+            status, response = request('127.0.0.1', server.port, 'GET', server.api_prefix + '/task/' + task_id)
+            if status != 200:
+                return status
+            task_status = json.loads(response.decode('utf-8')).get('Status', '')
+            if task_status.startswith('completed') or task_status.startswith('failed') or 'Task failed' in task_status:
+                break
+            time.sleep(args.poll_interval)
+
+        with lock:
+            completion_latencies.append(time.monotonic() - started)
+            poll_counts.append(polls)
+        return status
+
+    result = run_load(args.concurrency, args.duration, submit_and_wait)
+    completion_latencies.sort()
+    result['completed_tasks'] = len(completion_latencies)
+    result['task_completion_ms'] = {
+        'p50': _ms(percentile(completion_latencies, 0.5)),
+        'p90': _ms(percentile(completion_latencies, 0.9)),
+        'p99': _ms(percentile(completion_latencies, 0.99)),
+    }
+    result['polls_per_task'] = round(sum(poll_counts) / len(poll_counts), 2) if poll_counts else None
+    return result
+
+
+class _FakeRequest:
+    path = '/v1/bench/example'
+
+
+def bench_task_manager(server, args):
+    """Adds, updates and reads tasks directly through TaskManager from concurrency threads."""
+    from task_management.api_task import TaskManager
+    from task_management.task_store import create_task_store
+
+    directory = tempfile.mkdtemp(prefix='ai4e_bench_tasks_')
+    task_manager = TaskManager(create_task_store(directory))
+
+    def add_update_get():
+        task_id = task_manager.AddTask(_FakeRequest())['TaskId']
+        task_manager.UpdateTaskStatus(task_id, 'running')
+        task_manager.CompleteTask(task_id, 'completed')
+        task_manager.GetTaskStatus(task_id)
+        return 'ok'
+
+    result = run_load(args.concurrency, args.duration, add_update_get)
+    result['operations_per_iteration'] = 4
+    return result
+
+
+def bench_blob(server, args):
+    """Writes and reads blobs through AadBlob in local mode."""
+    try:
+        from aad_blob import AadBlob
+    except ImportError as e:
+        return {'skipped': 'aad_blob could not be imported: {}'.format(e)}
+
+    directory = tempfile.mkdtemp(prefix='ai4e_bench_blob_')
+    blob = AadBlob(local_test_directory=directory)
+    payload = 'x' * args.blob_size
+    counter = [0]
+    lock = threading.Lock()
+
+    def write_and_read():
+        with lock:
+            counter[0] += 1
+            name = 'blob_{}.txt'.format(counter[0] % 64)
+        blob.write_blob_from_text('bench', name, payload)
+        blob.get_blob_to_text('bench', name)
+        return 'ok'
+
+    result = run_load(args.concurrency, args.duration, write_and_read)
+    result['blob_size_bytes'] = args.blob_size
+    return result
+
+
+BENCHMARKS = {
+    'sync': bench_sync,
+    'async': bench_async,
+    'poll': bench_poll,
+    'task_manager': bench_task_manager,
+    'blob': bench_blob,
+}
+
+
+def get_git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=REPO_DIR, stderr=subprocess.DEVNULL).decode('utf-8').strip()
+    except (subprocess.CalledProcessError, OSError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks for the AI for Earth API framework.')
+    parser.add_argument('--server', choices=['inprocess', 'gunicorn'], default='inprocess', help='Serve the benchmark app in this process or under gunicorn.')
+    parser.add_argument('--workers', type=int, default=4, help='gunicorn worker processes.')
+    parser.add_argument('--concurrency', type=int, default=8, help='Concurrent client threads per scenario.')
+    parser.add_argument('--duration', type=float, default=5.0, help='Seconds to run each scenario.')
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS), help='Comma-separated list of: ' + ', '.join(SCENARIOS))
+    parser.add_argument('--poll-interval', type=float, default=0.05, help='Seconds between /task polls in the poll scenario.')
+    parser.add_argument('--blob-size', type=int, default=64 * 1024, help='Blob size in bytes for the blob scenario.')
+    parser.add_argument('--output', help='Write the JSON results to this file instead of stdout.')
+    args = parser.parse_args()
+
+    scenarios = [name.strip() for name in args.scenarios.split(',') if name.strip()]
+    for name in scenarios:
+        if name not in BENCHMARKS:
+            parser.error('Unknown scenario "{}".'.format(name))
+
+    # Import the framework from the repository, as bench_app does.
+    sys.path.insert(0, os.path.join(REPO_DIR, 'Containers', 'base-py', 'ai4e_api_tools'))
+    sys.path.insert(0, os.path.join(REPO_DIR, 'Containers', 'common'))
+
+    server = InProcessServer() if args.server == 'inprocess' else GunicornServer(args.workers)
+    server.start()
+    try:
+        results = {}
+        for name in scenarios:
+            print('Running {} benchmark...'.format(name), file=sys.stderr)
+            results[name] = BENCHMARKS[name](server, args)
+        memory = server.memory()
+    finally:
+        server.stop()
+
+    report = {
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'git_commit': get_git_commit(),
+        'python_version': platform.python_version(),
+        'server': args.server,
+        'workers': args.workers if args.server == 'gunicorn' else 1,
+        'concurrency': args.concurrency,
+        'duration_seconds': args.duration,
+        'model_seconds': float(os.getenv('BENCH_MODEL_SECONDS', '0.05')),
+        'memory': memory,
+        'results': results,
+    }
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,46 @@
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License.
+import json
+import os
+import subprocess
+import sys
+
+import pytest
+
+import run_benchmarks
+
+
+def test_percentile():
+    values = [1, 2, 3, 4, 5]
+    assert run_benchmarks.percentile(values, 0.5) == 3
+    assert run_benchmarks.percentile(values, 0.99) == 5
+    assert run_benchmarks.percentile([], 0.5) is None
+
+
+def test_summarize():
+    summary = run_benchmarks.summarize([0.002, 0.001, 0.003], {200: 2, 503: 1}, 2.0)
+    assert summary['requests'] == 3
+    assert summary['throughput_rps'] == 1.5
+    assert summary['rejection_rate'] == 0.3333
+    assert summary['status_counts'] == {'200': 2, '503': 1}
+    assert summary['latency_ms']['p50'] == 2.0
+
+
+def test_run_load():
+    result = run_benchmarks.run_load(2, 0.1, lambda: 200)
+    assert result['requests'] > 0
+    assert result['status_counts'] == {'200': result['requests']}
+
+
+def test_harness_runs(tmp_path):
+    pytest.importorskip('flask')
+    output = str(tmp_path / 'results.json')
+    env = dict(os.environ, BENCH_MODEL_SECONDS='0.001', LOCAL_BLOB_TEST_DIRECTORY=str(tmp_path))
+    subprocess.run([sys.executable, run_benchmarks.__file__, '--duration', '0.3', '--concurrency', '2', '--scenarios', 'sync,async,task_manager,blob', '--output', output],
+                   env=env, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, timeout=120)
+
+    with open(output) as f:
+        report = json.load(f)
+    assert set(report['results']) == {'sync', 'async', 'task_manager', 'blob'}
+    assert report['results']['sync']['status_counts'].get('200', 0) > 0
+    assert report['results']['task_manager']['requests'] > 0
@@ -7,11 +7,10 @@ from os import getenv
 import logging
 from opencensus.ext.azure import metrics_exporter
 from opencensus.ext.azure.log_exporter import AzureLogHandler
-from opencensus.stats import aggregation as aggregation_module
-from opencensus.stats import measure as measure_module
-from opencensus.tags import tag_map as tag_map_module
-from opencensus.stats import view as view_module
 from opencensus.stats import stats as stats_module
+from types import MappingProxyType
+from ai4e_log_context import build_log_properties
+from telemetry import OpenCensusMetricExporter, TelemetryPipeline, create_sink
 
 APPINSIGHTS_INSTRUMENTATIONKEY = "APPINSIGHTS_INSTRUMENTATIONKEY"
 
@@ -19,9 +18,10 @@ stats = stats_module.stats
 view_manager = stats.view_manager
 stats_recorder = stats.stats_recorder
 
+_BASE_PROPERTIES = MappingProxyType({})
+
 class AI4EAppInsights(object):
     def __init__(self):
-        self.metrics = {}
         self.logger = logging.getLogger(__name__)
 
         self.appinsights_key = None
@@ -29,20 +29,21 @@ class AI4EAppInsights(object):
         if (raw_key and len(raw_key.strip()) > 0):
             self.appinsights_key = raw_key.strip()
 
+        metric_exporter = None
         if (self.appinsights_key):
             handler = AzureLogHandler(connection_string='InstrumentationKey=' + str(getenv('APPINSIGHTS_INSTRUMENTATIONKEY')))
             self.logger.addHandler(handler)
             exporter = metrics_exporter.new_metrics_exporter(connection_string='InstrumentationKey=' + str(getenv('APPINSIGHTS_INSTRUMENTATIONKEY')))
             view_manager.register_exporter(exporter)
+            metric_exporter = OpenCensusMetricExporter(view_manager, stats_recorder)
+
+        # Logs and metrics are queued and exported from a background thread.
+        self.telemetry = TelemetryPipeline(create_sink(export_metric=metric_exporter))
 
     def _log(self, message, sev, taskId = None, additionalProperties = None):
-        if (taskId):
-            if (additionalProperties is None):
-                additionalProperties = { 'task_id': taskId }
-            else:
-                additionalProperties['task_id'] = taskId
-        
-        self.logger.log(sev, message, extra=additionalProperties)
+        # additionalProperties is not modified; the task id can also come from ai4e_log_context.log_context.
+        properties = build_log_properties(_BASE_PROPERTIES, taskId or None, additionalProperties)
+        self.telemetry.log(self.logger, sev, message, extra=properties)
 
     def log_debug(self, message, taskId = None, additionalProperties = None):
         self._log(message, 10, taskId, additionalProperties)
@@ -60,22 +61,17 @@ class AI4EAppInsights(object):
         self._log(message, 50, taskId, additionalProperties)
 
     def track_metric(self, metric_name, metric_value):
-        if (self.appinsights_key):
-            print("Tracking metric:" + metric_name + ", Value: " + str(metric_value))
-
-            if (not metric_name in self.metrics):
-                metrics_measure = measure_module.MeasureInt(metric_name, metric_name, metric_name)
-                metrics_view = view_module.View(metric_name, metric_name, [], metrics_measure, aggregation_module.LastValueAggregation(value=metric_value))
+        """Records the current value of a metric. Only the last value in each flush interval is exported."""
+        self.telemetry.gauge(metric_name, metric_value)
 
-                view_manager.register_view(metrics_view)
-                mmap = stats_recorder.new_measurement_map()
-                tmap = tag_map_module.TagMap()
+    def increment_metric(self, metric_name, value = 1):
+        """Adds value to a counter. Increments are summed in each flush interval before they are exported."""
+        self.telemetry.increment(metric_name, value)
 
-                self.metrics[metric_name] = {'measure': metrics_measure, 'measurement_map': mmap, 'tag_map': tmap}
+    def track_distribution(self, metric_name, value):
+        """Records one value, such as a request duration in milliseconds, of a distribution metric."""
+        self.telemetry.distribution(metric_name, value)
 
-            measure = self.metrics[metric_name]['measure']
-            mmap = self.metrics[metric_name]['measurement_map']
-            tmap = self.metrics[metric_name]['tag_map']
-            print("Putting metric:" + metric_name + ", Value: " + str(metric_value))
-            mmap.measure_int_put(measure, metric_value)
-            mmap.record(tmap)
\ No newline at end of file
+    def flush(self):
+        """Exports all queued logs and metrics now. They are also exported when the process exits."""
+        self.telemetry.flush()
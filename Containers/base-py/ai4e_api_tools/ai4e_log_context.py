@@ -0,0 +1,66 @@
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License.
+# Per-task logging context. Fields such as the task id are bound with log_context()
+# and are added to every log message written by the loggers in the same thread or
+# async task, without being shared with other tasks running at the same time.
+from contextlib import contextmanager
+import contextvars
+from types import MappingProxyType
+
+
+class _LogFields:
+    """An immutable set of context fields, plus the merged properties built from it for each logger."""
+    __slots__ = ('fields', '_merged')
+
+    def __init__(self, fields):
+        self.fields = MappingProxyType(fields)
+        self._merged = ()
+
+    def merged_with(self, base):
+        # Loggers call this with their own base properties. The merged dict is built
+        # once per context and logger and is never modified afterwards.
+        for cached_base, merged in self._merged:
+            if cached_base is base:
+                return merged
+
+        merged = {**base, **self.fields}
+        # Replacing the tuple is atomic, so no lock is needed if two threads race here.
+        self._merged = self._merged + ((base, merged),)
+        return merged
+
+
+_EMPTY = _LogFields({})
+_current = contextvars.ContextVar('ai4e_log_context', default=_EMPTY)
+
+
+@contextmanager
+def log_context(**fields):
+    """Adds fields to every log message written inside the with block, for example task_id=taskId."""
+    token = _current.set(_LogFields({**_current.get().fields, **fields}))
+    try:
+        yield
+    finally:
+        _current.reset(token)
+
+
+def get_log_context():
+    """Returns a read-only mapping of the fields bound in the current context."""
+    return _current.get().fields
+
+
+def build_log_properties(base, task_id=None, additional_properties=None):
+    """Returns the properties for one log message: base, then the context fields, then the per-call fields.
+
+    The returned dict may be shared with other calls and must not be modified. base
+    and additional_properties are never modified.
+    """
+    properties = _current.get().merged_with(base)
+    if task_id is None and not additional_properties:
+        return properties
+
+    properties = dict(properties)
+    if task_id is not None:
+        properties['task_id'] = task_id
+    if additional_properties:
+        properties.update(additional_properties)
+    return properties
@@ -1,34 +1,103 @@
 # Copyright (c) Microsoft Corporation. All rights reserved.
 # Licensed under the MIT License.
-from threading import Thread
 from os import getenv
+import atexit
 import json
+import os
+import threading
+import time
 import traceback
 
-from flask import Flask, abort, request, current_app, views
+from flask import Flask, Response, abort, request, current_app, views, g
 from flask_restful import Resource, Api
 import signal
 from task_management.api_task import TaskManager
+from task_management.task_store import TERMINAL_TASK_STATES, TASK_STATE_ACTIVE, TASK_STATE_COMPLETED
 import sys
-from functools import wraps
+from functools import partial, wraps
 from werkzeug.exceptions import HTTPException
 from ai4e_app_insights_wrapper import AI4EAppInsights
+from ai4e_log_context import log_context
+from task_executor import create_executor, EXECUTOR_TYPE_THREAD, ProcessTaskExecutor
+from concurrency_limiter import SharedConcurrencyLimiter
+from batching import MicroBatcher
+from request_body import read_request_body, RequestBodyTooLarge
+from metrics import EndpointMetrics
+from model_loader import get_loaded_models, get_process_memory
+from response_cache import CachedTask, make_cache_key
+from warmup import WarmupRunner, WARMUP_REQUEST_WAIT_SECONDS
 
 disable_request_metric = getenv('DISABLE_CURRENT_REQUEST_METRIC', 'False')
 
+# Upper limit for the ?wait= parameter of task status requests, in seconds.
+TASK_WAIT_MAX_SECONDS = float(getenv('TASK_WAIT_MAX_SECONDS', '60'))
+# Task event streams send a comment line this often to keep connections open, and close after TASK_EVENTS_MAX_SECONDS.
+TASK_EVENTS_HEARTBEAT_SECONDS = float(getenv('TASK_EVENTS_HEARTBEAT_SECONDS', '15'))
+TASK_EVENTS_MAX_SECONDS = float(getenv('TASK_EVENTS_MAX_SECONDS', '300'))
+# On SIGTERM or SIGINT, in-flight requests and tasks get this long to finish before the process exits.
+# Keep it below gunicorn's --graceful-timeout and the pod's terminationGracePeriodSeconds (both 30 by default).
+DRAIN_TIMEOUT_SECONDS = float(getenv('DRAIN_TIMEOUT_SECONDS', '25'))
+DRAIN_POLL_SECONDS = 0.1
+# Workers of async endpoints that do not set maximum_concurrent_requests. Their queue is not limited.
+ASYNC_DEFAULT_MAX_WORKERS = int(getenv('ASYNC_DEFAULT_MAX_WORKERS', '16'))
+
 MAX_REQUESTS_KEY_NAME = 'max_requests'
 CONTENT_TYPE_KEY_NAME = 'content_types'
 CONTENT_MAX_KEY_NAME = 'content_max_length'
+EXECUTOR_KEY_NAME = 'executor'
+ADMISSION_LIMIT_KEY_NAME = 'admission_limit'
+BATCHER_KEY_NAME = 'batcher'
+STREAM_BODY_KEY_NAME = 'stream_request_body'
+RESPONSE_CACHE_KEY_NAME = 'response_cache'
+CACHE_KEY_PARAMS_KEY_NAME = 'cache_key_params'
+
+TASK_QUEUED_STATUS = 'queued'
+TASK_RUNNING_STATUS = 'running'
+TASK_INTERRUPTED_STATUS = 'interrupted - the service stopped before the task finished, please submit it again'
 
 APP_INSIGHTS_REQUESTS_KEY_NAME = 'REJECTED_STATE'
+APP_INSIGHTS_DURATION_KEY_NAME = 'REQUEST_DURATION_MS'
+APP_INSIGHTS_QUEUE_TIME_KEY_NAME = 'QUEUE_TIME_MS'
+APP_INSIGHTS_REJECTED_COUNT_KEY_NAME = 'REJECTED_COUNT'
+APP_INSIGHTS_CACHE_HIT_KEY_NAME = 'CACHE_HIT_COUNT'
+APP_INSIGHTS_CACHE_MISS_KEY_NAME = 'CACHE_MISS_COUNT'
+APP_INSIGHTS_WARMUP_DURATION_KEY_NAME = 'WARMUP_MS'
+
+ADMITTED_PATH_KEY_NAME = 'ai4e_admitted_path'
+CACHE_KEY_KEY_NAME = 'ai4e_cache_key'
+REQUEST_BODY_KEY_NAME = 'ai4e_request_body'
+ACTIVE_REQUEST_KEY_NAME = 'ai4e_active_request'
 
 class Task(Resource):
     def __init__(self, **kwargs):
         self.task_mgr = kwargs['task_manager']
 
     def get(self, id):
-        st = self.task_mgr.GetTaskStatus(str(id))
-        return(st)
+        # ?wait=30 holds the request until the task is updated, for up to 30 seconds.
+        # ?version=N returns as soon as the task's Version is greater than N.
+        wait = request.args.get('wait')
+        if wait is None:
+            st = self.task_mgr.GetTaskStatus(str(id))
+            return(st)
+
+        try:
+            timeout = min(float(wait), TASK_WAIT_MAX_SECONDS)
+            since_version = _parse_version(request.args.get('version'))
+        except ValueError:
+            abort(400, {'message': 'wait must be a number of seconds and version must be an integer.'})
+        if not timeout >= 0:
+            abort(400, {'message': 'wait must be a number of seconds.'})
+
+        return self.task_mgr.WaitForTaskStatus(str(id), since_version, timeout)
+
+def _parse_version(value):
+    return int(value) if value not in (None, '') else None
+
+def _format_task_event(status):
+    event = 'data: ' + json.dumps(status) + '\n\n'
+    if 'Version' in status:
+        event = 'id: ' + str(status['Version']) + '\n' + event
+    return event
 
 class APIService():
     def __init__(self, flask_app, logger):
@@ -37,130 +106,577 @@ class APIService():
         self.api = Api(self.app)
         self.is_terminating = False
         self.func_properties = {}
-        self.func_request_counts = {}
+        self.func_executors = {}
         self.api_prefix = getenv('API_PREFIX')
+        # Shared by every worker process serving this API_PREFIX.
+        self.concurrency_limiter = SharedConcurrencyLimiter(str(self.api_prefix))
+        self.metrics = EndpointMetrics(str(self.api_prefix))
+        self.tracer = None
         if not isinstance(self.log, AI4EAppInsights):
             self.tracer = self.log.tracer
         
         self.api_task_manager = TaskManager()
-        signal.signal(signal.SIGINT, self.initialize_term)
+        self.warmup = WarmupRunner(self._record_warmup)
+
+        # In-flight work of this process, waited for when the service drains.
+        self._drain_lock = threading.Lock()
+        self._active_requests = 0
+        self._in_flight_tasks = set()
+        self._drained_pid = None
+        self._previous_signal_handlers = {}
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            try:
+                self._previous_signal_handlers[signum] = signal.signal(signum, self.initialize_term)
+            except ValueError:
+                # Signal handlers can only be set from the main thread.
+                print('Could not handle signal {} outside the main thread.'.format(signum))
+        # Servers that install their own signal handlers in each worker (such as gunicorn) still
+        # run exit handlers, so async tasks are drained and telemetry is flushed on exit as well.
+        atexit.register(self._drain_at_exit)
 
         # Add health check endpoint
         self.app.add_url_rule(self.api_prefix + '/', view_func = self.health_check, methods=['GET'])
         print("Adding url rule: " + self.api_prefix + '/')
+        # Add liveness and readiness endpoints
+        self.app.add_url_rule(self.api_prefix + '/health/live', view_func = self.health_live, methods=['GET'])
+        print("Adding url rule: " + self.api_prefix + '/health/live')
+        self.app.add_url_rule(self.api_prefix + '/health/ready', view_func = self.health_ready, methods=['GET'])
+        print("Adding url rule: " + self.api_prefix + '/health/ready')
         # Add task endpoint
         self.api.add_resource(Task, self.api_prefix + '/task/<id>', resource_class_kwargs={ 'task_manager': self.api_task_manager })
         print("Adding url rule: " + self.api_prefix + '/task/<int:taskId>')
+        self.app.add_url_rule(self.api_prefix + '/task/<id>/events', view_func = self.task_events, methods=['GET'])
+        print("Adding url rule: " + self.api_prefix + '/task/<id>/events')
+        self.app.add_url_rule(self.api_prefix + '/task/<id>/result', view_func = self.task_result, methods=['GET'])
+        print("Adding url rule: " + self.api_prefix + '/task/<id>/result')
+        # Add Prometheus metrics endpoint
+        self.app.add_url_rule(self.api_prefix + '/metrics', view_func = self.metrics_endpoint, methods=['GET'])
+        print("Adding url rule: " + self.api_prefix + '/metrics')
 
         self.app.before_request(self.before_request)
+        self.app.teardown_request(self.teardown_request)
 
     def health_check(self):
+        # Health checks reach every worker in time, so they also start its warm-up.
+        self.warmup.ensure_started()
         print("Health check call successful.")
         return 'Health check OK'
 
-    def api_func(self, is_async, api_path, methods, request_processing_function, maximum_concurrent_requests, content_types = None, content_max_length = None, trace_name = None, *args, **kwargs):
+    def health_live(self):
+        """Liveness: the worker is running and answering requests, and its warm-up has not failed."""
+        if self.warmup.has_failed():
+            return Response('Warm-up failed', status=503, mimetype='text/plain')
+        return 'OK'
+
+    def health_ready(self):
+        """Readiness: the worker has finished its warm-up and is accepting requests."""
+        if self.is_terminating:
+            return Response('Terminating', status=503, mimetype='text/plain')
+        if not self.warmup.is_ready():
+            return Response('Warming up', status=503, mimetype='text/plain')
+        return 'Ready'
+
+    def register_warmup(self, func = None, name = None):
+        """Registers a function that runs a synthetic inference to warm up the model.
+
+        Warm-up functions take no arguments. They run once in each worker process, in
+        registration order, before API_PREFIX/health/ready reports the worker as ready.
+        Use it as a decorator (@ai4e_service.register_warmup) or call it with the function.
+        """
+        if func is None:
+            return partial(self.register_warmup, name = name)
+        return self.warmup.register(func, name)
+
+    def task_events(self, id):
+        """Streams the status of a task as server-sent events until the task completes or fails.
+
+        Each event has the task Version as its id, so a client that reconnects with
+        Last-Event-ID only receives newer statuses.
+        """
+        try:
+            since_version = _parse_version(request.headers.get('Last-Event-ID', request.args.get('version')))
+        except ValueError:
+            abort(400, {'message': 'Last-Event-ID and version must be integers.'})
+        task_id = str(id)
+        task_manager = self.api_task_manager
+
+        def stream():
+            # Without a version, the current status is sent first.
+            version = -1 if since_version is None else since_version
+            deadline = time.monotonic() + TASK_EVENTS_MAX_SECONDS
+            while not self.is_terminating:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                status = task_manager.WaitForTaskStatus(task_id, version, min(remaining, TASK_EVENTS_HEARTBEAT_SECONDS))
+                if 'Version' not in status:
+                    # The task does not exist.
+                    yield _format_task_event(status)
+                    break
+
+                if status['Version'] > version:
+                    version = status['Version']
+                    yield _format_task_event(status)
+                elif status['State'] not in TERMINAL_TASK_STATES:
+                    yield ': keep-alive\n\n'
+
+                if status['State'] in TERMINAL_TASK_STATES:
+                    break
+
+        return Response(stream(), mimetype='text/event-stream', headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+    def task_result(self, id):
+        """Returns the result passed to CompleteTask. Supports single byte-range requests."""
+        task_id = str(id)
+        status = self.api_task_manager.GetTaskStatus(task_id)
+        result = status.get('Result')
+        if not result:
+            abort(404, {'message': 'Task has no result. Status: ' + str(status['Status'])})
+
+        size = result['Size']
+        byte_range = None
+        if request.range:
+            byte_range = request.range.range_for_length(size)
+            if byte_range is None:
+                return Response(status=416, headers={'Content-Range': 'bytes */{}'.format(size)})
+        start, stop = byte_range or (0, size)
+
+        chunks = self.api_task_manager.result_store.iter_range(task_id, result, start, stop)
+        response = Response(chunks, status=206 if byte_range else 200, mimetype=result['ContentType'], headers={'Accept-Ranges': 'bytes'})
+        response.content_length = stop - start
+        if byte_range:
+            response.headers['Content-Range'] = request.range.to_content_range_header(size)
+        return response
+
+    def metrics_endpoint(self):
+        in_flight = {path: self.concurrency_limiter.get_in_flight(path) for path in self.func_properties}
+        process_memory = {pid: get_process_memory(pid) for pid in self.metrics.registry.get_process_ids()}
+        return Response(self.metrics.render_prometheus(in_flight, get_loaded_models(), process_memory), mimetype='text/plain; version=0.0.4')
+
+    def api_func(self, is_async, api_path, methods, request_processing_function, maximum_concurrent_requests, content_types = None, content_max_length = None, trace_name = None, executor = EXECUTOR_TYPE_THREAD, max_queue_size = None, queue_priority_function = None, process_initializer = None, batch_function = None, max_batch_size = 8, max_batch_wait_ms = 10, stream_request_body = False, response_cache = None, cache_key_params = None, *args, **kwargs):
         def decorator_api_func(func):
             if not self.api_prefix + api_path in self.func_properties:
-                self.func_properties[self.api_prefix + api_path] = {MAX_REQUESTS_KEY_NAME: maximum_concurrent_requests, CONTENT_TYPE_KEY_NAME: content_types, CONTENT_MAX_KEY_NAME: content_max_length}
-                self.func_request_counts[self.api_prefix + api_path] = 0
+                batcher = None
+                if batch_function:
+                    if executor != EXECUTOR_TYPE_THREAD:
+                        raise ValueError('batch_function cannot be used with the "{}" executor.'.format(executor))
+                    # Concurrent calls of this endpoint share one batching thread.
+                    batcher = MicroBatcher(batch_function, max_batch_size, max_batch_wait_ms, name=api_path + '-batcher')
+
+                executor_instance = None
+                admission_limit = maximum_concurrent_requests
+                if is_async:
+                    # Async requests run on a fixed worker pool. Requests beyond the pool size wait in a bounded queue.
+                    if maximum_concurrent_requests is None:
+                        # No limit was set, so requests are never rejected: the queue is unbounded unless max_queue_size is set.
+                        max_workers = ASYNC_DEFAULT_MAX_WORKERS
+                        queue_size = max_queue_size
+                    else:
+                        max_workers = maximum_concurrent_requests or 1
+                        queue_size = (maximum_concurrent_requests if max_queue_size is None else max_queue_size) or 0
+                    job_function = partial(self._execute_async_task, func=func, api_path=api_path)
+                    executor_instance = create_executor(executor, api_path, job_function, max_workers, queue_size, partial(self._on_async_job_done, api_path), process_initializer, self._fail_lost_task)
+                    self.func_executors[self.api_prefix + api_path] = executor_instance
+                    if maximum_concurrent_requests is not None:
+                        admission_limit = max_workers + queue_size
+
+                self.func_properties[self.api_prefix + api_path] = {MAX_REQUESTS_KEY_NAME: maximum_concurrent_requests, CONTENT_TYPE_KEY_NAME: content_types, CONTENT_MAX_KEY_NAME: content_max_length, EXECUTOR_KEY_NAME: executor_instance, ADMISSION_LIMIT_KEY_NAME: admission_limit, BATCHER_KEY_NAME: batcher, STREAM_BODY_KEY_NAME: stream_request_body, RESPONSE_CACHE_KEY_NAME: response_cache, CACHE_KEY_PARAMS_KEY_NAME: cache_key_params}
 
             @wraps(func)
             def api(*args, **kwargs):
                 internal_args = {"func": func, "api_path": api_path}
-
-                if request_processing_function:
-                    return_values = request_processing_function(request)
-                    combined_kwargs = {**internal_args, **kwargs, **return_values}
-                else:
-                    combined_kwargs = {**internal_args, **kwargs}
+                if self.func_properties[self.api_prefix + api_path][BATCHER_KEY_NAME]:
+                    internal_args["batcher"] = self.func_properties[self.api_prefix + api_path][BATCHER_KEY_NAME]
 
                 if is_async:
-                    task_info = self.api_task_manager.AddTask(request)
-                    taskId = str(task_info['TaskId'])
-                    combined_kwargs["taskId"] = taskId
-
-                    self.wrap_async_endpoint(trace_name, *args, **combined_kwargs)
+                    task_executor = self.func_executors[self.api_prefix + api_path]
+                    if not task_executor.reserve():
+                        print('Task queue is full. Request has been denied.')
+                        self._record_rejection(self.api_prefix + api_path)
+                        abort(503, {'message': 'Service is busy, please try again later.'})
+
+                    taskId = None
+                    submitted = False
+                    try:
+                        if stream_request_body:
+                            internal_args["request_body"] = self._get_request_body(content_max_length)
+
+                        if request_processing_function:
+                            return_values = request_processing_function(request)
+                            combined_kwargs = {**internal_args, **kwargs, **return_values}
+                        else:
+                            combined_kwargs = {**internal_args, **kwargs}
+
+                        task_info = self.api_task_manager.AddTask(request, TASK_QUEUED_STATUS)
+                        taskId = str(task_info['TaskId'])
+                        combined_kwargs["taskId"] = taskId
+
+                        priority = queue_priority_function(request) if queue_priority_function else 0
+                        with self._drain_lock:
+                            self._in_flight_tasks.add(taskId)
+                        self.wrap_async_endpoint(trace_name, priority, *args, **combined_kwargs)
+                        submitted = True
+                    finally:
+                        if not submitted:
+                            # The executor never got the task, so its slot, body and task are released here.
+                            task_executor.cancel_reservation()
+                            if "request_body" in internal_args:
+                                internal_args["request_body"].close()
+                            if taskId is not None:
+                                self._fail_unsubmitted_task(taskId)
+
+                    # Identical requests get this task id until the task fails or expires.
+                    self._cache_response(api_path, CachedTask(taskId))
+                    # The admission taken in before_request is now released by the executor when the task finishes.
+                    g.pop(ADMITTED_PATH_KEY_NAME, None)
                     return 'TaskId: ' + taskId
                 else:
-                    return self.wrap_sync_endpoint(trace_name, *args, **combined_kwargs)
+                    if stream_request_body:
+                        internal_args["request_body"] = self._get_request_body(content_max_length)
+
+                    try:
+                        if request_processing_function:
+                            return_values = request_processing_function(request)
+                            combined_kwargs = {**internal_args, **kwargs, **return_values}
+                        else:
+                            combined_kwargs = {**internal_args, **kwargs}
+
+                        r = self.wrap_sync_endpoint(trace_name, *args, **combined_kwargs)
+                        self._cache_response(api_path, r)
+                        return r
+                    finally:
+                        if "request_body" in internal_args:
+                            internal_args["request_body"].close()
 
             api.__name__ = 'api_' + api_path.replace('/', '')
             print("Adding url rule: " + self.api_prefix + api_path + ", " + api.__name__)
             self.app.add_url_rule(self.api_prefix + api_path, view_func = api, methods=methods, provide_automatic_options=True)
         return decorator_api_func
 
-    def api_async_func(self, api_path, methods, request_processing_function = None, maximum_concurrent_requests = None, content_types = None, content_max_length = None, trace_name = None, *args, **kwargs):
+    def api_async_func(self, api_path, methods, request_processing_function = None, maximum_concurrent_requests = None, content_types = None, content_max_length = None, trace_name = None, executor = EXECUTOR_TYPE_THREAD, max_queue_size = None, queue_priority_function = None, process_initializer = None, batch_function = None, max_batch_size = 8, max_batch_wait_ms = 10, stream_request_body = False, response_cache = None, cache_key_params = None, *args, **kwargs):
         is_async = True
-        return self.api_func(is_async, api_path, methods, request_processing_function, maximum_concurrent_requests, content_types, content_max_length, trace_name, *args, **kwargs)
+        return self.api_func(is_async, api_path, methods, request_processing_function, maximum_concurrent_requests, content_types, content_max_length, trace_name, executor, max_queue_size, queue_priority_function, process_initializer, batch_function, max_batch_size, max_batch_wait_ms, stream_request_body, response_cache, cache_key_params, *args, **kwargs)
 
-    def api_sync_func(self, api_path, methods, request_processing_function = None, maximum_concurrent_requests = None, content_types = None, content_max_length = None, trace_name=None, *args, **kwargs):
+    def api_sync_func(self, api_path, methods, request_processing_function = None, maximum_concurrent_requests = None, content_types = None, content_max_length = None, trace_name=None, batch_function = None, max_batch_size = 8, max_batch_wait_ms = 10, stream_request_body = False, response_cache = None, cache_key_params = None, *args, **kwargs):
         is_async = False
-        return self.api_func(is_async, api_path, methods, request_processing_function, maximum_concurrent_requests, content_types, content_max_length, trace_name, *args, **kwargs)
+        return self.api_func(is_async, api_path, methods, request_processing_function, maximum_concurrent_requests, content_types, content_max_length, trace_name, EXECUTOR_TYPE_THREAD, None, None, None, batch_function, max_batch_size, max_batch_wait_ms, stream_request_body, response_cache, cache_key_params, *args, **kwargs)
+
+    def start_executors(self):
+        """Starts the async endpoint workers of this process, such as the children of 'process' executors.
+
+        Call it in each server worker before the worker starts other threads, for
+        example from the gunicorn post_worker_init hook. Otherwise the workers are
+        started by the first task.
+        """
+        for task_executor in self.func_executors.values():
+            task_executor.start()
 
     def initialize_term(self, signum, frame):
-        print('Signal handler called with signal: ' + signum)
-        print('SIGINT received, service is terminating and will no longer accept requests.')
+        print('Signal handler called with signal: ' + str(signum))
+        if self._drained_pid == os.getpid() or self.is_terminating:
+            # Drained, or a second signal: hand the signal to the handler that was replaced.
+            self._forward_signal(signum, frame)
+            return
+
+        print('{} received, service is terminating and will no longer accept requests.'.format(signal.Signals(signum).name))
         self.is_terminating = True
+        # Drain on another thread, so requests running on this (main) thread can finish.
+        threading.Thread(target=self._drain_and_resend, args=(signum,), name='drain', daemon=True).start()
+
+    def drain(self, timeout = DRAIN_TIMEOUT_SECONDS):
+        """Stops accepting requests and waits up to timeout seconds for in-flight work of this process.
+
+        New requests get a 503 and API_PREFIX/health/ready fails. Sync requests and
+        queued or running async tasks are given until the deadline. Tasks that have
+        not finished by then are removed from the queue and marked as failed with
+        the TASK_INTERRUPTED_STATUS status, so callers know to submit them again.
+        Finally the executors are shut down and telemetry is flushed. Returns True if
+        all work finished in time.
+        """
+        self.is_terminating = True
+        deadline = time.monotonic() + timeout
+        print('Draining {} requests and {} tasks, for up to {} seconds.'.format(self._active_requests, len(self._in_flight_tasks), timeout))
+        while (self._active_requests or self._in_flight_tasks) and time.monotonic() < deadline:
+            time.sleep(DRAIN_POLL_SECONDS)
+
+        with self._drain_lock:
+            unfinished_tasks = list(self._in_flight_tasks)
+        finished = not unfinished_tasks and not self._active_requests
+
+        for task_executor in self.func_executors.values():
+            task_executor.cancel_queued()
+            task_executor.shutdown(wait=False)
+        self._interrupt_tasks(unfinished_tasks)
+
+        if hasattr(self.log, 'flush'):
+            self.log.flush()
+        self._drained_pid = os.getpid()
+        print('Drain finished{}.'.format('' if finished else ', {} tasks were interrupted'.format(len(unfinished_tasks))))
+        return finished
+
+    def _interrupt_tasks(self, task_ids):
+        for task_id in task_ids:
+            try:
+                # A task that finished since the deadline keeps its status.
+                if self.api_task_manager.GetTaskStatus(task_id).get('State') in TERMINAL_TASK_STATES:
+                    continue
+                self.api_task_manager.FailTask(task_id, TASK_INTERRUPTED_STATUS)
+            except Exception as e:
+                print('Exception when marking task {} as interrupted:'.format(task_id))
+                print(e)
+
+    def _drain_and_resend(self, signum):
+        try:
+            self.drain()
+        finally:
+            # Delivered to initialize_term again, which now forwards it on the main thread.
+            os.kill(os.getpid(), signum)
+
+    def _forward_signal(self, signum, frame):
+        previous = self._previous_signal_handlers.get(signum)
+        if previous is None:
+            # The handler was not installed from Python.
+            previous = signal.SIG_DFL
+        signal.signal(signum, previous)
+        if previous == signal.SIG_DFL:
+            os.kill(os.getpid(), signum)
+        elif previous != signal.SIG_IGN:
+            previous(signum, frame)
+
+    def _drain_at_exit(self):
+        if self._drained_pid == os.getpid():
+            return
+        if self._active_requests or self._in_flight_tasks:
+            self.drain()
+        elif hasattr(self.log, 'flush'):
+            # Nothing to wait for, but buffered telemetry is still sent.
+            self.log.flush()
 
     def before_request(self):
+        # The process stays live while it terminates.
+        if request.url_rule and request.url_rule.rule == self.api_prefix + '/health/live':
+            return
+
         # Don't accept a request if SIGTERM has been called on this instance.
         if (self.is_terminating):
             print('Process is being terminated. Request has been denied.')
             abort(503, {'message': 'Service is busy, please try again later.'})
 
-        if request.path in self.func_properties:
-            if (self.func_properties[request.path][CONTENT_TYPE_KEY_NAME] and not request.content_type in self.func_properties[request.path][CONTENT_TYPE_KEY_NAME]):
+        # Match on the URL rule so that endpoints with path parameters are found.
+        path = request.url_rule.rule if request.url_rule else request.path
+        if path in self.func_properties:
+            if (self.func_properties[path][CONTENT_TYPE_KEY_NAME] and not request.content_type in self.func_properties[path][CONTENT_TYPE_KEY_NAME]):
                 print('Invalid content type. Request has been denied.')
-                abort(401, {'message': 'Content-type must be ' + str(self.func_properties[request.path][CONTENT_TYPE_KEY_NAME])})
+                abort(401, {'message': 'Content-type must be ' + str(self.func_properties[path][CONTENT_TYPE_KEY_NAME])})
 
-            if (self.func_properties[request.path][CONTENT_MAX_KEY_NAME] and request.content_length > self.func_properties[request.path][CONTENT_MAX_KEY_NAME]):
+            # Chunked requests have no content length; stream_request_body endpoints enforce the limit while reading.
+            if (self.func_properties[path][CONTENT_MAX_KEY_NAME] and request.content_length is not None and request.content_length > self.func_properties[path][CONTENT_MAX_KEY_NAME]):
                 print('Request is too large. Request has been denied.')
-                abort(413, {'message': 'Request content too large (' + str(request.content_length) + "). Must be smaller than: " + str(self.func_properties[request.path][CONTENT_MAX_KEY_NAME])})
+                abort(413, {'message': 'Request content too large (' + str(request.content_length) + "). Must be smaller than: " + str(self.func_properties[path][CONTENT_MAX_KEY_NAME])})
+
+            # Cache hits are answered here, without taking a slot from maximum_concurrent_requests.
+            if self.func_properties[path][RESPONSE_CACHE_KEY_NAME]:
+                cached_response = self._lookup_cached_response(path)
+                if cached_response is not None:
+                    return cached_response
+
+            # Requests that reach a worker before its warm-up has finished wait for it.
+            if not self.warmup.is_ready() and not self.warmup.wait(WARMUP_REQUEST_WAIT_SECONDS):
+                print('Warm-up has not finished. Request has been denied.')
+                abort(503, {'message': 'Service is starting, please try again later.'})
 
             denied_request=0
-            if (self.func_request_counts[request.path] + 1 > self.func_properties[request.path][MAX_REQUESTS_KEY_NAME]):
-                print('Current requests: ' + str(self.func_request_counts[request.path] + 1))
-                print('Max requests: ' + str(self.func_properties[request.path][MAX_REQUESTS_KEY_NAME]))
+            if not self.concurrency_limiter.try_acquire(path, self.func_properties[path][ADMISSION_LIMIT_KEY_NAME]):
+                print('Max requests: ' + str(self.func_properties[path][ADMISSION_LIMIT_KEY_NAME]))
                 denied_request = 1
+            else:
+                # Recorded at once, so teardown_request releases the slot even if the code below fails.
+                g.setdefault(ADMITTED_PATH_KEY_NAME, path)
 
+            if (disable_request_metric == 'False'):
+                self.log.track_metric(APP_INSIGHTS_REQUESTS_KEY_NAME + path, denied_request)
+
+            if denied_request:
+                self._record_rejection(path)
                 print('Service is busy. Request has been denied.')
                 abort(503, {'message': 'Service is busy, please try again later.'})
 
-            if (disable_request_metric == 'False'):
-                self.log.track_metric(APP_INSIGHTS_REQUESTS_KEY_NAME + request.path, denied_request)
+            with self._drain_lock:
+                self._active_requests += 1
+            g.setdefault(ACTIVE_REQUEST_KEY_NAME, True)
+
+    def teardown_request(self, exception):
+        path = g.pop(ADMITTED_PATH_KEY_NAME, None)
+        if path:
+            self.concurrency_limiter.release(path)
 
-    def increment_requests(self, api_path):
-        self.func_request_counts[self.api_prefix + api_path] += 1
+        if g.pop(ACTIVE_REQUEST_KEY_NAME, None):
+            with self._drain_lock:
+                self._active_requests -= 1
+
+        # A body read for the cache lookup but not handed to the endpoint.
+        request_body = g.pop(REQUEST_BODY_KEY_NAME, None)
+        if request_body is not None:
+            request_body.close()
+
+    def get_in_flight_requests(self, api_path):
+        """Returns the number of admitted requests for api_path across all worker processes."""
+        return self.concurrency_limiter.get_in_flight(self.api_prefix + api_path)
 
     def decrement_requests(self, api_path):
-        self.func_request_counts[self.api_prefix + api_path] -= 1
+        self.concurrency_limiter.release(self.api_prefix + api_path)
+
+    def _on_async_job_done(self, api_path, args, kwargs, queue_seconds, run_seconds, failed):
+        with self._drain_lock:
+            self._in_flight_tasks.discard(kwargs.get('taskId'))
+        request_body = kwargs.get('request_body')
+        if request_body is not None:
+            request_body.close()
+        self.decrement_requests(api_path)
+        self._record_request(self.api_prefix + api_path, run_seconds, failed, queue_seconds)
+
+    def _record_request(self, path, duration_seconds, failed, queue_seconds=None):
+        # Metrics are best-effort: a failure here must not replace the response or kill a worker.
+        try:
+            self.metrics.record_request(path, duration_seconds, failed, queue_seconds)
+            if hasattr(self.log, 'track_distribution'):
+                self.log.track_distribution(APP_INSIGHTS_DURATION_KEY_NAME + path, duration_seconds * 1000)
+                if queue_seconds is not None:
+                    self.log.track_distribution(APP_INSIGHTS_QUEUE_TIME_KEY_NAME + path, queue_seconds * 1000)
+        except Exception as e:
+            print('Exception when recording request metrics for {}:'.format(path))
+            print(e)
+
+    def _record_rejection(self, path):
+        try:
+            self.metrics.record_rejection(path)
+            if hasattr(self.log, 'increment_metric'):
+                self.log.increment_metric(APP_INSIGHTS_REJECTED_COUNT_KEY_NAME + path)
+        except Exception as e:
+            print('Exception when recording a rejection for {}:'.format(path))
+            print(e)
+
+    def _record_warmup(self, name, seconds):
+        self.metrics.record_warmup(name, seconds)
+        if hasattr(self.log, 'track_distribution'):
+            self.log.track_distribution(APP_INSIGHTS_WARMUP_DURATION_KEY_NAME + name, seconds * 1000)
+
+    def _lookup_cached_response(self, path):
+        properties = self.func_properties[path]
+        response_cache = properties[RESPONSE_CACHE_KEY_NAME]
+
+        if properties[STREAM_BODY_KEY_NAME]:
+            # Keep the body for the endpoint, so it is only read once.
+            request_body = self._read_request_body(properties[CONTENT_MAX_KEY_NAME])
+            g.setdefault(REQUEST_BODY_KEY_NAME, request_body)
+            body = request_body.peek_buffer()
+        else:
+            body = request.get_data(cache=True)
+        params = {name: request.args.getlist(name) for name in properties[CACHE_KEY_PARAMS_KEY_NAME] or ()}
+        key = make_cache_key(path, request.view_args, params, body)
+
+        value = response_cache.get(key)
+        if isinstance(value, CachedTask):
+            # Tasks that failed or have expired are run again.
+            state = self.api_task_manager.GetTaskStatus(value.task_id).get('State')
+            if state not in (TASK_STATE_ACTIVE, TASK_STATE_COMPLETED):
+                response_cache.delete(key)
+                value = None
+
+        self.metrics.record_cache_lookup(path, value is not None)
+        if hasattr(self.log, 'increment_metric'):
+            self.log.increment_metric((APP_INSIGHTS_CACHE_HIT_KEY_NAME if value is not None else APP_INSIGHTS_CACHE_MISS_KEY_NAME) + path)
+
+        if value is None:
+            g.setdefault(CACHE_KEY_KEY_NAME, key)
+            return None
+        if isinstance(value, CachedTask):
+            return 'TaskId: ' + value.task_id
+        return value
+
+    def _cache_response(self, api_path, value):
+        # Caching is best-effort: the request has already been handled, so errors are only logged.
+        key = g.pop(CACHE_KEY_KEY_NAME, None)
+        if key is None:
+            return
+        try:
+            self.func_properties[self.api_prefix + api_path][RESPONSE_CACHE_KEY_NAME].put(key, value)
+        except Exception as e:
+            print('Exception when caching the response:')
+            print(e)
+
+    def _get_request_body(self, content_max_length):
+        request_body = g.pop(REQUEST_BODY_KEY_NAME, None)
+        if request_body is None:
+            request_body = self._read_request_body(content_max_length)
+        return request_body
+
+    def _read_request_body(self, content_max_length):
+        try:
+            return read_request_body(request.stream, request.content_length, content_max_length)
+        except RequestBodyTooLarge:
+            print('Request is too large. Request has been denied.')
+            abort(413, {'message': 'Request content too large. Must be smaller than: ' + str(content_max_length)})
 
     def wrap_sync_endpoint(self, trace_name=None, *args, **kwargs):
-        if (self.tracer):
-            if (not trace_name):
-                api_path = kwargs['api_path']
-                trace_name = api_path
+        started_at = time.monotonic()
+        failed = True
+        try:
+            if (self.tracer):
+                if (not trace_name):
+                    api_path = kwargs['api_path']
+                    trace_name = api_path
 
-            with self.tracer.span(name=trace_name) as span:
-                return self._execute_func_with_counter(*args, **kwargs)
-        else:
-            return self._execute_func_with_counter(*args, **kwargs)
+                with self.tracer.span(name=trace_name) as span:
+                    r = self._execute_func(*args, **kwargs)
+            else:
+                r = self._execute_func(*args, **kwargs)
+            failed = False
+            return r
+        finally:
+            self._record_request(self.api_prefix + kwargs['api_path'], time.monotonic() - started_at, failed)
 
-    def wrap_async_endpoint(self, trace_name=None, *args, **kwargs):
+    def wrap_async_endpoint(self, trace_name=None, priority=0, *args, **kwargs):
         if (self.tracer):
             if (not trace_name):
                 api_path = kwargs['api_path']
                 trace_name = api_path
 
             with self.tracer.span(name=trace_name) as span:
-                self._create_and_execute_thread(*args, **kwargs)
+                self._submit_to_executor(priority, *args, **kwargs)
         else:
-            self._create_and_execute_thread(*args, **kwargs)
+            self._submit_to_executor(priority, *args, **kwargs)
+
+    def _submit_to_executor(self, priority, *args, **kwargs):
+        task_executor = self.func_executors[self.api_prefix + kwargs['api_path']]
 
-    def _create_and_execute_thread(self, *args, **kwargs):
-        kwargs['request'] = request
-        thread = Thread(target = self._execute_func_with_counter, args=args, kwargs=kwargs)
-        thread.start()
+        # The executor's job function already holds the endpoint function.
+        del kwargs['func']
+        if not isinstance(task_executor, ProcessTaskExecutor):
+            # The request proxy is bound to this thread, so hand the worker the underlying request object.
+            # Requests cannot be sent to worker processes.
+            kwargs['request'] = request._get_current_object()
+
+        task_executor.submit(args, kwargs, priority)
+
+    def _execute_async_task(self, *args, **kwargs):
+        # Everything the task logs from this worker is tagged with its task id.
+        with log_context(task_id=kwargs['taskId']):
+            self.api_task_manager.UpdateTaskStatus(kwargs['taskId'], TASK_RUNNING_STATUS)
+            self._execute_func(*args, **kwargs)
+
+    def _fail_unsubmitted_task(self, task_id):
+        with self._drain_lock:
+            self._in_flight_tasks.discard(task_id)
+        try:
+            self.api_task_manager.FailTask(task_id, 'Task failed - please contact support or try again.')
+        except Exception as e:
+            print('Exception when failing task {}:'.format(task_id))
+            print(e)
+
+    def _fail_lost_task(self, args, kwargs):
+        print('Worker process exited while running task ' + str(kwargs.get('taskId')))
+        self.api_task_manager.FailTask(kwargs['taskId'], 'Task failed - please contact support or try again.')
 
     def _log_and_fail_exeception(self, **kwargs):
         exc_type, exc_value, exc_traceback = sys.exc_info()
@@ -177,16 +693,12 @@ class APIService():
         else:
             self.log.log_exception(ex_str)
 
-    def _execute_func_with_counter(self, *args, **kwargs):
+    def _execute_func(self, *args, **kwargs):
         func = kwargs['func']
-        api_path = kwargs['api_path']
 
-        self.increment_requests(api_path)
         try:
             r = func(*args, **kwargs)
             return r
         except Exception as e:
-            self._log_and_fail_exeception(e)
-            abort(500)
-        finally:
-            self.decrement_requests(api_path)
\ No newline at end of file
+            self._log_and_fail_exeception(**kwargs)
+            abort(500)
\ No newline at end of file
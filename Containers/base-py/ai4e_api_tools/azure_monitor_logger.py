@@ -3,15 +3,14 @@ from os import getenv
 from opencensus.ext.azure.log_exporter import AzureLogHandler
 from opencensus.ext.azure.trace_exporter import AzureExporter
 from opencensus.ext.flask.flask_middleware import FlaskMiddleware
-from opencensus.stats import aggregation as aggregation_module
-from opencensus.tags import tag_map as tag_map_module
 from opencensus.ext.azure import metrics_exporter
-from opencensus.stats import measure as measure_module
-from opencensus.stats import view as view_module
 from opencensus.trace.samplers import ProbabilitySampler, AlwaysOnSampler
 from opencensus.trace.tracer import Tracer
 from opencensus.stats import stats as stats_module
 from opencensus.trace import config_integration
+from types import MappingProxyType
+from ai4e_log_context import build_log_properties
+from telemetry import OpenCensusMetricExporter, TelemetryPipeline, create_sink
 
 CONF_SERVICE_OWNER = "SERVICE_OWNER"
 CONF_SERVICE_NAME = "SERVICE_NAME"
@@ -26,7 +25,8 @@ CONF_SERVICE_CONTAINER_NAME = "SERVICE_CONTAINER_NAME"
 
 class AzureMonitorLogger(object):
     def __init__(self, logger, flask_app=None):
-        self._properties = {
+        # Read-only; per-task fields come from ai4e_log_context.log_context or the taskId argument.
+        self._properties = MappingProxyType({
             'service_name': getenv(CONF_SERVICE_NAME),
             'service_version': getenv(CONF_SERVICE_VERSION),
             'service_cluster': getenv(CONF_SERVICE_CLUSTER),
@@ -35,11 +35,11 @@ class AzureMonitorLogger(object):
             'service_container_version': getenv(CONF_SERVICE_CONTAINER_VERSION),
             'service_container_name': getenv(CONF_SERVICE_CONTAINER_NAME),
             'task_id': 'none'
-        }
+        })
         self.logger = logger
-        self.metrics = {}
         self.tracer = None
         self.appinsights_key = getenv('APPINSIGHTS_INSTRUMENTATIONKEY', None)
+        metric_exporter = None
 
         if self.appinsights_key:
             try:
@@ -75,74 +75,46 @@ class AzureMonitorLogger(object):
                 self.view_manager = stats.view_manager
                 self.view_manager.register_exporter(self.metrics_exporter)
                 self.stats_recorder = stats.stats_recorder
+                metric_exporter = OpenCensusMetricExporter(self.view_manager, self.stats_recorder)
             except Exception as e:
                 print('Exception in setting up the Azure Monitor:')
                 print(e)
 
-    def log_debug(self, message, taskId = None, additionalProperties = None):
-        properties = self._properties
-        properties['task_id'] = taskId
-        if additionalProperties:
-            properties.update(additionalProperties)
+        # Logs and metrics are queued and exported from a background thread.
+        self.telemetry = TelemetryPipeline(create_sink(export_metric=metric_exporter))
 
-        custom_dimensions = {'custom_dimensions': properties}
-        self.logger.debug(message, extra=custom_dimensions)
+    def _log(self, level, message, taskId = None, additionalProperties = None, exc_info = False):
+        # Neither the base properties nor additionalProperties are modified, so concurrent tasks never see each other's fields.
+        properties = build_log_properties(self._properties, taskId, additionalProperties)
+        self.telemetry.log(self.logger, level, message, {'custom_dimensions': properties}, exc_info)
 
-    def log_info(self, message, taskId = None, additionalProperties = None):
-        properties = self._properties
-        properties['task_id'] = taskId
-        if additionalProperties:
-            properties.update(additionalProperties)
-        
-        custom_dimensions = {'custom_dimensions': properties}
+    def log_debug(self, message, taskId = None, additionalProperties = None):
+        self._log(logging.DEBUG, message, taskId, additionalProperties)
 
-        self.logger.info(message, extra=custom_dimensions)
+    def log_info(self, message, taskId = None, additionalProperties = None):
+        self._log(logging.INFO, message, taskId, additionalProperties)
 
     def log_warn(self, message, taskId = None, additionalProperties = None):
-        properties = self._properties
-        properties['task_id'] = taskId
-        if additionalProperties:
-            properties.update(additionalProperties)
-
-        custom_dimensions = {'custom_dimensions': properties}
-        self.logger.warning(message, extra=custom_dimensions)
+        self._log(logging.WARNING, message, taskId, additionalProperties)
 
     def log_error(self, message, taskId = None, additionalProperties = None):
-        properties = self._properties
-        properties['task_id'] = taskId
-        if additionalProperties:
-            properties.update(additionalProperties)
-
-        custom_dimensions = {'custom_dimensions': properties}
-        self.logger.error(message, extra=custom_dimensions)
+        self._log(logging.ERROR, message, taskId, additionalProperties)
 
     def log_exception(self, message, taskId = None, additionalProperties = None):
-        properties = self._properties
-        properties['task_id'] = taskId
-        if additionalProperties:
-            properties.update(additionalProperties)
-
-        custom_dimensions = {'custom_dimensions': properties}
-        self.logger.exception(message, extra=custom_dimensions)
+        self._log(logging.ERROR, message, taskId, additionalProperties, exc_info=True)
 
     def track_metric(self, metric_name, metric_value):
-        try:
-            if (self.appinsights_key):
-                if (not metric_name in self.metrics):
-                    metrics_measure = measure_module.MeasureInt(metric_name, metric_name, metric_name)
-                    metrics_view = view_module.View(metric_name, metric_name, [], metrics_measure, aggregation_module.LastValueAggregation(value=metric_value))
-
-                    self.view_manager.register_view(metrics_view)
-                    mmap = self.stats_recorder.new_measurement_map()
-                    tmap = tag_map_module.TagMap()
-
-                    self.metrics[metric_name] = {'measure': metrics_measure, 'measurement_map': mmap, 'tag_map': tmap}
-
-                measure = self.metrics[metric_name]['measure']
-                mmap = self.metrics[metric_name]['measurement_map']
-                tmap = self.metrics[metric_name]['tag_map']
-                mmap.measure_int_put(measure, metric_value)
-                mmap.record(tmap)
-        except Exception as e:
-            print('Exception when tracking a metric:')
-            print(e)
+        """Records the current value of a metric. Only the last value in each flush interval is exported."""
+        self.telemetry.gauge(metric_name, metric_value)
+
+    def increment_metric(self, metric_name, value = 1):
+        """Adds value to a counter. Increments are summed in each flush interval before they are exported."""
+        self.telemetry.increment(metric_name, value)
+
+    def track_distribution(self, metric_name, value):
+        """Records one value, such as a request duration in milliseconds, of a distribution metric."""
+        self.telemetry.distribution(metric_name, value)
+
+    def flush(self):
+        """Exports all queued logs and metrics now. They are also exported when the process exits."""
+        self.telemetry.flush()
@@ -0,0 +1,93 @@
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License.
+# Dynamic micro-batching: concurrent callers submit single items and a background
+# thread runs them through the model in batches.
+from concurrent.futures import Future
+import os
+import queue
+import threading
+import time
+
+
+class MicroBatcher:
+    """Groups concurrent calls into batches for a batch-capable model function.
+
+    batch_function receives a list of items and must return a list of results in the
+    same order. A batch is run as soon as max_batch_size items are waiting, or
+    max_wait_ms after the first item of the batch arrived, whichever comes first.
+    While one batch runs, new items queue up and form the next batch.
+
+    submit() blocks the calling thread until its result is ready and re-raises any
+    exception raised by batch_function.
+    """
+    def __init__(self, batch_function, max_batch_size=8, max_wait_ms=10, name='batcher'):
+        if max_batch_size < 1:
+            raise ValueError('max_batch_size must be at least 1.')
+
+        self.batch_function = batch_function
+        self.max_batch_size = max_batch_size
+        self.max_wait_seconds = max_wait_ms / 1000.0
+        self.name = name
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._pid = None
+
+    def submit(self, item, timeout=None):
+        """Adds item to the next batch and returns its result."""
+        return self.submit_async(item).result(timeout)
+
+    def submit_async(self, item):
+        """Adds item to the next batch and returns a concurrent.futures.Future for its result."""
+        self._ensure_worker()
+        future = Future()
+        self._queue.put((item, future))
+        return future
+
+    def _ensure_worker(self):
+        if self._pid == os.getpid():
+            return
+
+        with self._lock:
+            if self._pid != os.getpid():
+                # Threads do not survive a fork, so start the batching thread in this process.
+                threading.Thread(target=self._work, name=self.name, daemon=True).start()
+                self._pid = os.getpid()
+
+    def _work(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.max_wait_seconds
+            while len(batch) < self.max_batch_size:
+                remaining = deadline - time.monotonic()
+                try:
+                    if remaining > 0:
+                        batch.append(self._queue.get(timeout=remaining))
+                    else:
+                        batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            self._run_batch(batch)
+
+    def _run_batch(self, batch):
+        # Skip callers that cancelled their future while it was queued.
+        batch = [(item, future) for item, future in batch if future.set_running_or_notify_cancel()]
+        if not batch:
+            return
+
+        items = [item for item, _ in batch]
+        futures = [future for _, future in batch]
+
+        try:
+            results = self.batch_function(items)
+            if len(results) != len(items):
+                raise ValueError('batch_function returned {} results for {} items.'.format(len(results), len(items)))
+        except BaseException as e:
+            # BaseExceptions such as SystemExit are caught too, so the batching thread keeps
+            # running and no caller is left waiting for a result that never comes.
+            for future in futures:
+                future.set_exception(e)
+            return
+
+        for future, result in zip(futures, results):
+            future.set_result(result)
@@ -0,0 +1,191 @@
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License.
+# Admission control shared by every worker process of a service, so that
+# maximum_concurrent_requests holds for the whole container rather than per worker.
+import fcntl
+import hashlib
+import mmap
+import os
+import threading
+
+from payload_buffers import SHARED_MEMORY_DIR
+
+LIMITER_DIR = os.getenv('CONCURRENCY_LIMITER_DIR', SHARED_MEMORY_DIR)
+LIMITER_MAX_PROCESSES = int(os.getenv('CONCURRENCY_LIMITER_MAX_PROCESSES', '64'))
+LIMITER_MAX_ENDPOINTS = int(os.getenv('CONCURRENCY_LIMITER_MAX_ENDPOINTS', '64'))
+
+_NAME_SIZE = 128
+_COUNTER_SIZE = 8
+
+
+class SharedConcurrencyLimiter:
+    """Counts in-flight requests per endpoint across threads and worker processes.
+
+    The counters live in a memory-mapped file (in /dev/shm by default) that every
+    worker of the service opens. Each update holds an in-process lock and an flock
+    on the file, so a check-and-increment is atomic across threads and processes.
+
+    The file holds a table of endpoint names, a row of totals and one row of
+    counters per worker process. When a worker claims a row, it first gives back
+    the slots held by rows whose process has exited, so a crashed worker does not
+    leak admissions. Rows record the start time of their process as well as its
+    pid, so a row is also given back when its pid has been reused by a new process.
+    """
+    def __init__(self, name, max_processes=LIMITER_MAX_PROCESSES, max_endpoints=LIMITER_MAX_ENDPOINTS):
+        self.max_processes = max_processes
+        self.max_endpoints = max_endpoints
+        self.path = os.path.join(LIMITER_DIR, 'ai4e_limiter_' + hashlib.sha1(name.encode('utf-8')).hexdigest()[:16])
+
+        # Layout: endpoint names, totals row, then per process a pid and its start time followed by a counters row.
+        self._names_size = max_endpoints * _NAME_SIZE
+        self._row_size = max_endpoints * _COUNTER_SIZE
+        self._process_size = 2 * _COUNTER_SIZE + self._row_size
+        self._size = self._names_size + self._row_size + max_processes * self._process_size
+
+        self._lock = threading.Lock()
+        self._endpoint_indexes = {}
+        self._pid = None
+        self._fd = None
+        self._mmap = None
+        self._counters = None
+        self._row_offset = None
+
+    def _open(self):
+        if self._pid == os.getpid():
+            return
+
+        # Called with self._lock held. A forked process must reopen the file, because flock
+        # does not exclude processes sharing an inherited descriptor, and claim its own row.
+        if self._fd is not None:
+            os.close(self._fd)
+
+        self._fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+        fcntl.flock(self._fd, fcntl.LOCK_EX)
+        try:
+            if os.fstat(self._fd).st_size < self._size:
+                os.ftruncate(self._fd, self._size)
+        finally:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+        self._mmap = mmap.mmap(self._fd, self._size)
+        self._counters = memoryview(self._mmap)[self._names_size:].cast('q')
+
+        fcntl.flock(self._fd, fcntl.LOCK_EX)
+        try:
+            self._row_offset = self._claim_row()
+        finally:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+        self._pid = os.getpid()
+
+    def _claim_row(self):
+        process_counters = self._process_size // _COUNTER_SIZE
+        free_row = None
+        for row in range(self.max_processes):
+            pid_offset = self.max_endpoints + row * process_counters
+            pid = self._counters[pid_offset]
+            if pid != 0 and (pid == os.getpid() or not is_same_process(pid, self._counters[pid_offset + 1])):
+                # Give back the slots held by a process that has exited (or by an earlier process with the same pid).
+                for i in range(self.max_endpoints):
+                    self._counters[i] -= self._counters[pid_offset + 2 + i]
+                    self._counters[pid_offset + 2 + i] = 0
+                self._counters[pid_offset] = 0
+                self._counters[pid_offset + 1] = 0
+                pid = 0
+            if pid == 0 and free_row is None:
+                free_row = pid_offset
+
+        if free_row is None:
+            raise RuntimeError('More than {} processes are sharing the concurrency limiter. Increase CONCURRENCY_LIMITER_MAX_PROCESSES.'.format(self.max_processes))
+
+        self._counters[free_row] = os.getpid()
+        self._counters[free_row + 1] = get_process_start_time(os.getpid())
+        return free_row + 2
+
+    def _get_endpoint_index(self, endpoint):
+        index = self._endpoint_indexes.get(endpoint)
+        if index is not None:
+            return index
+
+        # Called with both locks held. Endpoint names are shared so every worker uses the same column.
+        encoded = endpoint.encode('utf-8')[:_NAME_SIZE]
+        for i in range(self.max_endpoints):
+            name = self._mmap[i * _NAME_SIZE:(i + 1) * _NAME_SIZE].rstrip(b'\0')
+            if name == encoded or not name:
+                if not name:
+                    self._mmap[i * _NAME_SIZE:i * _NAME_SIZE + len(encoded)] = encoded
+                self._endpoint_indexes[endpoint] = i
+                return i
+
+        raise RuntimeError('More than {} endpoints are registered with the concurrency limiter. Increase CONCURRENCY_LIMITER_MAX_ENDPOINTS.'.format(self.max_endpoints))
+
+    def try_acquire(self, endpoint, limit):
+        """Admits one request if fewer than limit are in flight across all workers. A limit of None always admits."""
+        with self._lock:
+            self._open()
+            fcntl.flock(self._fd, fcntl.LOCK_EX)
+            try:
+                index = self._get_endpoint_index(endpoint)
+                if limit is not None and self._counters[index] >= limit:
+                    return False
+                self._counters[index] += 1
+                self._counters[self._row_offset + index] += 1
+                return True
+            finally:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+    def release(self, endpoint):
+        with self._lock:
+            self._open()
+            fcntl.flock(self._fd, fcntl.LOCK_EX)
+            try:
+                index = self._get_endpoint_index(endpoint)
+                if self._counters[self._row_offset + index] > 0:
+                    self._counters[index] -= 1
+                    self._counters[self._row_offset + index] -= 1
+            finally:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+    def get_in_flight(self, endpoint):
+        """Returns the number of in-flight requests for endpoint across all workers."""
+        with self._lock:
+            self._open()
+            fcntl.flock(self._fd, fcntl.LOCK_EX)
+            try:
+                return self._counters[self._get_endpoint_index(endpoint)]
+            finally:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+
+def get_process_start_time(pid):
+    """Returns the start time of a process in clock ticks since boot, from /proc/<pid>/stat.
+
+    Returns 0 if the process does not exist or /proc is not available.
+    """
+    try:
+        with open('/proc/{}/stat'.format(pid), 'rb') as f:
+            stat = f.read()
+    except OSError:
+        return 0
+    # The command name in parentheses may contain spaces; starttime is the 22nd field.
+    fields = stat[stat.rindex(b')') + 2:].split()
+    return int(fields[19])
+
+
+def is_same_process(pid, start_time):
+    """Returns True if pid is alive and, when start_time is known, is the process that started then."""
+    if not is_process_alive(pid):
+        return False
+    if not start_time:
+        return True
+    current_start_time = get_process_start_time(pid)
+    return not current_start_time or current_start_time == start_time
+
+
+def is_process_alive(pid):
+    """Returns True if a process with this id exists, including processes of other users."""
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
@@ -0,0 +1,141 @@
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License.
+# Image decoding and model input preparation. JPEGs are decoded directly at a
+# reduced size, and images are written into a preallocated batch array in one pass.
+# Requires numpy and Pillow, which are installed by the model containers.
+from concurrent.futures import ThreadPoolExecutor
+from os import getenv
+import math
+import os
+import threading
+
+import numpy as np
+from PIL import Image
+
+# Threads used by decode_images(). Pillow releases the GIL while decoding, so these run in parallel.
+IMAGE_DECODE_THREADS = int(getenv('IMAGE_DECODE_THREADS', '4'))
+
+# Per-channel mean and standard deviation of ImageNet, for inputs scaled to [0, 1].
+IMAGENET_MEAN = (0.485, 0.456, 0.406)
+IMAGENET_STD = (0.229, 0.224, 0.225)
+
+
+def fit_size(size, max_size):
+    """Returns size scaled down, keeping its aspect ratio, so that neither side exceeds max_size."""
+    width, height = size
+    scale = max_size / max(width, height)
+    if scale >= 1:
+        return size
+    return max(1, round(width * scale)), max(1, round(height * scale))
+
+
+def decode_image(image_bytes, size=None, max_size=None, mode='RGB', resample=Image.BILINEAR):
+    """Decodes an image into a PIL image in mode, resized on decode where possible.
+
+    Args:
+        image_bytes: a file-like object, such as kwargs['request_body'].
+        size: optional (width, height) to resize to, ignoring the aspect ratio.
+        max_size: optional limit on the longer side. The aspect ratio is kept and
+            smaller images are not enlarged.
+        mode: the mode of the returned image, or None to keep the decoded mode.
+
+    JPEGs are decoded with Pillow's draft mode, which lets the decoder scale by 1/2,
+    1/4 or 1/8 while decoding instead of building the full-resolution image first.
+    The remaining resize is done on the smaller image.
+    """
+    image = Image.open(image_bytes)
+    target_size = size
+    if target_size is None and max_size:
+        target_size = fit_size(image.size, max_size)
+
+    if target_size is not None and target_size != image.size:
+        # Only scales down, and never below target_size. Formats other than JPEG ignore it.
+        image.draft(mode, target_size)
+
+    if mode is not None and image.mode != mode:
+        # Image.convert() returns a converted copy of this image
+        image = image.convert(mode)
+    if target_size is not None and target_size != image.size:
+        image = image.resize(target_size, resample)
+    return image
+
+
+_pool = None
+_pool_pid = None
+_pool_lock = threading.Lock()
+
+def _get_pool():
+    # Created on first use in each process, so that forked workers get their own threads.
+    global _pool, _pool_pid
+    if _pool_pid != os.getpid():
+        with _pool_lock:
+            if _pool_pid != os.getpid():
+                _pool = ThreadPoolExecutor(max_workers=IMAGE_DECODE_THREADS, thread_name_prefix='image-decode')
+                _pool_pid = os.getpid()
+    return _pool
+
+
+def decode_images(images_bytes, size=None, max_size=None, mode='RGB'):
+    """Decodes several images in parallel with decode_image(). Returns the images in input order.
+
+    Decoding errors are raised for the first image that failed.
+    """
+    images_bytes = list(images_bytes)
+    if len(images_bytes) == 1:
+        return [decode_image(images_bytes[0], size, max_size, mode)]
+    pool = _get_pool()
+    futures = [pool.submit(decode_image, image_bytes, size, max_size, mode) for image_bytes in images_bytes]
+    return [future.result() for future in futures]
+
+
+def to_batch(images, dtype=np.float32, channels_first=True, scale=None, mean=None, std=None, out=None):
+    """Writes images of the same size into one batch array, converting, normalizing and transposing in one pass.
+
+    Args:
+        images: PIL images or H x W x C uint8 arrays, all with the same shape.
+        dtype: the dtype of the batch. Ignored if out is given.
+        channels_first: N x C x H x W (PyTorch) if True, N x H x W x C (TensorFlow) if False.
+        scale: optional factor applied first, for example 1 / 255.
+        mean, std: optional per-channel values; the batch holds (x * scale - mean) / std.
+        out: optional preallocated array of the batch shape to write into, such as the
+            numpy view of a pinned torch tensor.
+
+    Returns:
+        the batch array.
+    """
+    arrays = [np.asarray(image) for image in images]
+    if not arrays:
+        raise ValueError('to_batch() needs at least one image.')
+    height, width, channels = arrays[0].shape
+    shape = (len(arrays), channels, height, width) if channels_first else (len(arrays), height, width, channels)
+    if out is None:
+        out = np.empty(shape, dtype)
+    elif out.shape != shape:
+        raise ValueError('out has shape {}, but the images need {}.'.format(out.shape, shape))
+
+    # Fold the normalization into one multiply and one add per element: x * factor + offset.
+    factor = np.ones(channels, np.float32)
+    offset = np.zeros(channels, np.float32)
+    if scale is not None:
+        factor *= scale
+    if mean is not None:
+        offset -= np.asarray(mean, np.float32)
+    if std is not None:
+        factor /= np.asarray(std, np.float32)
+        offset /= np.asarray(std, np.float32)
+    normalize = scale is not None or mean is not None or std is not None
+    if channels_first:
+        factor = factor.reshape(channels, 1, 1)
+        offset = offset.reshape(channels, 1, 1)
+
+    for i, array in enumerate(arrays):
+        if array.shape != (height, width, channels):
+            raise ValueError('Images in a batch must have the same shape; got {} and {}.'.format(arrays[0].shape, array.shape))
+        # A transposed view, so the copy into the batch does the transpose.
+        source = array.transpose((2, 0, 1)) if channels_first else array
+        if normalize:
+            np.multiply(source, factor, out=out[i], casting='unsafe')
+            out[i] += offset
+        else:
+            np.copyto(out[i], source, casting='unsafe')
+    return out
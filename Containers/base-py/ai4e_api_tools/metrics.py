@@ -0,0 +1,293 @@
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License.
+# Per-endpoint request counters and latency histograms, shared by every worker
+# process and rendered in the Prometheus text format.
+import bisect
+import glob
+import hashlib
+import mmap
+import os
+import threading
+
+from concurrency_limiter import is_process_alive
+from payload_buffers import SHARED_MEMORY_DIR
+
+METRICS_DIR = os.getenv('METRICS_DIR', SHARED_MEMORY_DIR)
+METRICS_MAX_SERIES = int(os.getenv('METRICS_MAX_SERIES', '128'))
+
+# Upper bounds, in seconds, of the latency histogram buckets. Values above the last bound
+# are only counted in the +Inf bucket.
+HISTOGRAM_BUCKETS = tuple(float(bound) for bound in os.getenv('METRICS_HISTOGRAM_BUCKETS', '0.005,0.01,0.025,0.05,0.1,0.25,0.5,1,2.5,5,10,30,60,300').split(','))
+BUCKET_COUNT = len(HISTOGRAM_BUCKETS) + 1
+
+_BUCKET_BOUNDS = [int(round(bound * 1000000)) for bound in HISTOGRAM_BUCKETS]
+
+_NAME_SIZE = 128
+# A series holds the histogram buckets followed by the sum (in microseconds) and the count.
+# Counters only use the first value.
+_SERIES_LENGTH = BUCKET_COUNT + 2
+_SUM_INDEX = BUCKET_COUNT
+_COUNT_INDEX = BUCKET_COUNT + 1
+
+
+def bucket_index(microseconds):
+    """Returns the index of the first bucket whose upper bound is at least microseconds."""
+    return bisect.bisect_left(_BUCKET_BOUNDS, microseconds)
+
+
+class MetricsRegistry:
+    """Counters and latency histograms, written lock-free across processes.
+
+    Each process writes only to its own memory-mapped file, named after the
+    registry and the process id. An in-process lock serializes threads. A
+    reader adds up the files of all live processes, so /metrics shows the whole
+    container no matter which worker answers. Files left by processes that have
+    exited are removed when metrics are read, which Prometheus sees as a counter
+    reset. Series beyond max_series are not recorded.
+    """
+    def __init__(self, name, max_series=METRICS_MAX_SERIES):
+        self.max_series = max_series
+        self._prefix = os.path.join(METRICS_DIR, 'ai4e_metrics_' + hashlib.sha1(name.encode('utf-8')).hexdigest()[:16] + '_')
+        self._names_size = max_series * _NAME_SIZE
+        self._size = self._names_size + max_series * _SERIES_LENGTH * 8
+
+        self._lock = threading.Lock()
+        self._pid = None
+        self._mmap = None
+        self._values = None
+        self._series_offsets = {}
+        self._is_full = False
+
+    def _open(self):
+        # Called with self._lock held.
+        if self._pid == os.getpid():
+            return
+
+        path = self._prefix + str(os.getpid())
+        fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o600)
+        try:
+            os.ftruncate(fd, self._size)
+            self._mmap = mmap.mmap(fd, self._size)
+        finally:
+            os.close(fd)
+        self._values = memoryview(self._mmap)[self._names_size:].cast('q')
+        self._series_offsets = {}
+        self._pid = os.getpid()
+
+    def _get_offset(self, series):
+        # Called with self._lock held.
+        offset = self._series_offsets.get(series)
+        if offset is not None:
+            return offset
+
+        index = len(self._series_offsets)
+        if index >= self.max_series:
+            if not self._is_full:
+                self._is_full = True
+                print('More than {} metric series were created; new series are not recorded. Increase METRICS_MAX_SERIES.'.format(self.max_series))
+            return None
+        encoded = series.encode('utf-8')[:_NAME_SIZE]
+        self._mmap[index * _NAME_SIZE:index * _NAME_SIZE + len(encoded)] = encoded
+        offset = index * _SERIES_LENGTH
+        self._series_offsets[series] = offset
+        return offset
+
+    def increment(self, name, endpoint, value=1):
+        with self._lock:
+            self._open()
+            offset = self._get_offset(_series_name(name, endpoint))
+            if offset is not None:
+                self._values[offset] += value
+
+    def observe(self, name, endpoint, seconds):
+        """Adds a duration to the histogram name for endpoint."""
+        microseconds = int(seconds * 1000000)
+        with self._lock:
+            self._open()
+            offset = self._get_offset(_series_name(name, endpoint))
+            if offset is None:
+                return
+            self._values[offset + bucket_index(microseconds)] += 1
+            self._values[offset + _SUM_INDEX] += microseconds
+            self._values[offset + _COUNT_INDEX] += 1
+
+    def get_process_ids(self):
+        """Returns the ids of the live processes that have recorded metrics, including this one."""
+        with self._lock:
+            self._open()
+        pids = []
+        for path in glob.glob(self._prefix + '*'):
+            try:
+                pid = int(path[len(self._prefix):])
+            except ValueError:
+                continue
+            if pid == os.getpid() or is_process_alive(pid):
+                pids.append(pid)
+        return sorted(pids)
+
+    def collect(self):
+        """Returns {(name, endpoint): values} summed over every live process."""
+        totals = {}
+        for path in glob.glob(self._prefix + '*'):
+            try:
+                pid = int(path[len(self._prefix):])
+            except ValueError:
+                continue
+            if pid != os.getpid() and not is_process_alive(pid):
+                _remove(path)
+                continue
+
+            try:
+                with open(path, 'rb') as f:
+                    data = f.read(self._size)
+            except FileNotFoundError:
+                continue
+            if len(data) < self._size:
+                continue
+
+            values = memoryview(data)[self._names_size:].cast('q')
+            for index in range(self.max_series):
+                raw_name = data[index * _NAME_SIZE:(index + 1) * _NAME_SIZE].rstrip(b'\0')
+                if not raw_name:
+                    break
+                key = tuple(raw_name.decode('utf-8', 'replace').split('|', 1))
+                series = values[index * _SERIES_LENGTH:(index + 1) * _SERIES_LENGTH]
+                total = totals.get(key)
+                if total is None:
+                    totals[key] = list(series)
+                else:
+                    for i, value in enumerate(series):
+                        total[i] += value
+        return totals
+
+
+class EndpointMetrics:
+    """The request metrics that APIService keeps for each endpoint."""
+    REQUESTS = 'ai4e_requests_total'
+    ERRORS = 'ai4e_request_errors_total'
+    REJECTED = 'ai4e_requests_rejected_total'
+    DURATION = 'ai4e_request_duration_seconds'
+    QUEUE_TIME = 'ai4e_task_queue_seconds'
+    IN_FLIGHT = 'ai4e_requests_in_flight'
+    CACHE_HITS = 'ai4e_response_cache_hits_total'
+    CACHE_MISSES = 'ai4e_response_cache_misses_total'
+    WARMUP_TIME = 'ai4e_warmup_seconds'
+    MODEL_LOAD_TIME = 'ai4e_model_load_seconds'
+    MODEL_PRELOADED = 'ai4e_model_preloaded'
+    PROCESS_RSS = 'ai4e_process_resident_memory_bytes'
+    PROCESS_PSS = 'ai4e_process_proportional_memory_bytes'
+    PROCESS_SHARED = 'ai4e_process_shared_memory_bytes'
+    PROCESS_PRIVATE = 'ai4e_process_private_memory_bytes'
+
+    _HELP = {
+        REQUESTS: ('counter', 'Requests (sync) or tasks (async) that have finished.'),
+        ERRORS: ('counter', 'Requests or tasks that raised an exception.'),
+        REJECTED: ('counter', 'Requests rejected with a 503 because the endpoint was at capacity.'),
+        DURATION: ('histogram', 'Time spent running the endpoint function.'),
+        QUEUE_TIME: ('histogram', 'Time async tasks waited in the queue before running.'),
+        IN_FLIGHT: ('gauge', 'Requests admitted and not yet finished, across all worker processes.'),
+        CACHE_HITS: ('counter', 'Requests answered from the response cache.'),
+        CACHE_MISSES: ('counter', 'Requests that were not found in the response cache.'),
+        WARMUP_TIME: ('histogram', 'Time each warm-up hook took, once per worker process.'),
+        MODEL_LOAD_TIME: ('gauge', 'Time taken to load each model with model_loader.load_model.'),
+        MODEL_PRELOADED: ('gauge', '1 if the model was loaded before the worker processes were forked.'),
+        PROCESS_RSS: ('gauge', 'Resident memory of each worker process.'),
+        PROCESS_PSS: ('gauge', 'Proportional set size of each worker process: shared pages are divided between the processes that share them.'),
+        PROCESS_SHARED: ('gauge', 'Resident memory of each worker process that is shared with other processes.'),
+        PROCESS_PRIVATE: ('gauge', 'Resident memory of each worker process that is not shared.'),
+    }
+
+    # Label names of series that are not per endpoint.
+    _LABEL_NAMES = {WARMUP_TIME: 'hook'}
+
+    # Keys of model_loader.get_process_memory() for each process memory gauge.
+    _PROCESS_MEMORY_KEYS = ((PROCESS_RSS, 'rss_bytes'), (PROCESS_PSS, 'pss_bytes'), (PROCESS_SHARED, 'shared_bytes'), (PROCESS_PRIVATE, 'private_bytes'))
+
+    def __init__(self, name):
+        self.registry = MetricsRegistry(name)
+
+    def record_request(self, endpoint, duration_seconds, failed, queue_seconds=None):
+        self.registry.increment(self.REQUESTS, endpoint)
+        if failed:
+            self.registry.increment(self.ERRORS, endpoint)
+        self.registry.observe(self.DURATION, endpoint, duration_seconds)
+        if queue_seconds is not None:
+            self.registry.observe(self.QUEUE_TIME, endpoint, queue_seconds)
+
+    def record_rejection(self, endpoint):
+        self.registry.increment(self.REJECTED, endpoint)
+
+    def record_cache_lookup(self, endpoint, hit):
+        self.registry.increment(self.CACHE_HITS if hit else self.CACHE_MISSES, endpoint)
+
+    def record_warmup(self, hook, seconds):
+        self.registry.observe(self.WARMUP_TIME, hook, seconds)
+
+    def render_prometheus(self, in_flight=None, models=None, process_memory=None):
+        """Renders every series in the Prometheus text exposition format.
+
+        in_flight is an optional {endpoint: count} dict for the in-flight gauge.
+        models is an optional list of model_loader.ModelInfo, and process_memory an
+        optional {pid: model_loader.get_process_memory(pid)} dict.
+        """
+        by_name = {}
+        for (name, endpoint), values in self.registry.collect().items():
+            by_name.setdefault(name, []).append((endpoint, values))
+        if in_flight:
+            by_name[self.IN_FLIGHT] = [(endpoint, [count]) for endpoint, count in in_flight.items()]
+
+        lines = []
+        for name in sorted(by_name):
+            metric_type, help_text = self._HELP.get(name, ('untyped', name))
+            lines.append('# HELP {} {}'.format(name, help_text))
+            lines.append('# TYPE {} {}'.format(name, metric_type))
+            for endpoint, values in sorted(by_name[name]):
+                label = '{}="{}"'.format(self._LABEL_NAMES.get(name, 'endpoint'), _escape_label(endpoint))
+                if metric_type == 'histogram':
+                    # Prometheus buckets are cumulative.
+                    cumulative = 0
+                    for bound, bucket_count in zip(HISTOGRAM_BUCKETS, values):
+                        cumulative += bucket_count
+                        lines.append('{}_bucket{{{},le="{}"}} {}'.format(name, label, _format_value(bound), cumulative))
+                    lines.append('{}_bucket{{{},le="+Inf"}} {}'.format(name, label, values[_COUNT_INDEX]))
+                    lines.append('{}_sum{{{}}} {}'.format(name, label, _format_value(values[_SUM_INDEX] / 1000000.0)))
+                    lines.append('{}_count{{{}}} {}'.format(name, label, values[_COUNT_INDEX]))
+                else:
+                    lines.append('{}{{{}}} {}'.format(name, label, values[0]))
+
+        if models:
+            self._render_gauge(lines, self.MODEL_LOAD_TIME, 'model', [(info.name, info.load_seconds) for info in models])
+            self._render_gauge(lines, self.MODEL_PRELOADED, 'model', [(info.name, int(info.pid != os.getpid())) for info in models])
+        if process_memory:
+            for name, key in self._PROCESS_MEMORY_KEYS:
+                values = [(str(pid), memory[key]) for pid, memory in sorted(process_memory.items()) if key in memory]
+                if values:
+                    self._render_gauge(lines, name, 'pid', values)
+        return '\n'.join(lines) + '\n'
+
+    def _render_gauge(self, lines, name, label_name, values):
+        lines.append('# HELP {} {}'.format(name, self._HELP[name][1]))
+        lines.append('# TYPE {} gauge'.format(name))
+        for label, value in values:
+            lines.append('{}{{{}="{}"}} {}'.format(name, label_name, _escape_label(label), value if isinstance(value, int) else _format_value(value)))
+
+
+def _series_name(name, endpoint):
+    return name + '|' + endpoint
+
+
+def _escape_label(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_value(value):
+    if value != value:
+        return 'NaN'
+    return repr(float(value))
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
@@ -0,0 +1,148 @@
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License.
+# Loads models once, before the web server forks its workers, so that every
+# worker shares the model's memory pages copy-on-write instead of loading its own
+# copy. Also reports how long models took to load and how much memory each
+# worker process uses.
+from collections import namedtuple
+from os import getenv
+import gc
+import mmap
+import os
+import threading
+import time
+
+# Moves the objects that exist after a model is loaded out of reach of the garbage
+# collector, so that collections in the workers do not write to (and so copy) shared pages.
+MODEL_FREEZE_GC = getenv('MODEL_FREEZE_GC', 'true').lower() == 'true'
+
+ModelInfo = namedtuple('ModelInfo', ['name', 'load_seconds', 'pid'])
+
+_lock = threading.Lock()
+_models = {}  # name: (ModelInfo, model)
+
+
+def load_model(name, loader, *args, **kwargs):
+    """Calls loader(*args, **kwargs) the first time a model name is loaded and returns the model.
+
+    Call it at module level in runserver.py. When the server imports the app before
+    forking, as gunicorn does with --preload and uWSGI does without --lazy-apps, the
+    model is loaded once in the master and every worker inherits it. Later calls for
+    the same name return the loaded model.
+
+    The load time is printed and reported on API_PREFIX/metrics, along with the
+    memory use of each worker.
+    """
+    with _lock:
+        loaded = _models.get(name)
+        if loaded is not None:
+            return loaded[1]
+
+        started_at = time.monotonic()
+        model = loader(*args, **kwargs)
+        info = ModelInfo(name, time.monotonic() - started_at, os.getpid())
+        _models[name] = (info, model)
+
+    if MODEL_FREEZE_GC:
+        freeze_gc()
+    memory = get_process_memory()
+    print('Loaded model {} in {:.2f} seconds. Process {} uses {:.0f} MB.'.format(
+        name, info.load_seconds, info.pid, memory.get('rss_bytes', 0) / 1024 / 1024))
+    return model
+
+
+def get_loaded_models():
+    """Returns a ModelInfo for every model loaded with load_model in this process or before it was forked."""
+    with _lock:
+        return [info for info, _ in _models.values()]
+
+
+def is_preloaded(name):
+    """True if the model was loaded by a parent process and inherited by this one."""
+    loaded = _models.get(name)
+    return loaded is not None and loaded[0].pid != os.getpid()
+
+
+def freeze_gc():
+    """Collects garbage, then excludes every remaining object from future collections (Python 3.7+)."""
+    gc.collect()
+    if hasattr(gc, 'freeze'):
+        gc.freeze()
+
+
+def map_file(path):
+    """Memory-maps a file read-only.
+
+    Pages are read from the page cache on first access and shared by every process
+    that maps the same file, so weights read this way are never duplicated per
+    worker. Parsers that accept a buffer can read the mapping without a copy.
+    """
+    with open(path, 'rb') as f:
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+class PerProcess:
+    """Creates a value on first use in each process.
+
+    Use it for the parts of a model that do not survive fork(), such as TensorFlow
+    sessions and CUDA state, while the weights themselves are loaded before the fork.
+    """
+    def __init__(self, factory):
+        self.factory = factory
+        self._lock = threading.Lock()
+        self._value = None
+        self._pid = None
+
+    def get(self):
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    self._value = self.factory()
+                    self._pid = os.getpid()
+        return self._value
+
+    def get_if_created(self):
+        """Returns the value of this process, or None if it has not been created."""
+        return self._value if self._pid == os.getpid() else None
+
+
+# Fields of /proc/<pid>/smaps_rollup, in kB.
+_SMAPS_FIELDS = {
+    'Rss:': 'rss_bytes',
+    'Pss:': 'pss_bytes',
+    'Shared_Clean:': 'shared_bytes',
+    'Shared_Dirty:': 'shared_bytes',
+    'Private_Clean:': 'private_bytes',
+    'Private_Dirty:': 'private_bytes',
+}
+
+
+def get_process_memory(pid='self'):
+    """Returns the memory use of a process in bytes, read from /proc.
+
+    rss_bytes counts every resident page. pss_bytes divides shared pages by the
+    number of processes that share them, so adding up the PSS of all workers gives
+    the memory they really use. shared_bytes and private_bytes split the RSS.
+    Only rss_bytes is returned if smaps_rollup is not available (Linux < 4.14),
+    and an empty dict outside Linux or for processes that have exited.
+    """
+    memory = {}
+    try:
+        with open('/proc/{}/smaps_rollup'.format(pid)) as f:
+            for line in f:
+                fields = line.split()
+                key = _SMAPS_FIELDS.get(fields[0]) if fields else None
+                if key:
+                    memory[key] = memory.get(key, 0) + int(fields[1]) * 1024
+        return memory
+    except (OSError, ValueError, IndexError):
+        pass
+
+    try:
+        with open('/proc/{}/status'.format(pid)) as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    memory['rss_bytes'] = int(line.split()[1]) * 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    return memory
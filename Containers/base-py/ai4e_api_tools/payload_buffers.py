@@ -0,0 +1,108 @@
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License.
+# Helpers for handing request payloads to endpoint code without copying them.
+import io
+import mmap
+import os
+import tempfile
+
+# /dev/shm is a tmpfs mount, so files created there live in shared memory.
+SHARED_MEMORY_DIR = os.getenv('SHARED_MEMORY_DIR', '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir())
+
+
+class MemoryViewReader(io.RawIOBase):
+    """A read-only, seekable file-like object over an existing buffer.
+
+    Unlike io.BytesIO(data), the buffer is not copied. Use getbuffer() to get a
+    memoryview of the whole payload.
+    """
+    def __init__(self, buffer):
+        super().__init__()
+        self._view = memoryview(buffer).cast('B')
+        self._position = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def readinto(self, b):
+        remaining = len(self._view) - self._position
+        if remaining <= 0:
+            return 0
+        count = min(len(b), remaining)
+        b[:count] = self._view[self._position:self._position + count]
+        self._position += count
+        return count
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            position = offset
+        elif whence == io.SEEK_CUR:
+            position = self._position + offset
+        elif whence == io.SEEK_END:
+            position = len(self._view) + offset
+        else:
+            raise ValueError('Invalid whence value: {}'.format(whence))
+
+        if position < 0:
+            raise ValueError('Negative seek position {}'.format(position))
+        self._position = position
+        return self._position
+
+    def tell(self):
+        return self._position
+
+    def getbuffer(self):
+        return self._view
+
+    def __len__(self):
+        return len(self._view)
+
+
+def get_payload_buffer(value):
+    """Returns a memoryview over value if it is a bytes-like payload or an io.BytesIO, otherwise None."""
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return memoryview(value)
+    if isinstance(value, io.BytesIO):
+        return value.getbuffer()
+    if isinstance(value, MemoryViewReader):
+        return value.getbuffer()
+    return None
+
+
+def write_shared_payload(buffer):
+    """Copies buffer into a new shared memory segment and returns its path.
+
+    The segment must be removed with remove_shared_payload once every reader is done.
+    """
+    fd, path = tempfile.mkstemp(prefix='ai4e_payload_', dir=SHARED_MEMORY_DIR)
+    try:
+        size = len(buffer)
+        if size > 0:
+            os.ftruncate(fd, size)
+            with mmap.mmap(fd, size) as shared:
+                shared[:] = buffer
+    finally:
+        os.close(fd)
+    return path
+
+
+def open_shared_payload(path, size):
+    """Maps a segment created by write_shared_payload read-only. Returns an empty bytes object for empty payloads."""
+    if size == 0:
+        return b''
+
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        return mmap.mmap(fd, size, access=mmap.ACCESS_READ)
+    finally:
+        os.close(fd)
+
+
+def remove_shared_payload(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
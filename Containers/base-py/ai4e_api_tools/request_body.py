@@ -0,0 +1,199 @@
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License.
+# Reads request bodies into reusable buffers, so endpoints get the payload without
+# Werkzeug building a bytes object and the endpoint copying it into a BytesIO.
+from os import getenv
+import mmap
+import tempfile
+import threading
+
+from payload_buffers import MemoryViewReader
+
+# Bodies larger than this are written to a temporary file instead of a pooled buffer.
+REQUEST_BODY_SPOOL_BYTES = int(getenv('REQUEST_BODY_SPOOL_BYTES', str(16 * 1024 * 1024)))
+# Number of idle buffers kept for reuse per buffer size.
+REQUEST_BODY_POOL_SIZE = int(getenv('REQUEST_BODY_POOL_SIZE', '8'))
+READ_CHUNK_SIZE = 64 * 1024
+
+_MIN_BUFFER_SIZE = 4 * 1024
+
+
+class RequestBodyTooLarge(Exception):
+    pass
+
+
+class BufferPool:
+    """A pool of bytearrays, grouped by power-of-two size so buffers fit many request sizes."""
+    def __init__(self, max_idle_per_size=REQUEST_BODY_POOL_SIZE):
+        self.max_idle_per_size = max_idle_per_size
+        self._lock = threading.Lock()
+        self._idle = {}
+
+    def get(self, size):
+        capacity = _MIN_BUFFER_SIZE
+        while capacity < size:
+            capacity *= 2
+
+        with self._lock:
+            idle = self._idle.get(capacity)
+            if idle:
+                return idle.pop()
+        return bytearray(capacity)
+
+    def put(self, buffer):
+        with self._lock:
+            idle = self._idle.setdefault(len(buffer), [])
+            if len(idle) < self.max_idle_per_size:
+                idle.append(buffer)
+
+
+_pool = BufferPool()
+
+
+class RequestBody(MemoryViewReader):
+    """The request body as a read-only, seekable file-like object.
+
+    getbuffer() returns a memoryview of the body without copying it. Small bodies
+    live in a pooled buffer and large ones in a memory-mapped temporary file.
+    close() gives the buffer back to the pool, unless getbuffer() was called:
+    views and their slices can outlive the body, so a buffer that was handed out
+    is never reused.
+    """
+    def __init__(self, buffer, size, pooled_buffer=None, spool_file=None):
+        super().__init__(memoryview(buffer)[:size])
+        self.size = size
+        self._buffer = buffer
+        self._pooled_buffer = pooled_buffer
+        self._spool_file = spool_file
+
+    def getbuffer(self):
+        # Slices of the view keep the buffer exported even after the view is released,
+        # so there is no telling when the caller is done with it.
+        self._pooled_buffer = None
+        return self._view
+
+    def peek_buffer(self):
+        """Returns a view of the body that is only used until the body is closed.
+
+        Unlike getbuffer(), it lets the buffer be reused, so the caller must not keep
+        the view or any slice of it.
+        """
+        return self._view
+
+    def close(self):
+        if self.closed:
+            return
+        super().close()
+
+        try:
+            self._view.release()
+        except BufferError:
+            # The view is still exported, so the buffer cannot be reused.
+            self._pooled_buffer = None
+        if self._pooled_buffer is not None:
+            _pool.put(self._pooled_buffer)
+            self._pooled_buffer = None
+        if self._spool_file is not None:
+            try:
+                self._buffer.close()
+            except BufferError:
+                # The endpoint still holds a view of the mapping; it is unmapped when that view is freed.
+                pass
+            self._spool_file.close()
+            self._spool_file = None
+
+
+def read_request_body(stream, content_length=None, max_length=None, spool_bytes=REQUEST_BODY_SPOOL_BYTES):
+    """Reads stream into a RequestBody, raising RequestBodyTooLarge as soon as max_length is exceeded.
+
+    content_length may be None for chunked requests, in which case the body is read until
+    the stream ends.
+    """
+    if content_length is not None and max_length is not None and content_length > max_length:
+        raise RequestBodyTooLarge(content_length)
+
+    limit = content_length if content_length is not None else max_length
+    if content_length is not None and content_length > spool_bytes:
+        return _spool(stream, memoryview(b''), limit, max_length)
+
+    # A chunked body starts in a small buffer, which is doubled whenever the body fills it.
+    if content_length is not None:
+        capacity = content_length
+    else:
+        capacity = min(READ_CHUNK_SIZE, spool_bytes) if limit is None else min(READ_CHUNK_SIZE, spool_bytes, limit)
+    pooled_buffer = _pool.get(capacity)
+    size = 0
+    try:
+        while True:
+            with memoryview(pooled_buffer) as view:
+                end = len(view) if limit is None else min(len(view), limit)
+                size += _read_into(stream, view[size:end], end - size)
+            if content_length is not None or size < len(pooled_buffer) or (limit is not None and size >= limit):
+                break
+
+            if len(pooled_buffer) >= spool_bytes:
+                # Chunked body larger than the spool threshold: continue in a temporary file.
+                with memoryview(pooled_buffer) as view:
+                    body = _spool(stream, view[:size], limit, max_length)
+                _pool.put(pooled_buffer)
+                return body
+
+            larger = _pool.get(min(len(pooled_buffer) * 2, spool_bytes))
+            with memoryview(larger) as larger_view, memoryview(pooled_buffer) as view:
+                larger_view[:size] = view[:size]
+            _pool.put(pooled_buffer)
+            pooled_buffer = larger
+    except:
+        _pool.put(pooled_buffer)
+        raise
+
+    if max_length is not None and content_length is None and size == max_length and stream.read(1):
+        _pool.put(pooled_buffer)
+        raise RequestBodyTooLarge(max_length + 1)
+
+    return RequestBody(pooled_buffer, size, pooled_buffer=pooled_buffer)
+
+
+def _read_into(stream, view, limit):
+    position = 0
+    readinto = getattr(stream, 'readinto', None)
+    while position < limit:
+        wanted = min(READ_CHUNK_SIZE, limit - position)
+        if readinto is not None:
+            count = readinto(view[position:position + wanted])
+        else:
+            chunk = stream.read(wanted)
+            count = len(chunk)
+            view[position:position + count] = chunk
+        if not count:
+            break
+        position += count
+    return position
+
+
+def _spool(stream, head, limit, max_length):
+    spool_file = tempfile.TemporaryFile()
+    try:
+        spool_file.write(head)
+        size = len(head)
+        while limit is None or size < limit:
+            chunk = stream.read(READ_CHUNK_SIZE if limit is None else min(READ_CHUNK_SIZE, limit - size))
+            if not chunk:
+                break
+            size += len(chunk)
+            if max_length is not None and size > max_length:
+                raise RequestBodyTooLarge(size)
+            spool_file.write(chunk)
+
+        if max_length is not None and size == max_length and limit == max_length and stream.read(1):
+            raise RequestBodyTooLarge(size + 1)
+
+        spool_file.flush()
+        if size == 0:
+            spool_file.close()
+            return RequestBody(b'', 0)
+        mapped = mmap.mmap(spool_file.fileno(), size, access=mmap.ACCESS_READ)
+    except:
+        spool_file.close()
+        raise
+    return RequestBody(mapped, size, spool_file=spool_file)
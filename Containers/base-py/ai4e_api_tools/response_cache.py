@@ -0,0 +1,226 @@
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License.
+# Caches endpoint responses by a hash of the request, so that identical requests
+# are answered without running the model again.
+from collections import namedtuple, OrderedDict
+from os import getenv
+import hashlib
+import json
+import os
+import struct
+import tempfile
+import threading
+import time
+
+RESPONSE_CACHE_MAX_BYTES = int(getenv('RESPONSE_CACHE_MAX_BYTES', str(64 * 1024 * 1024)))
+RESPONSE_CACHE_TTL_SECONDS = float(getenv('RESPONSE_CACHE_TTL_SECONDS', '3600'))
+# Set to a directory, such as /dev/shm/ai4e_response_cache, to share cached responses between worker processes.
+RESPONSE_CACHE_DIR = getenv('RESPONSE_CACHE_DIR', '')
+RESPONSE_CACHE_DISK_MAX_BYTES = int(getenv('RESPONSE_CACHE_DISK_MAX_BYTES', str(256 * 1024 * 1024)))
+# How often a process checks the size of the disk tier, in seconds.
+RESPONSE_CACHE_EVICT_SECONDS = float(getenv('RESPONSE_CACHE_EVICT_SECONDS', '10'))
+
+# An async request whose task is cached. The task id is returned instead of starting a new task.
+CachedTask = namedtuple('CachedTask', ['task_id'])
+
+_HEADER = struct.Struct('<d')
+_STR = b's'
+_BYTES = b'b'
+_JSON = b'j'
+_TASK = b't'
+
+
+def make_cache_key(api_path, view_args=None, params=None, body=None):
+    """Returns a 16 byte BLAKE2b digest of the endpoint, its URL and query parameters and the request body.
+
+    body can be any bytes-like object, such as the memoryview of a RequestBody.
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(api_path.encode('utf-8'))
+    for values in (view_args, params):
+        digest.update(b'\0')
+        if values:
+            digest.update(json.dumps(values, sort_keys=True, default=str).encode('utf-8'))
+    digest.update(b'\0')
+    if body is not None:
+        digest.update(body)
+    return digest.digest()
+
+
+def encode_response(value):
+    """Encodes an endpoint return value for the cache, or returns None if it cannot be cached.
+
+    Strings, bytes, JSON lists and dicts and CachedTask values are cached. Flask
+    Response objects and (body, status) tuples are not.
+    """
+    if isinstance(value, CachedTask):
+        return _TASK + value.task_id.encode('utf-8')
+    if isinstance(value, str):
+        return _STR + value.encode('utf-8')
+    if isinstance(value, (bytes, bytearray)):
+        return _BYTES + bytes(value)
+    if isinstance(value, (dict, list)):
+        try:
+            return _JSON + json.dumps(value, separators=(',', ':')).encode('utf-8')
+        except (TypeError, ValueError):
+            return None
+    return None
+
+
+def decode_response(data):
+    kind, payload = data[:1], data[1:]
+    if kind == _TASK:
+        return CachedTask(payload.decode('utf-8'))
+    if kind == _STR:
+        return payload.decode('utf-8')
+    if kind == _BYTES:
+        return payload
+    return json.loads(payload.decode('utf-8'))
+
+
+class ResponseCache:
+    """A bounded LRU cache of encoded responses, with an optional shared disk tier.
+
+    The memory tier belongs to one process. When disk_dir is set, entries are also
+    written there as one file per key, so every worker process that uses the same
+    directory can serve them. Disk entries are evicted by last use (their mtime) once
+    the directory holds more than disk_max_bytes. Entries older than ttl_seconds are
+    treated as missing.
+    """
+    def __init__(self, max_bytes=RESPONSE_CACHE_MAX_BYTES, ttl_seconds=RESPONSE_CACHE_TTL_SECONDS, disk_dir=RESPONSE_CACHE_DIR, disk_max_bytes=RESPONSE_CACHE_DISK_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self.disk_dir = disk_dir or None
+        self.disk_max_bytes = disk_max_bytes
+        if self.disk_dir:
+            os.makedirs(self.disk_dir, exist_ok=True)
+
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # key: (created, data)
+        self._size = 0
+        self._last_evict = 0.0
+
+    def get(self, key):
+        """Returns the cached value for key, or None."""
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if now - entry[0] <= self.ttl_seconds:
+                    self._entries.move_to_end(key)
+                    return decode_response(entry[1])
+                self._remove(key)
+
+        if not self.disk_dir:
+            return None
+
+        path = self._get_path(key)
+        try:
+            with open(path, 'rb') as f:
+                file_data = f.read()
+            # Record the use for LRU eviction.
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        if len(file_data) <= _HEADER.size:
+            return None
+        created = _HEADER.unpack_from(file_data)[0]
+        if now - created > self.ttl_seconds:
+            _remove_file(path)
+            return None
+
+        data = file_data[_HEADER.size:]
+        with self._lock:
+            self._add(key, created, data)
+        return decode_response(data)
+
+    def put(self, key, value):
+        """Caches value under key. Returns False if the value cannot be cached."""
+        data = encode_response(value)
+        if data is None:
+            return False
+
+        created = time.time()
+        with self._lock:
+            self._add(key, created, data)
+
+        if self.disk_dir:
+            try:
+                self._write_file(key, created, data)
+            except OSError as e:
+                print('Exception when writing to the response cache:')
+                print(e)
+        return True
+
+    def delete(self, key):
+        with self._lock:
+            self._remove(key)
+        if self.disk_dir:
+            _remove_file(self._get_path(key))
+
+    def _add(self, key, created, data):
+        # Called with self._lock held.
+        if len(data) > self.max_bytes:
+            return
+        self._remove(key)
+        self._entries[key] = (created, data)
+        self._size += len(data)
+        while self._size > self.max_bytes:
+            _, (_, evicted) = self._entries.popitem(last=False)
+            self._size -= len(evicted)
+
+    def _remove(self, key):
+        # Called with self._lock held.
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._size -= len(entry[1])
+
+    def _get_path(self, key):
+        return os.path.join(self.disk_dir, key.hex())
+
+    def _write_file(self, key, created, data):
+        fd, temp_path = tempfile.mkstemp(dir=self.disk_dir, prefix='.tmp_')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(_HEADER.pack(created))
+                f.write(data)
+            os.replace(temp_path, self._get_path(key))
+        except:
+            _remove_file(temp_path)
+            raise
+
+        if time.monotonic() - self._last_evict >= RESPONSE_CACHE_EVICT_SECONDS:
+            self._last_evict = time.monotonic()
+            self._evict_files()
+
+    def _evict_files(self):
+        files = []
+        total = 0
+        now = time.time()
+        for entry in os.scandir(self.disk_dir):
+            if entry.name.startswith('.tmp_'):
+                continue
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            if now - stat.st_mtime > self.ttl_seconds:
+                # Not used within the TTL, so it has also expired.
+                _remove_file(entry.path)
+                continue
+            files.append((stat.st_mtime, stat.st_size, entry.path))
+            total += stat.st_size
+
+        files.sort()
+        for _, size, path in files:
+            if total <= self.disk_max_bytes:
+                break
+            _remove_file(path)
+            total -= size
+
+
+def _remove_file(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
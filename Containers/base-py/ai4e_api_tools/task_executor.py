@@ -0,0 +1,339 @@
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License.
+# Executors used by APIService to run async endpoint functions on a fixed pool of
+# workers fed by a bounded queue, instead of starting a new thread per request.
+import itertools
+import multiprocessing
+import os
+import queue
+import signal
+import sys
+import threading
+import time
+import traceback
+
+from payload_buffers import MemoryViewReader, get_payload_buffer, write_shared_payload, open_shared_payload, remove_shared_payload
+
+EXECUTOR_TYPE_THREAD = 'thread'
+EXECUTOR_TYPE_PROCESS = 'process'
+
+# How often an idle child process checks that its parent is still alive.
+PROCESS_PARENT_CHECK_SECONDS = 1.0
+
+
+class ThreadTaskExecutor:
+    """Runs job_function on a fixed pool of worker threads.
+
+    At most max_workers jobs run at once and at most max_queue_size more wait in a
+    priority queue (lowest priority value first, FIFO within a priority). A caller
+    must reserve a slot before submitting; reserve() returns False when both the
+    workers and the queue are full, which is when the service should answer 503.
+    A max_queue_size of None does not limit the queue.
+
+    Workers are started by start() or on first use in each process, so an executor
+    created before a web server forks its workers is still usable in every worker.
+    job_done_callback(args, kwargs, queue_seconds, run_seconds, failed), if given, is
+    called after every job, including failed ones, with the time the job waited in
+    the queue and the time it ran.
+    """
+    def __init__(self, name, job_function, max_workers, max_queue_size=0, job_done_callback=None):
+        if max_workers < 1:
+            raise ValueError('An executor needs at least one worker.')
+
+        self.name = name
+        self.job_function = job_function
+        self.job_done_callback = job_done_callback
+        self.max_workers = max_workers
+        self.max_queue_size = max_queue_size
+        self._slots = threading.BoundedSemaphore(max_workers + max_queue_size) if max_queue_size is not None else None
+        self._queue = queue.PriorityQueue()
+        self._sequence = itertools.count()
+        self._lock = threading.Lock()
+        self._running_lock = threading.Lock()
+        self._workers = []
+        self._pid = None
+        self._running = 0
+        self._is_shutdown = False
+
+    @property
+    def running_count(self):
+        return self._running
+
+    @property
+    def queued_count(self):
+        return self._queue.qsize()
+
+    def reserve(self):
+        """Reserves a worker or queue slot without blocking. Returns False if none are free."""
+        if self._is_shutdown:
+            return False
+        if self._slots is None:
+            return True
+        return self._slots.acquire(blocking=False)
+
+    def cancel_reservation(self):
+        """Releases a slot obtained from reserve() that will not be submitted."""
+        self._release_slot()
+
+    def _release_slot(self):
+        if self._slots is not None:
+            self._slots.release()
+
+    def start(self):
+        """Starts the workers in this process now rather than on the first job."""
+        self._ensure_workers()
+
+    def submit(self, args=(), kwargs=None, priority=0):
+        """Queues job_function(*args, **kwargs). The caller must hold a slot from reserve()."""
+        self._ensure_workers()
+        self._queue.put((priority, next(self._sequence), args, kwargs or {}, time.monotonic()))
+
+    def _ensure_workers(self):
+        if self._pid == os.getpid():
+            return
+
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+
+            # Threads do not survive a fork, so (re)start the pool in this process.
+            self._start_workers()
+            self._pid = os.getpid()
+
+    def _start_workers(self):
+        self._workers = []
+        for i in range(self.max_workers):
+            worker = threading.Thread(target=self._work, args=(i,), name='{}-worker-{}'.format(self.name, i), daemon=True)
+            worker.start()
+            self._workers.append(worker)
+
+    def _work(self, worker_index):
+        while True:
+            _, _, args, kwargs, enqueued_at = self._queue.get()
+            if args is None:
+                self._queue.task_done()
+                return
+
+            with self._running_lock:
+                self._running += 1
+            started_at = time.monotonic()
+            failed = False
+            try:
+                self._run_job(worker_index, args, kwargs)
+            except Exception:
+                failed = True
+                print('Unhandled exception in executor {}:'.format(self.name))
+                print(traceback.format_exception(*sys.exc_info()))
+            finally:
+                with self._running_lock:
+                    self._running -= 1
+                self._release_slot()
+                self._queue.task_done()
+                self._call_job_done_callback(args, kwargs, started_at - enqueued_at, time.monotonic() - started_at, failed)
+
+    def _call_job_done_callback(self, args, kwargs, queue_seconds, run_seconds, failed):
+        if not self.job_done_callback:
+            return
+        try:
+            self.job_done_callback(args, kwargs, queue_seconds, run_seconds, failed)
+        except Exception:
+            # The worker must keep running whatever the callback does.
+            print('Exception in job_done_callback of executor {}:'.format(self.name))
+            print(traceback.format_exception(*sys.exc_info()))
+
+    def _run_job(self, worker_index, args, kwargs):
+        self.job_function(*args, **kwargs)
+
+    def cancel_queued(self):
+        """Removes the jobs that have not started and returns their (args, kwargs).
+
+        Their slots are released, and job_done_callback is called for each as a failed job.
+        """
+        cancelled = []
+        stop_markers = []
+        while True:
+            try:
+                item = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            self._queue.task_done()
+            _, _, args, kwargs, enqueued_at = item
+            if args is None:
+                stop_markers.append(item)
+                continue
+
+            self._release_slot()
+            self._call_job_done_callback(args, kwargs, time.monotonic() - enqueued_at, 0, True)
+            cancelled.append((args, kwargs))
+
+        for item in stop_markers:
+            self._queue.put(item)
+        return cancelled
+
+    def shutdown(self, wait=True):
+        """Stops accepting work. Queued jobs still run before the workers exit."""
+        self._is_shutdown = True
+        if self._pid != os.getpid():
+            return
+
+        for _ in self._workers:
+            # Stop markers sort after every real job.
+            self._queue.put((float('inf'), next(self._sequence), None, None, None))
+
+        if wait:
+            for worker in self._workers:
+                worker.join()
+
+
+class ProcessTaskExecutor(ThreadTaskExecutor):
+    """Runs job_function in a pool of warm child processes, for CPU-bound endpoints.
+
+    The queue and admission work as in ThreadTaskExecutor; each parent worker thread
+    owns one forked child and hands it one job at a time. process_initializer runs
+    once in every child when it starts, which is where a model should be loaded.
+
+    All children are forked when the pool starts, before its worker threads. A
+    child forked while other threads run can inherit a lock one of them held, so
+    call start() in each server worker before it starts threads, for example from
+    the gunicorn post_worker_init hook. A child that dies is replaced on its next
+    job, from the running process.
+
+    Bytes-like keyword arguments and io.BytesIO payloads are copied once into a
+    shared memory segment instead of being pickled. The child receives a
+    memoryview (for bytes-like values) or a MemoryViewReader (for io.BytesIO)
+    over the mapped segment. All other arguments must be picklable.
+
+    Children are forked, so job_function and anything it references (such as the
+    TaskManager) are inherited rather than pickled, and status updates made in the
+    child go straight to the shared task store. If a child dies mid-job,
+    lost_job_handler(args, kwargs) is called in the parent so the task can be failed.
+    """
+    def __init__(self, name, job_function, max_workers, max_queue_size=0, job_done_callback=None, process_initializer=None, lost_job_handler=None):
+        super().__init__(name, job_function, max_workers, max_queue_size, job_done_callback)
+        self.process_initializer = process_initializer
+        self.lost_job_handler = lost_job_handler
+        self._context = multiprocessing.get_context('fork')
+        self._children = {}
+
+    def _start_workers(self):
+        # Children belong to the process that forked them. They are forked before the
+        # worker threads start, so that they do not inherit locks held by those threads.
+        self._children = {}
+        for i in range(self.max_workers):
+            self._get_child(i)
+        super()._start_workers()
+
+    def _run_job(self, worker_index, args, kwargs):
+        shared_kwargs = {}
+        plain_kwargs = {}
+        for key, value in kwargs.items():
+            buffer = get_payload_buffer(value)
+            if buffer is None:
+                plain_kwargs[key] = value
+            else:
+                shared_kwargs[key] = (write_shared_payload(buffer), len(buffer), not isinstance(value, (bytes, bytearray, memoryview)))
+
+        try:
+            connection = self._get_child(worker_index)
+            try:
+                connection.send((args, plain_kwargs, shared_kwargs))
+                error = connection.recv()
+            except (EOFError, OSError):
+                # The child died mid-job; a new one is started for the next job.
+                self._children.pop(worker_index, None)
+                if self.lost_job_handler:
+                    self.lost_job_handler(args, kwargs)
+                raise RuntimeError('Worker process for {} exited while running a job.'.format(self.name))
+
+            if error:
+                raise RuntimeError('Exception in worker process for {}:\n{}'.format(self.name, error))
+        finally:
+            for path, _, _ in shared_kwargs.values():
+                remove_shared_payload(path)
+
+    def _get_child(self, worker_index):
+        child = self._children.get(worker_index)
+        if child is not None and child[0].is_alive():
+            return child[1]
+
+        # Output still buffered here would otherwise be written again by the child.
+        sys.stdout.flush()
+        sys.stderr.flush()
+        parent_connection, child_connection = self._context.Pipe()
+        process = self._context.Process(
+            target=self._child_main,
+            args=(child_connection, os.getpid()),
+            name='{}-process-{}'.format(self.name, worker_index),
+            daemon=True)
+        process.start()
+        child_connection.close()
+        self._children[worker_index] = (process, parent_connection)
+        return parent_connection
+
+    def _child_main(self, connection, parent_pid):
+        # The parent decides when to stop; Ctrl+C signals the whole process group. SIGTERM keeps its
+        # default action so multiprocessing can still stop the child when the parent exits.
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+
+        if self.process_initializer:
+            self.process_initializer()
+
+        while True:
+            if not connection.poll(PROCESS_PARENT_CHECK_SECONDS):
+                if os.getppid() != parent_pid:
+                    return
+                continue
+
+            try:
+                job = connection.recv()
+            except EOFError:
+                return
+            if job is None:
+                return
+
+            args, kwargs, shared_kwargs = job
+            mapped = []
+            error = None
+            try:
+                for key, (path, size, as_file) in shared_kwargs.items():
+                    shared = open_shared_payload(path, size)
+                    mapped.append(shared)
+                    kwargs[key] = MemoryViewReader(shared) if as_file else memoryview(shared)
+
+                self.job_function(*args, **kwargs)
+            except Exception:
+                error = ''.join(traceback.format_exception(*sys.exc_info()))
+            finally:
+                kwargs.clear()
+                for shared in mapped:
+                    try:
+                        shared.close()
+                    except (AttributeError, BufferError):
+                        # Empty payloads are not mapped, and the job may still hold a view of the segment.
+                        pass
+
+            connection.send(error)
+
+    def shutdown(self, wait=True):
+        super().shutdown(wait)
+        if self._pid != os.getpid():
+            return
+
+        for process, connection in list(self._children.values()):
+            try:
+                connection.send(None)
+            except (OSError, ValueError):
+                pass
+            if wait:
+                process.join()
+        self._children = {}
+
+
+def create_executor(executor_type, name, job_function, max_workers, max_queue_size=0, job_done_callback=None, process_initializer=None, lost_job_handler=None):
+    if executor_type == EXECUTOR_TYPE_THREAD:
+        return ThreadTaskExecutor(name, job_function, max_workers, max_queue_size, job_done_callback)
+    elif executor_type == EXECUTOR_TYPE_PROCESS:
+        return ProcessTaskExecutor(name, job_function, max_workers, max_queue_size, job_done_callback, process_initializer, lost_job_handler)
+    else:
+        raise ValueError('Unknown executor type "{}". Supported types are: {}, {}.'.format(executor_type, EXECUTOR_TYPE_THREAD, EXECUTOR_TYPE_PROCESS))
@@ -1,76 +1,64 @@
 # Copyright (c) Microsoft Corporation. All rights reserved.
 # Licensed under the MIT License.
 from datetime import datetime
-import json
 import os
-import multiprocessing
-from typing import Any, Dict
+import time
+from typing import Any, Dict, Optional
 import uuid
 
 import requests
 
+from task_management.task_notifier import TaskStatusNotifier
+from task_management.task_results import create_result_store
+from task_management.task_retention import TaskCompactor
+from task_management.task_store import create_task_store, TASK_STATE_ACTIVE, TASK_STATE_COMPLETED, TASK_STATE_FAILED, TERMINAL_TASK_STATES
+
 
 print("Creating task manager.")
 
 LOCAL_BLOB_TEST_DIRECTORY = os.getenv('LOCAL_BLOB_TEST_DIRECTORY', '.')
+# How often a waiting status request re-reads the task store, to see updates made by other processes.
+TASK_WAIT_POLL_SECONDS = float(os.getenv('TASK_WAIT_POLL_SECONDS', '1'))
 
 class TaskManager:
-
-    # use a lock whenever we access task_status.json
-    task_status_json_lock = multiprocessing.Lock()
-
-    def __init__(self):
+    def __init__(self, task_store=None, result_store=None):
         self.status_dict = {}
-        self.task_status_json_path = os.path.join(
-            LOCAL_BLOB_TEST_DIRECTORY, 'task_status.json')
+        if task_store is None:
+            task_store = create_task_store(LOCAL_BLOB_TEST_DIRECTORY)
+        if result_store is None:
+            result_store = create_result_store(LOCAL_BLOB_TEST_DIRECTORY)
+        self.task_store = task_store
+        self.result_store = result_store
+        self.notifier = TaskStatusNotifier()
+        # Results are deleted together with their tasks.
+        self.compactor = TaskCompactor(task_store, on_expired=result_store.delete)
 
     def GetTaskId(self) -> str:
         return str(uuid.uuid4())
 
-    def AddTask(self, request):
+    def AddTask(self, request, status='created'):
         status = {
             'TaskId': self.GetTaskId(),
-            'Status': 'created',
+            'Status': status,
             'Timestamp': datetime.strftime(
                 datetime.utcnow(), "%Y-%m-%d %H:%M:%S"),
-            'Endpoint': request.path
+            'Endpoint': request.path,
+            'State': TASK_STATE_ACTIVE,
+            'Version': 0
         }
 
-        with self.task_status_json_lock:
-            statuses = []
-            if os.path.isfile(self.task_status_json_path):
-                with open(self.task_status_json_path, 'r') as f:
-                    statuses = json.load(f)
-            statuses.append(status)
-
-            with open(self.task_status_json_path, 'w') as f:
-                json.dump(statuses, f)
+        self.task_store.add(status)
+        self.compactor.ensure_started()
         return status
 
     def UpdateTaskStatus(self, taskId: str, status: Any) -> None:
-        with self.task_status_json_lock:
-            if not os.path.isfile(self.task_status_json_path):
-                raise ValueError('taskId "{}" is not found. Decorate your endpoint with an ai4e_service decorator or call AddTask(request) before UpdateTaskStatus.'.format(taskId))
-
-            statuses = []
-            with open(self.task_status_json_path, 'r') as f:
-                statuses = json.load(f)
-
-            task_status = None
-            for rec_status in statuses:
-                if rec_status['TaskId'] == taskId:
-                    task_status = rec_status
-                    break
-
-            if task_status is None:
-                raise ValueError('taskId "{}" is not found. Decorate your endpoint with an ai4e_service decorator or call AddTask(request) before UpdateTaskStatus.'.format(taskId))
-            else:
-                task_status['Status'] = status
-                task_status['Timestamp'] = datetime.strftime(
-                    datetime.utcnow(), "%Y-%m-%d %H:%M:%S")
+        self._set_status(taskId, status, TASK_STATE_ACTIVE)
 
-            with open(self.task_status_json_path, 'w') as f:
-                json.dump(statuses, f)
+    def _set_status(self, taskId, status, state, result=None):
+        timestamp = datetime.strftime(datetime.utcnow(), "%Y-%m-%d %H:%M:%S")
+        if not self.task_store.update(taskId, status, timestamp, state, result):
+            raise ValueError('taskId "{}" is not found. Decorate your endpoint with an ai4e_service decorator or call AddTask(request) before UpdateTaskStatus.'.format(taskId))
+        self.notifier.notify(taskId)
 
     def AddPipelineTask(self, taskId, organization_moniker, version, api_name, body):
         next_url = version + '/' + organization_moniker + '/' + api_name
@@ -88,21 +76,25 @@ class TaskManager:
         else:
             return r.status_code
 
-    def CompleteTask(self, taskId, status):
-        self.UpdateTaskStatus(taskId, status)
+    def CompleteTask(self, taskId, status, result=None, content_type=None):
+        """Marks a task as completed, with an optional result.
+
+        result can be JSON-serializable data, bytes or a numpy array, and is returned by
+        API_PREFIX/task/<id>/result. content_type sets the Content-Type of the result,
+        for example 'image/jpeg' for bytes.
+        """
+        descriptor = None
+        if result is not None:
+            descriptor = self.result_store.save(taskId, result, content_type)
+        self._set_status(taskId, status, TASK_STATE_COMPLETED, descriptor)
 
     def FailTask(self, taskId, status):
-        self.UpdateTaskStatus(taskId, status)
+        self._set_status(taskId, status, TASK_STATE_FAILED)
 
     def GetTaskStatus(self, taskId: str) -> Dict[str, Any]:
-        with self.task_status_json_lock:
-            if os.path.isfile(self.task_status_json_path):
-                with open(self.task_status_json_path, 'r') as f:
-                    statuses = json.load(f)
-
-                for rec_status in statuses:
-                    if rec_status['TaskId'] == taskId:
-                        return rec_status
+        rec_status = self.task_store.get(taskId)
+        if rec_status is not None:
+            return rec_status
 
         status = {
             'TaskId': taskId,
@@ -111,3 +103,24 @@ class TaskManager:
             'Endpoint': ''
         }
         return status
+
+    def WaitForTaskStatus(self, taskId: str, since_version: Optional[int] = None, timeout: float = 0) -> Dict[str, Any]:
+        """Returns the status of a task once its Version is greater than since_version.
+
+        If since_version is None, waits for the next update after the call. Returns
+        immediately if the task is not found or has completed or failed, and returns
+        the current status if nothing changes within timeout seconds.
+        """
+        deadline = time.monotonic() + timeout
+        with self.notifier.watch(taskId) as watcher:
+            status = self.GetTaskStatus(taskId)
+            if since_version is None:
+                since_version = status.get('Version', 0)
+
+            while 'Version' in status and status['Version'] <= since_version and status['State'] not in TERMINAL_TASK_STATES:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                watcher.wait(min(remaining, TASK_WAIT_POLL_SECONDS))
+                status = self.GetTaskStatus(taskId)
+        return status
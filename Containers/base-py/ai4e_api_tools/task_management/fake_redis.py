@@ -0,0 +1,190 @@
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License.
+# An in-process stand-in for a Redis server, with the commands used by RedisTaskStore.
+# Several RedisTaskStore (or TaskManager) instances given the same FakeRedis behave
+# like worker processes sharing one Redis server, which makes the Redis backend
+# testable without a server.
+import threading
+import time
+
+
+class FakeRedis:
+    """A thread-safe subset of redis.Redis(decode_responses=True), holding data in memory.
+
+    Values are stored as strings, like Redis does. Transactions run all of their
+    commands under one lock, so they are atomic with respect to other clients.
+    """
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._data = {}
+        self._expires_at = {}
+
+    def _get(self, key, default=None):
+        expires_at = self._expires_at.get(key)
+        if expires_at is not None and expires_at <= time.time():
+            self._data.pop(key, None)
+            del self._expires_at[key]
+        return self._data.get(key, default)
+
+    # Keys..............................................
+    def exists(self, *keys):
+        with self._lock:
+            return sum(1 for key in keys if self._get(key) is not None)
+
+    def delete(self, *keys):
+        with self._lock:
+            deleted = 0
+            for key in keys:
+                if self._get(key) is not None:
+                    del self._data[key]
+                    deleted += 1
+                self._expires_at.pop(key, None)
+            return deleted
+
+    # Strings...........................................
+    def set(self, key, value, ex=None):
+        with self._lock:
+            self._data[key] = str(value)
+            if ex is None:
+                self._expires_at.pop(key, None)
+            else:
+                self._expires_at[key] = time.time() + ex
+            return True
+
+    def get(self, key):
+        with self._lock:
+            return self._get(key)
+
+    # Hashes............................................
+    def hset(self, key, field=None, value=None, mapping=None):
+        with self._lock:
+            values = dict(mapping or {})
+            if field is not None:
+                values[field] = value
+            fields = self._data.setdefault(key, {})
+            added = sum(1 for name in values if name not in fields)
+            fields.update((name, str(item)) for name, item in values.items())
+            return added
+
+    def hget(self, key, field):
+        with self._lock:
+            return self._get(key, {}).get(field)
+
+    def hmget(self, key, *fields):
+        with self._lock:
+            value = self._get(key, {})
+            return [value.get(field) for field in fields]
+
+    def hgetall(self, key):
+        with self._lock:
+            return dict(self._get(key, {}))
+
+    def hdel(self, key, *fields):
+        with self._lock:
+            values = self._get(key, {})
+            deleted = sum(1 for field in fields if values.pop(field, None) is not None)
+            if key in self._data and not values:
+                del self._data[key]
+            return deleted
+
+    def hincrby(self, key, field, amount=1):
+        with self._lock:
+            values = self._data.setdefault(key, {})
+            value = int(values.get(field, 0)) + amount
+            values[field] = str(value)
+            return value
+
+    # Sorted sets.......................................
+    def zadd(self, key, mapping):
+        with self._lock:
+            members = self._data.setdefault(key, {})
+            added = sum(1 for member in mapping if member not in members)
+            members.update((member, float(score)) for member, score in mapping.items())
+            return added
+
+    def zrem(self, key, *members):
+        with self._lock:
+            values = self._get(key, {})
+            removed = sum(1 for member in members if values.pop(member, None) is not None)
+            if key in self._data and not values:
+                del self._data[key]
+            return removed
+
+    def zcard(self, key):
+        with self._lock:
+            return len(self._get(key, {}))
+
+    def zrange(self, key, start, end, withscores=False):
+        with self._lock:
+            items = self._sorted_members(key)
+        items = items[start:] if end == -1 else items[start:end + 1]
+        return items if withscores else [member for member, _ in items]
+
+    def zrangebyscore(self, key, min, max, start=None, num=None, withscores=False):
+        low = float(min)
+        high = float(max)
+        with self._lock:
+            items = [(member, score) for member, score in self._sorted_members(key) if low <= score <= high]
+        if start is not None and num is not None:
+            items = items[start:start + num]
+        return items if withscores else [member for member, _ in items]
+
+    def _sorted_members(self, key):
+        return sorted(self._get(key, {}).items(), key=lambda item: (item[1], item[0]))
+
+    def pipeline(self, transaction=True):
+        return FakePipeline(self)
+
+    def transaction(self, func, *watches, value_from_callable=False):
+        # The lock is held from WATCH to EXEC, so the watched keys cannot change and the
+        # transaction never has to be retried.
+        with self._lock:
+            pipe = self.pipeline()
+            if watches:
+                pipe.watch(*watches)
+            value = func(pipe)
+            results = pipe.execute()
+        return value if value_from_callable else results
+
+
+class FakePipeline:
+    """Queues commands and runs them together in execute(), like redis.client.Pipeline.
+
+    After watch(), commands run immediately until multi() is called.
+    """
+    def __init__(self, client):
+        self._client = client
+        self._commands = []
+        self._watching = False
+
+    def watch(self, *keys):
+        self._watching = True
+
+    def multi(self):
+        self._watching = False
+
+    def unwatch(self):
+        self._watching = False
+
+    def __getattr__(self, name):
+        method = getattr(self._client, name)
+        if self._watching:
+            return method
+
+        def queue(*args, **kwargs):
+            self._commands.append((method, args, kwargs))
+            return self
+        return queue
+
+    def execute(self):
+        commands, self._commands = self._commands, []
+        self._watching = False
+        with self._client._lock:
+            return [method(*args, **kwargs) for method, args, kwargs in commands]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._commands = []
+        self._watching = False
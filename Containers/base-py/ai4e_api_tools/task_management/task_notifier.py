@@ -0,0 +1,77 @@
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License.
+# In-process notifications of task status changes, used by long-poll and
+# server-sent-event status requests to wake up as soon as a task is updated.
+from contextlib import contextmanager
+import threading
+
+
+class _TaskWatch:
+    __slots__ = ('condition', 'generation', 'watchers')
+
+    def __init__(self):
+        self.condition = threading.Condition(threading.Lock())
+        self.generation = 0
+        self.watchers = 0
+
+
+class TaskWatcher:
+    """Returned by TaskStatusNotifier.watch(). Waits for the next notification of one task."""
+    def __init__(self, watch):
+        self._watch = watch
+        self._seen = watch.generation
+
+    def wait(self, timeout):
+        """Blocks until the task has been notified since the last call, or timeout seconds pass.
+
+        Returns True if a notification arrived.
+        """
+        watch = self._watch
+        with watch.condition:
+            if watch.generation == self._seen:
+                watch.condition.wait(timeout)
+            notified = watch.generation != self._seen
+            self._seen = watch.generation
+        return notified
+
+
+class TaskStatusNotifier:
+    """Wakes threads waiting on a task when its status is updated in this process.
+
+    Only tasks with a waiting thread have a Condition, so notify() costs a dict lookup
+    when nobody is waiting. Updates made by other processes (gunicorn workers or
+    process executor workers) are not notified; waiters find them by re-reading the
+    task store when their wait times out.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._watches = {}
+
+    def notify(self, task_id):
+        watch = self._watches.get(task_id)
+        if watch is None:
+            return
+        with watch.condition:
+            watch.generation += 1
+            watch.condition.notify_all()
+
+    @contextmanager
+    def watch(self, task_id):
+        """Registers interest in task_id for the duration of the with block and yields a TaskWatcher.
+
+        Notifications sent after watch() is entered are never missed, so read the task
+        status inside the with block, then call wait().
+        """
+        with self._lock:
+            watch = self._watches.get(task_id)
+            if watch is None:
+                watch = _TaskWatch()
+                self._watches[task_id] = watch
+            watch.watchers += 1
+        try:
+            yield TaskWatcher(watch)
+        finally:
+            with self._lock:
+                watch.watchers -= 1
+                if watch.watchers == 0:
+                    del self._watches[task_id]
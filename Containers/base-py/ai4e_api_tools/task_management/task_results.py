@@ -0,0 +1,161 @@
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License.
+# Storage for the results of async tasks. Small JSON results are kept in the task
+# status record; everything else is written to a result store on local disk or in
+# blob storage, and the status record only describes it.
+from io import BytesIO
+import json
+import os
+import tempfile
+from typing import Any, Dict, Iterator, List, Optional
+
+TASK_RESULT_STORE = os.getenv('TASK_RESULT_STORE', 'local')  # local or blob
+TASK_RESULT_DIR = os.getenv('TASK_RESULT_DIR')
+TASK_RESULT_CONTAINER = os.getenv('TASK_RESULT_CONTAINER', 'task-results')
+# JSON results up to this size are stored in the task status record.
+TASK_RESULT_INLINE_BYTES = int(os.getenv('TASK_RESULT_INLINE_BYTES', '4096'))
+TASK_RESULT_CHUNK_SIZE = int(os.getenv('TASK_RESULT_CHUNK_SIZE', str(1024 * 1024)))
+
+JSON_CONTENT_TYPE = 'application/json'
+BYTES_CONTENT_TYPE = 'application/octet-stream'
+NUMPY_CONTENT_TYPE = 'application/x-npy'
+
+
+def encode_result(result: Any, content_type: Optional[str] = None):
+    """Returns (content_type, data) for a task result.
+
+    bytes-like results are stored as they are, numpy arrays in the .npy format and
+    anything else as compact JSON. content_type overrides the detected type, for
+    example 'image/jpeg' for bytes.
+    """
+    if isinstance(result, (bytes, bytearray, memoryview)):
+        return content_type or BYTES_CONTENT_TYPE, bytes(result)
+
+    if type(result).__module__ == 'numpy' and hasattr(result, 'dtype'):
+        # numpy is only imported when a task returns an array.
+        import numpy as np
+        buffer = BytesIO()
+        np.save(buffer, result, allow_pickle=False)
+        return content_type or NUMPY_CONTENT_TYPE, buffer.getvalue()
+
+    return content_type or JSON_CONTENT_TYPE, _encode_json(result)
+
+
+def _encode_json(value):
+    return json.dumps(value, separators=(',', ':')).encode('utf-8')
+
+
+class ResultStore:
+    """Base class for task result storage.
+
+    save() returns a descriptor that is kept in the task status record as Result:
+    {'ContentType': ..., 'Size': ...}, plus 'Value' for JSON results that are stored
+    inline.
+    """
+    def __init__(self, inline_bytes: int = TASK_RESULT_INLINE_BYTES):
+        self.inline_bytes = inline_bytes
+
+    def save(self, task_id: str, result: Any, content_type: Optional[str] = None) -> Dict[str, Any]:
+        content_type, data = encode_result(result, content_type)
+        descriptor = {'ContentType': content_type, 'Size': len(data)}
+        if content_type == JSON_CONTENT_TYPE and len(data) <= self.inline_bytes:
+            descriptor['Value'] = result
+        else:
+            self.write(task_id, data)
+        return descriptor
+
+    def iter_range(self, task_id: str, descriptor: Dict[str, Any], start: int, stop: int, chunk_size: int = TASK_RESULT_CHUNK_SIZE) -> Iterator[bytes]:
+        """Yields bytes [start, stop) of a task result."""
+        if 'Value' in descriptor:
+            yield _encode_json(descriptor['Value'])[start:stop]
+            return
+        for chunk in self.read_range(task_id, start, stop, chunk_size):
+            yield chunk
+
+    def write(self, task_id: str, data: bytes) -> None:
+        raise NotImplementedError()
+
+    def read_range(self, task_id: str, start: int, stop: int, chunk_size: int) -> Iterator[bytes]:
+        raise NotImplementedError()
+
+    def delete(self, task_ids: List[str]) -> None:
+        """Deletes the results of tasks. Tasks without a stored result are ignored."""
+        raise NotImplementedError()
+
+
+class LocalResultStore(ResultStore):
+    """Keeps each result in a file named after its task id."""
+    def __init__(self, directory: str, inline_bytes: int = TASK_RESULT_INLINE_BYTES):
+        super().__init__(inline_bytes)
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def _get_path(self, task_id):
+        return os.path.join(self.directory, os.path.basename(task_id))
+
+    def write(self, task_id, data):
+        # Write to a temporary file first, so a result is never read half-written.
+        fd, temp_path = tempfile.mkstemp(dir=self.directory, prefix='.tmp_')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(temp_path, self._get_path(task_id))
+        except:
+            os.remove(temp_path)
+            raise
+
+    def read_range(self, task_id, start, stop, chunk_size):
+        with open(self._get_path(task_id), 'rb') as f:
+            f.seek(start)
+            remaining = stop - start
+            while remaining > 0:
+                chunk = f.read(min(chunk_size, remaining))
+                if not chunk:
+                    break
+                remaining -= len(chunk)
+                yield chunk
+
+    def delete(self, task_ids):
+        for task_id in task_ids:
+            try:
+                os.remove(self._get_path(task_id))
+            except FileNotFoundError:
+                pass
+
+
+class BlobResultStore(ResultStore):
+    """Keeps each result in a blob named after its task id, through an AadBlob."""
+    def __init__(self, aad_blob, container: str = TASK_RESULT_CONTAINER, inline_bytes: int = TASK_RESULT_INLINE_BYTES):
+        super().__init__(inline_bytes)
+        self.aad_blob = aad_blob
+        self.container = container
+
+    def write(self, task_id, data):
+        with tempfile.NamedTemporaryFile() as f:
+            f.write(data)
+            f.flush()
+            self.aad_blob.upload_blob_from_path(self.container, task_id, f.name)
+
+    def read_range(self, task_id, start, stop, chunk_size):
+        for offset in range(start, stop, chunk_size):
+            yield bytes(self.aad_blob.read_blob_range(self.container, task_id, offset, min(chunk_size, stop - offset)))
+
+    def delete(self, task_ids):
+        for task_id in task_ids:
+            self.aad_blob.delete_blob(self.container, task_id)
+
+
+def create_result_store(directory: str, store_type: str = TASK_RESULT_STORE) -> ResultStore:
+    """Creates the result store selected by TASK_RESULT_STORE.
+
+    Local results are written to TASK_RESULT_DIR, or to task_results in directory.
+    Blob results are written to TASK_RESULT_CONTAINER using the AAD_* environment variables.
+    """
+    if store_type == 'local':
+        return LocalResultStore(TASK_RESULT_DIR or os.path.join(directory, 'task_results'))
+    elif store_type == 'blob':
+        from aad_blob import AadBlob
+        aad_blob = AadBlob(os.getenv('AAD_TENANT_ID'), os.getenv('AAD_APPLICATION_ID'), os.getenv('AAD_APPLICATION_SECRET'), os.getenv('AAD_ACCOUNT_NAME'), os.getenv('LOCAL_BLOB_TEST_DIRECTORY', None))
+        return BlobResultStore(aad_blob)
+    else:
+        raise ValueError('Unknown TASK_RESULT_STORE "{}". Supported stores are: local, blob.'.format(store_type))
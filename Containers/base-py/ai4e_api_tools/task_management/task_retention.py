@@ -0,0 +1,68 @@
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License.
+# Background removal of old task records, so that the task store stays the same
+# size over long uptimes.
+import os
+import random
+import threading
+import time
+
+from task_management.task_store import TASK_STATE_ACTIVE, TASK_STATE_COMPLETED, TASK_STATE_FAILED
+
+# Seconds after their last update that tasks are removed, per state. 0 keeps them forever.
+TASK_TTL_COMPLETED_SECONDS = float(os.getenv('TASK_TTL_COMPLETED_SECONDS', str(7 * 24 * 3600)))
+TASK_TTL_FAILED_SECONDS = float(os.getenv('TASK_TTL_FAILED_SECONDS', str(7 * 24 * 3600)))
+TASK_TTL_ACTIVE_SECONDS = float(os.getenv('TASK_TTL_ACTIVE_SECONDS', str(30 * 24 * 3600)))
+# Above this many tasks, the oldest completed and failed tasks are removed. 0 disables the limit.
+TASK_MAX_COUNT = int(os.getenv('TASK_MAX_COUNT', '100000'))
+# How long removed task ids keep returning the expired status.
+TASK_TOMBSTONE_SECONDS = float(os.getenv('TASK_TOMBSTONE_SECONDS', str(30 * 24 * 3600)))
+TASK_COMPACTION_INTERVAL_SECONDS = float(os.getenv('TASK_COMPACTION_INTERVAL_SECONDS', '300'))
+TASK_COMPACTION_BATCH_SIZE = int(os.getenv('TASK_COMPACTION_BATCH_SIZE', '500'))
+
+
+class TaskCompactor:
+    """Periodically calls compact() on a task store from a background thread.
+
+    The thread is started on first use in each process, like the telemetry flush
+    thread, so every gunicorn worker compacts the shared store. Compaction is
+    idempotent, and the start of each thread is randomly delayed so that workers do
+    not compact at the same time. An interval of 0 disables compaction.
+    """
+    def __init__(self, task_store, interval_seconds=TASK_COMPACTION_INTERVAL_SECONDS, ttl_seconds=None, max_tasks=TASK_MAX_COUNT, tombstone_seconds=TASK_TOMBSTONE_SECONDS, batch_size=TASK_COMPACTION_BATCH_SIZE, on_expired=None):
+        self.task_store = task_store
+        self.interval_seconds = interval_seconds
+        if ttl_seconds is None:
+            ttl_seconds = {TASK_STATE_COMPLETED: TASK_TTL_COMPLETED_SECONDS, TASK_STATE_FAILED: TASK_TTL_FAILED_SECONDS, TASK_STATE_ACTIVE: TASK_TTL_ACTIVE_SECONDS}
+        self.ttl_seconds = ttl_seconds
+        self.max_tasks = max_tasks
+        self.tombstone_seconds = tombstone_seconds
+        self.batch_size = batch_size
+        self.on_expired = on_expired
+        self._lock = threading.Lock()
+        self._pid = None
+
+    def ensure_started(self):
+        if self._pid == os.getpid() or self.interval_seconds <= 0:
+            return
+
+        with self._lock:
+            if self._pid != os.getpid():
+                threading.Thread(target=self._work, name='task-compaction', daemon=True).start()
+                self._pid = os.getpid()
+
+    def compact(self):
+        """Runs one compaction now. Returns the number of tasks removed."""
+        return self.task_store.compact(self.ttl_seconds, self.max_tasks, self.tombstone_seconds, self.batch_size, self.on_expired)
+
+    def _work(self):
+        time.sleep(random.uniform(0, self.interval_seconds))
+        while True:
+            try:
+                expired = self.compact()
+                if expired:
+                    print('Task compaction removed {} tasks.'.format(expired))
+            except Exception as e:
+                print('Exception during task compaction:')
+                print(e)
+            time.sleep(self.interval_seconds)
@@ -0,0 +1,558 @@
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License.
+# Storage backends used by the TaskManager to persist task status records.
+# Every backend exposes the same small interface, keyed by TaskId, so that the
+# TaskManager can switch between them without changing its public methods.
+import calendar
+from contextlib import contextmanager
+import fcntl
+import json
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional
+
+TASK_STORE_BACKEND = os.getenv('TASK_STORE_BACKEND', 'sqlite')
+TASK_STORE_BUSY_TIMEOUT_MS = int(os.getenv('TASK_STORE_BUSY_TIMEOUT_MS', '5000'))
+TASK_STORE_REDIS_URL = os.getenv('TASK_STORE_REDIS_URL', 'redis://localhost:6379/0')
+# Prefix of every Redis key, so that several APIs can share one Redis database.
+TASK_STORE_REDIS_PREFIX = os.getenv('TASK_STORE_REDIS_PREFIX', 'ai4e:' + os.getenv('API_PREFIX', ''))
+
+# The State of a task record. Tasks are active until CompleteTask or FailTask is called.
+TASK_STATE_ACTIVE = 'active'
+TASK_STATE_COMPLETED = 'completed'
+TASK_STATE_FAILED = 'failed'
+TERMINAL_TASK_STATES = (TASK_STATE_COMPLETED, TASK_STATE_FAILED)
+# Tasks removed by compaction are remembered with this Status and State.
+TASK_STATE_EXPIRED = 'expired'
+
+# Timestamps are UTC strings in this format, so they sort in time order.
+TIMESTAMP_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+
+def format_timestamp(seconds: float) -> str:
+    return time.strftime(TIMESTAMP_FORMAT, time.gmtime(seconds))
+
+
+def parse_timestamp(timestamp: str) -> float:
+    return calendar.timegm(time.strptime(timestamp, TIMESTAMP_FORMAT))
+
+
+class _ForkGuard:
+    """Keeps os.fork() from running while another thread is inside SQLite.
+
+    SQLite holds process-wide mutexes during a call. A child forked in the middle of
+    one inherits them locked and hangs on its first query, so forks wait until calls
+    in progress have returned, and new calls wait until the fork is done.
+    """
+    def __init__(self):
+        self._reset()
+
+    def _reset(self):
+        self._condition = threading.Condition(threading.Lock())
+        self._active = 0
+        self._forking = False
+
+    def __enter__(self):
+        with self._condition:
+            while self._forking:
+                self._condition.wait()
+            self._active += 1
+
+    def __exit__(self, *exc_info):
+        with self._condition:
+            self._active -= 1
+            if self._active == 0:
+                self._condition.notify_all()
+
+    def before_fork(self):
+        with self._condition:
+            self._forking = True
+            while self._active:
+                self._condition.wait()
+
+    def after_fork_in_parent(self):
+        with self._condition:
+            self._forking = False
+            self._condition.notify_all()
+
+_sqlite_fork_guard = _ForkGuard()
+if hasattr(os, 'register_at_fork'):
+    # The child has only the forking thread, so it starts with a fresh guard.
+    os.register_at_fork(before=_sqlite_fork_guard.before_fork, after_in_parent=_sqlite_fork_guard.after_fork_in_parent, after_in_child=_sqlite_fork_guard._reset)
+
+
+def _expired_record(task_id, endpoint, expired_at):
+    # Expired records have no Version, as they will never change again.
+    return {
+        'TaskId': task_id,
+        'Status': TASK_STATE_EXPIRED,
+        'Timestamp': expired_at,
+        'Endpoint': endpoint,
+        'State': TASK_STATE_EXPIRED
+    }
+
+
+class TaskStore:
+    """Base class for task status storage backends.
+
+    Records are dictionaries with the keys TaskId, Status, Timestamp, Endpoint, State
+    and Version. Version starts at 0 and is incremented by every update. Records of
+    tasks that were completed with a result also have a Result descriptor.
+    """
+    def add(self, record: Dict[str, Any]) -> None:
+        raise NotImplementedError()
+
+    def update(self, task_id: str, status: Any, timestamp: str, state: str = TASK_STATE_ACTIVE, result: Optional[Dict[str, Any]] = None) -> bool:
+        """Updates the status, state and result descriptor of a task. Returns False if the task does not exist."""
+        raise NotImplementedError()
+
+    def get(self, task_id: str) -> Optional[Dict[str, Any]]:
+        """Returns the record of a task, an expired record if it was removed by compact(), or None."""
+        raise NotImplementedError()
+
+    def compact(self, ttl_seconds: Dict[str, float], max_tasks: int = 0, tombstone_seconds: float = 0, batch_size: int = 500, on_expired: Optional[Callable[[List[str]], None]] = None) -> int:
+        """Removes old task records and returns the number removed.
+
+        ttl_seconds maps a State to the number of seconds after its last update that a
+        task in that state is removed. If more than max_tasks records remain, the
+        completed and failed tasks with the oldest updates are removed as well. Removed
+        task ids are remembered as expired for tombstone_seconds. on_expired is called
+        with each batch of removed task ids. A value of 0 disables a limit.
+        """
+        raise NotImplementedError()
+
+
+class SqliteTaskStore(TaskStore):
+    """Task store backed by a SQLite database in WAL mode.
+
+    Lookups and updates go through the TaskId primary key index, so their cost does
+    not depend on the number of stored tasks. WAL mode lets status reads proceed
+    while another thread or process is writing.
+    """
+    def __init__(self, db_path: str):
+        self.db_path = db_path
+        self._local = threading.local()
+        with self._connection():
+            pass
+
+    @contextmanager
+    def _connection(self):
+        # Every use of the connection is inside the fork guard.
+        with _sqlite_fork_guard:
+            yield self._get_connection()
+
+    def _get_connection(self) -> sqlite3.Connection:
+        # SQLite connections must not be shared across threads or forked processes.
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.db_path, timeout=TASK_STORE_BUSY_TIMEOUT_MS / 1000.0, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.execute('PRAGMA busy_timeout={}'.format(TASK_STORE_BUSY_TIMEOUT_MS))
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS tasks ('
+                'task_id TEXT PRIMARY KEY, '
+                'status TEXT, '
+                'timestamp TEXT, '
+                'endpoint TEXT, '
+                'state TEXT, '
+                'version INTEGER NOT NULL DEFAULT 0, '
+                'result TEXT)')
+            self._migrate(conn)
+            conn.execute('CREATE INDEX IF NOT EXISTS tasks_state_timestamp ON tasks (state, timestamp)')
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS expired_tasks ('
+                'task_id TEXT PRIMARY KEY, '
+                'endpoint TEXT, '
+                'expired_at TEXT)')
+            conn.execute('CREATE INDEX IF NOT EXISTS expired_tasks_expired_at ON expired_tasks (expired_at)')
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def _migrate(self, conn):
+        # Databases created before the state, version and result columns existed.
+        columns = [row[1] for row in conn.execute('PRAGMA table_info(tasks)')]
+        for column, definition in (('state', 'TEXT'), ('version', 'INTEGER NOT NULL DEFAULT 0'), ('result', 'TEXT')):
+            if column not in columns:
+                try:
+                    conn.execute('ALTER TABLE tasks ADD COLUMN {} {}'.format(column, definition))
+                except sqlite3.OperationalError as e:
+                    # Another process added the column first.
+                    if 'duplicate column' not in str(e):
+                        raise
+        if 'state' not in columns:
+            conn.execute('UPDATE tasks SET state = ? WHERE state IS NULL', (TASK_STATE_ACTIVE,))
+
+    def add(self, record):
+        with self._connection() as conn:
+            conn.execute(
+                'INSERT INTO tasks (task_id, status, timestamp, endpoint, state, version) VALUES (?, ?, ?, ?, ?, ?)',
+                (record['TaskId'], json.dumps(record['Status']), record['Timestamp'], record['Endpoint'], record.get('State', TASK_STATE_ACTIVE), record.get('Version', 0)))
+
+    def update(self, task_id, status, timestamp, state=TASK_STATE_ACTIVE, result=None):
+        with self._connection() as conn:
+            cursor = conn.execute(
+                'UPDATE tasks SET status = ?, timestamp = ?, state = ?, version = version + 1, result = ? WHERE task_id = ?',
+                (json.dumps(status), timestamp, state, None if result is None else json.dumps(result), task_id))
+            return cursor.rowcount > 0
+
+    def get(self, task_id):
+        with self._connection() as conn:
+            row = conn.execute(
+                'SELECT task_id, status, timestamp, endpoint, state, version, result FROM tasks WHERE task_id = ?',
+                (task_id,)).fetchone()
+
+            if row is None:
+                row = conn.execute(
+                    'SELECT task_id, endpoint, expired_at FROM expired_tasks WHERE task_id = ?',
+                    (task_id,)).fetchone()
+                return None if row is None else _expired_record(*row)
+
+        record = {
+            'TaskId': row[0],
+            'Status': json.loads(row[1]),
+            'Timestamp': row[2],
+            'Endpoint': row[3],
+            'State': row[4] or TASK_STATE_ACTIVE,
+            'Version': row[5]
+        }
+        if row[6] is not None:
+            record['Result'] = json.loads(row[6])
+        return record
+
+
+    def compact(self, ttl_seconds, max_tasks=0, tombstone_seconds=0, batch_size=500, on_expired=None):
+        now = time.time()
+        expired = 0
+        for state, ttl in ttl_seconds.items():
+            if ttl > 0:
+                expired += self._expire(
+                    'SELECT task_id FROM tasks WHERE state = ? AND timestamp < ? LIMIT ?',
+                    (state, format_timestamp(now - ttl)), batch_size, now, on_expired)
+
+        if max_tasks > 0:
+            with self._connection() as conn:
+                excess = conn.execute('SELECT COUNT(*) FROM tasks').fetchone()[0] - max_tasks
+            if excess > 0:
+                expired += self._expire(
+                    'SELECT task_id FROM tasks WHERE state IN (?, ?) ORDER BY timestamp LIMIT ?',
+                    TERMINAL_TASK_STATES, batch_size, now, on_expired, excess)
+
+        with self._connection() as conn:
+            if tombstone_seconds > 0:
+                conn.execute('DELETE FROM expired_tasks WHERE expired_at < ?', (format_timestamp(now - tombstone_seconds),))
+
+            if expired:
+                # Deleted pages are reused by new records; truncating the WAL keeps the file from growing.
+                conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+        return expired
+
+    def _expire(self, select_sql, params, batch_size, now, on_expired, limit=None):
+        # Each batch is a short transaction, so status updates from other threads and
+        # processes wait for at most one batch.
+        expired_at = format_timestamp(now)
+        expired = 0
+        while limit is None or expired < limit:
+            count = batch_size if limit is None else min(batch_size, limit - expired)
+            with self._connection() as conn:
+                task_ids = [row[0] for row in conn.execute(select_sql, params + (count,))]
+                if not task_ids:
+                    break
+
+                conn.execute('BEGIN IMMEDIATE')
+                try:
+                    conn.executemany(
+                        'INSERT OR REPLACE INTO expired_tasks (task_id, endpoint, expired_at) SELECT task_id, endpoint, ? FROM tasks WHERE task_id = ?',
+                        [(expired_at, task_id) for task_id in task_ids])
+                    conn.executemany('DELETE FROM tasks WHERE task_id = ?', [(task_id,) for task_id in task_ids])
+                    conn.execute('COMMIT')
+                except:
+                    conn.execute('ROLLBACK')
+                    raise
+
+            expired += len(task_ids)
+            if on_expired:
+                on_expired(task_ids)
+            if len(task_ids) < count:
+                break
+        return expired
+
+
+class JsonFileTaskStore(TaskStore):
+    """Legacy task store that keeps every record in a single JSON file.
+
+    Each call reads and, for writes, rewrites the whole file, so the cost grows with the
+    number of tasks. It is kept for deployments that read task_status.json directly.
+    Writes hold an exclusive lock on task_status.json.lock, so worker processes do not
+    overwrite each other's changes, and replace the file atomically, so reads need no lock.
+    """
+    def __init__(self, json_path: str):
+        self.json_path = json_path
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def _locked(self):
+        with self._lock:
+            with open(self.json_path + '.lock', 'a') as lock_file:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                try:
+                    yield
+                finally:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _load(self):
+        if not os.path.isfile(self.json_path):
+            return []
+        with open(self.json_path, 'r') as f:
+            return json.load(f)
+
+    def _save(self, statuses):
+        fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(self.json_path)), prefix='.task_status_')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(statuses, f)
+            os.replace(temp_path, self.json_path)
+        except:
+            os.remove(temp_path)
+            raise
+
+    def add(self, record):
+        with self._locked():
+            statuses = self._load()
+            statuses.append(record)
+            self._save(statuses)
+
+    def update(self, task_id, status, timestamp, state=TASK_STATE_ACTIVE, result=None):
+        with self._locked():
+            statuses = self._load()
+            for rec_status in statuses:
+                if rec_status['TaskId'] == task_id:
+                    rec_status['Status'] = status
+                    rec_status['Timestamp'] = timestamp
+                    rec_status['State'] = state
+                    rec_status['Version'] = rec_status.get('Version', 0) + 1
+                    if result is None:
+                        rec_status.pop('Result', None)
+                    else:
+                        rec_status['Result'] = result
+                    self._save(statuses)
+                    return True
+        return False
+
+    def get(self, task_id):
+        for rec_status in self._load():
+            if rec_status['TaskId'] == task_id:
+                if rec_status.get('State') != TASK_STATE_EXPIRED:
+                    rec_status.setdefault('State', TASK_STATE_ACTIVE)
+                    rec_status.setdefault('Version', 0)
+                return rec_status
+        return None
+
+    def compact(self, ttl_seconds, max_tasks=0, tombstone_seconds=0, batch_size=500, on_expired=None):
+        # Expired tasks are kept in the file as records with the expired State.
+        now = time.time()
+        expired_at = format_timestamp(now)
+        cutoffs = {state: format_timestamp(now - ttl) for state, ttl in ttl_seconds.items() if ttl > 0}
+        tombstone_cutoff = format_timestamp(now - tombstone_seconds) if tombstone_seconds > 0 else None
+
+        with self._locked():
+            statuses = self._load()
+            tasks = []
+            tombstones = []
+            expired_ids = []
+            for rec_status in statuses:
+                state = rec_status.get('State', TASK_STATE_ACTIVE)
+                if state == TASK_STATE_EXPIRED:
+                    if tombstone_cutoff is None or rec_status['Timestamp'] >= tombstone_cutoff:
+                        tombstones.append(rec_status)
+                elif state in cutoffs and rec_status['Timestamp'] < cutoffs[state]:
+                    expired_ids.append(rec_status['TaskId'])
+                    tombstones.append(_expired_record(rec_status['TaskId'], rec_status['Endpoint'], expired_at))
+                else:
+                    tasks.append(rec_status)
+
+            if max_tasks > 0 and len(tasks) > max_tasks:
+                terminal = sorted((rec_status for rec_status in tasks if rec_status.get('State') in TERMINAL_TASK_STATES), key=lambda rec_status: rec_status['Timestamp'])
+                removed = set()
+                for rec_status in terminal[:len(tasks) - max_tasks]:
+                    removed.add(rec_status['TaskId'])
+                    expired_ids.append(rec_status['TaskId'])
+                    tombstones.append(_expired_record(rec_status['TaskId'], rec_status['Endpoint'], expired_at))
+                tasks = [rec_status for rec_status in tasks if rec_status['TaskId'] not in removed]
+
+            if expired_ids or len(tasks) + len(tombstones) != len(statuses):
+                self._save(tasks + tombstones)
+
+        if expired_ids and on_expired:
+            for i in range(0, len(expired_ids), batch_size):
+                on_expired(expired_ids[i:i + batch_size])
+        return len(expired_ids)
+
+
+class RedisTaskStore(TaskStore):
+    """Task store backed by Redis, shared by every worker process and every pod.
+
+    client is a redis.Redis created with decode_responses=True, or any object with
+    the same methods, such as fake_redis.FakeRedis. Each task is a hash, and a sorted
+    set per State holds the task ids by last update time for compaction. Expired task
+    ids are kept as strings that Redis deletes after tombstone_seconds; a
+    tombstone_seconds of 0 keeps no tombstones, since Redis would otherwise keep them
+    in memory forever. Updates and compaction WATCH the task's hash, so a task removed
+    by compaction is never partly written back, and a task updated while it is being
+    compacted is kept.
+    """
+    _STATES = (TASK_STATE_ACTIVE, TASK_STATE_COMPLETED, TASK_STATE_FAILED)
+
+    def __init__(self, client, prefix: str = TASK_STORE_REDIS_PREFIX):
+        self.client = client
+        self.prefix = prefix
+
+    def _task_key(self, task_id):
+        return '{}:task:{}'.format(self.prefix, task_id)
+
+    def _expired_key(self, task_id):
+        return '{}:expired:{}'.format(self.prefix, task_id)
+
+    def _index_key(self, state):
+        return '{}:tasks:{}'.format(self.prefix, state)
+
+    def add(self, record):
+        state = record.get('State', TASK_STATE_ACTIVE)
+        pipe = self.client.pipeline(transaction=True)
+        pipe.hset(self._task_key(record['TaskId']), mapping={
+            'status': json.dumps(record['Status']),
+            'timestamp': record['Timestamp'],
+            'endpoint': record['Endpoint'],
+            'state': state,
+            'version': record.get('Version', 0)})
+        pipe.zadd(self._index_key(state), {record['TaskId']: parse_timestamp(record['Timestamp'])})
+        pipe.execute()
+
+    def update(self, task_id, status, timestamp, state=TASK_STATE_ACTIVE, result=None):
+        key = self._task_key(task_id)
+        mapping = {'status': json.dumps(status), 'timestamp': timestamp, 'state': state}
+        if result is not None:
+            mapping['result'] = json.dumps(result)
+
+        def set_status(pipe):
+            # Runs again if another client changes or removes the task before EXEC.
+            if not pipe.exists(key):
+                return False
+            pipe.multi()
+            pipe.hset(key, mapping=mapping)
+            if result is None:
+                pipe.hdel(key, 'result')
+            pipe.hincrby(key, 'version', 1)
+            for other_state in self._STATES:
+                if other_state != state:
+                    pipe.zrem(self._index_key(other_state), task_id)
+            pipe.zadd(self._index_key(state), {task_id: parse_timestamp(timestamp)})
+            return True
+
+        return self.client.transaction(set_status, key, value_from_callable=True)
+
+    def get(self, task_id):
+        fields = self.client.hgetall(self._task_key(task_id))
+        if not fields:
+            expired = self.client.get(self._expired_key(task_id))
+            if expired is None:
+                return None
+            expired = json.loads(expired)
+            return _expired_record(task_id, expired['Endpoint'], expired['Timestamp'])
+
+        record = {
+            'TaskId': task_id,
+            'Status': json.loads(fields['status']),
+            'Timestamp': fields['timestamp'],
+            'Endpoint': fields['endpoint'],
+            'State': fields.get('state', TASK_STATE_ACTIVE),
+            'Version': int(fields.get('version', 0))
+        }
+        if 'result' in fields:
+            record['Result'] = json.loads(fields['result'])
+        return record
+
+    def compact(self, ttl_seconds, max_tasks=0, tombstone_seconds=0, batch_size=500, on_expired=None):
+        now = time.time()
+        expired = 0
+        for state, ttl in ttl_seconds.items():
+            if ttl > 0:
+                while True:
+                    task_ids = self.client.zrangebyscore(self._index_key(state), '-inf', now - ttl, start=0, num=batch_size)
+                    if not task_ids:
+                        break
+                    expired += self._expire(task_ids, now, tombstone_seconds, on_expired, (state,), now - ttl)
+                    if len(task_ids) < batch_size:
+                        break
+
+        if max_tasks > 0:
+            excess = sum(self.client.zcard(self._index_key(state)) for state in self._STATES) - max_tasks
+            while excess > 0:
+                count = min(batch_size, excess)
+                # The oldest completed and failed tasks, merged from both indexes.
+                oldest = []
+                for state in TERMINAL_TASK_STATES:
+                    oldest.extend(self.client.zrange(self._index_key(state), 0, count - 1, withscores=True))
+                task_ids = [task_id for task_id, _ in sorted(oldest, key=lambda item: item[1])[:count]]
+                if not task_ids:
+                    break
+                removed = self._expire(task_ids, now, tombstone_seconds, on_expired, TERMINAL_TASK_STATES)
+                if not removed:
+                    # Another client removed or updated them first.
+                    break
+                expired += removed
+                excess -= removed
+        return expired
+
+    def _expire(self, task_ids, now, tombstone_seconds, on_expired, states, updated_before=None):
+        # Removes the tasks that are still in one of states, and were last updated no later
+        # than updated_before if it is given. Returns the number removed.
+        keys = [self._task_key(task_id) for task_id in task_ids]
+        expired_at = format_timestamp(now)
+
+        def remove_tasks(pipe):
+            # Runs again if another client changes one of the tasks before EXEC.
+            removed = []
+            unindexed = []
+            for task_id, key in zip(task_ids, keys):
+                state, timestamp, endpoint = pipe.hmget(key, 'state', 'timestamp', 'endpoint')
+                if timestamp is None:
+                    # Already removed; only its index entry is left.
+                    unindexed.append(task_id)
+                elif (state or TASK_STATE_ACTIVE) in states and (updated_before is None or parse_timestamp(timestamp) <= updated_before):
+                    removed.append((task_id, endpoint))
+
+            pipe.multi()
+            for task_id, endpoint in removed:
+                if tombstone_seconds > 0:
+                    tombstone = json.dumps({'Endpoint': endpoint or '', 'Timestamp': expired_at})
+                    pipe.set(self._expired_key(task_id), tombstone, ex=max(1, int(tombstone_seconds)))
+                pipe.delete(self._task_key(task_id))
+            removed_ids = [task_id for task_id, _ in removed]
+            if removed_ids or unindexed:
+                for state in self._STATES:
+                    pipe.zrem(self._index_key(state), *(removed_ids + unindexed))
+            return removed_ids
+
+        removed_ids = self.client.transaction(remove_tasks, *keys, value_from_callable=True)
+        if on_expired and removed_ids:
+            on_expired(removed_ids)
+        return len(removed_ids)
+
+
+def create_task_store(directory: str, backend: str = TASK_STORE_BACKEND) -> TaskStore:
+    """Creates the task store selected by the TASK_STORE_BACKEND environment variable."""
+    if backend == 'sqlite':
+        return SqliteTaskStore(os.path.join(directory, 'task_status.db'))
+    elif backend == 'json':
+        return JsonFileTaskStore(os.path.join(directory, 'task_status.json'))
+    elif backend == 'redis':
+        # redis is only required when this backend is selected.
+        import redis
+        return RedisTaskStore(redis.Redis.from_url(TASK_STORE_REDIS_URL, decode_responses=True))
+    else:
+        raise ValueError('Unknown TASK_STORE_BACKEND "{}". Supported backends are: sqlite, json, redis.'.format(backend))
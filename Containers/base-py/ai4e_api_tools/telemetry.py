@@ -0,0 +1,317 @@
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License.
+# Background telemetry pipeline. Request threads only append to a ring buffer; a
+# flush thread aggregates metrics, samples logs and hands both to a sink.
+from collections import deque
+from os import getenv
+import atexit
+import json
+import logging
+import os
+import sys
+import threading
+import time
+
+TELEMETRY_SINK = getenv('TELEMETRY_SINK', 'opencensus')  # opencensus, stdout, file or none
+TELEMETRY_FILE = getenv('TELEMETRY_FILE', 'telemetry.jsonl')
+TELEMETRY_FLUSH_SECONDS = float(getenv('TELEMETRY_FLUSH_SECONDS', '5'))
+TELEMETRY_BUFFER_SIZE = int(getenv('TELEMETRY_BUFFER_SIZE', '65536'))
+# Logs below WARNING are sampled to at most this many per second, with bursts of up to TELEMETRY_LOG_BURST.
+TELEMETRY_LOG_RATE = float(getenv('TELEMETRY_LOG_RATE', '100'))
+TELEMETRY_LOG_BURST = float(getenv('TELEMETRY_LOG_BURST', '200'))
+
+METRIC_KIND_COUNTER = 'counter'
+METRIC_KIND_GAUGE = 'gauge'
+METRIC_KIND_DISTRIBUTION = 'distribution'
+
+# Bucket boundaries used when distributions (such as request durations in milliseconds) are exported.
+DISTRIBUTION_BOUNDARIES = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000, 30000, 60000, 300000]
+
+_COUNTER = 0
+_GAUGE = 1
+_LOG = 2
+_DISTRIBUTION = 3
+
+_exception_formatter = logging.Formatter()
+
+
+class TokenBucket:
+    """Rate limiter for log sampling. Not locked: a race can only let an extra message through."""
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = burst
+        self._updated = time.monotonic()
+
+    def try_take(self):
+        now = time.monotonic()
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+        if self._tokens < 1:
+            return False
+        self._tokens -= 1
+        return True
+
+
+class TelemetryPipeline:
+    """Buffers metrics and logs and exports them from a background thread.
+
+    increment(), gauge(), distribution() and log() append a tuple to a bounded
+    deque, which is thread-safe without a lock. Every flush_seconds the flush
+    thread sums counters, keeps the last value of each gauge, groups the values
+    of each distribution and passes the result and the buffered log records to
+    the sink. If the buffer fills up between flushes,
+    the oldest entries are dropped.
+
+    The flush thread is started on first use in each process, so a pipeline
+    created before a web server forks its workers works in every worker. What
+    is still buffered is flushed when a process that used the pipeline exits.
+    """
+    def __init__(self, sink, flush_seconds=TELEMETRY_FLUSH_SECONDS, buffer_size=TELEMETRY_BUFFER_SIZE, log_rate=TELEMETRY_LOG_RATE, log_burst=TELEMETRY_LOG_BURST):
+        self.sink = sink
+        self.flush_seconds = flush_seconds
+        self._buffer = deque(maxlen=buffer_size)
+        self._log_sampler = TokenBucket(log_rate, log_burst)
+        self._sampled_out = 0
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._pid = None
+        atexit.register(self._flush_at_exit)
+
+    def increment(self, name, value=1):
+        self._ensure_worker()
+        self._buffer.append((_COUNTER, name, value))
+
+    def gauge(self, name, value):
+        self._ensure_worker()
+        self._buffer.append((_GAUGE, name, value))
+
+    def distribution(self, name, value):
+        self._ensure_worker()
+        self._buffer.append((_DISTRIBUTION, name, value))
+
+    def log(self, logger, level, message, extra=None, exc_info=False):
+        """Queues a log message for logger. Messages below WARNING are subject to sampling."""
+        if not logger.isEnabledFor(level):
+            return
+        if level < logging.WARNING and not self._log_sampler.try_take():
+            self._sampled_out += 1
+            return
+
+        exc_type = None
+        exc_text = None
+        if exc_info:
+            if isinstance(exc_info, BaseException):
+                exc_info = (type(exc_info), exc_info, exc_info.__traceback__)
+            elif not isinstance(exc_info, tuple):
+                exc_info = sys.exc_info()
+            if exc_info[0] is not None:
+                # Formatted now, so the buffer does not keep the frames of the traceback (and their locals) alive.
+                exc_type = exc_info[0]
+                exc_text = _exception_formatter.formatException(exc_info)
+        self._ensure_worker()
+        self._buffer.append((_LOG, logger, (level, message, extra, exc_type, exc_text, time.time())))
+
+    def flush(self):
+        """Exports everything buffered so far from the calling thread."""
+        with self._flush_lock:
+            counters = {}
+            gauges = {}
+            distributions = {}
+            records = []
+            while True:
+                try:
+                    kind, name, value = self._buffer.popleft()
+                except IndexError:
+                    break
+                if kind == _COUNTER:
+                    counters[name] = counters.get(name, 0) + value
+                elif kind == _GAUGE:
+                    gauges[name] = value
+                elif kind == _DISTRIBUTION:
+                    distributions.setdefault(name, []).append(value)
+                else:
+                    try:
+                        records.append(_make_record(name, *value))
+                    except Exception as e:
+                        print('Exception when creating a log record:')
+                        print(e)
+
+            sampled_out, self._sampled_out = self._sampled_out, 0
+            if sampled_out:
+                counters['telemetry_logs_sampled_out'] = sampled_out
+
+            try:
+                if counters or gauges or distributions:
+                    self.sink.export_metrics(counters, gauges, distributions)
+                if records:
+                    self.sink.export_logs(records)
+            except Exception as e:
+                print('Exception when exporting telemetry:')
+                print(e)
+
+    def _flush_at_exit(self):
+        if self._pid == os.getpid():
+            self.flush()
+
+    def _ensure_worker(self):
+        if self._pid == os.getpid():
+            return
+
+        with self._lock:
+            if self._pid != os.getpid():
+                # Threads do not survive a fork, so start the flush thread in this process.
+                self._buffer.clear()
+                threading.Thread(target=self._work, name='telemetry-flush', daemon=True).start()
+                self._pid = os.getpid()
+
+    def _work(self):
+        while True:
+            time.sleep(self.flush_seconds)
+            self.flush()
+
+
+def _make_record(logger, level, message, extra, exc_type, exc_text, created):
+    # Handlers see the exception type and the traceback formatted when the message was logged.
+    exc_info = (exc_type, None, None) if exc_type is not None else None
+    record = logger.makeRecord(logger.name, level, '(telemetry)', 0, message, None, exc_info, extra=extra)
+    record.exc_text = exc_text
+    # Keep the time of the original call rather than the time of the flush.
+    record.created = created
+    record.msecs = (created - int(created)) * 1000
+    return record
+
+
+class LoggingSink:
+    """Exports to the logger's handlers (such as AzureLogHandler) and to a metric exporter function.
+
+    export_metric(name, value, kind) is called once per metric per flush, where kind is
+    METRIC_KIND_COUNTER (value is the count since the last flush), METRIC_KIND_GAUGE or
+    METRIC_KIND_DISTRIBUTION (value is the list of values recorded since the last flush).
+    """
+    def __init__(self, export_metric=None):
+        self.export_metric = export_metric
+
+    def export_metrics(self, counters, gauges, distributions):
+        if not self.export_metric:
+            return
+        for name, value in counters.items():
+            self.export_metric(name, value, METRIC_KIND_COUNTER)
+        for name, value in gauges.items():
+            self.export_metric(name, value, METRIC_KIND_GAUGE)
+        for name, values in distributions.items():
+            self.export_metric(name, values, METRIC_KIND_DISTRIBUTION)
+
+    def export_logs(self, records):
+        for record in records:
+            logging.getLogger(record.name).handle(record)
+
+
+class OpenCensusMetricExporter:
+    """An export_metric function for LoggingSink that records metrics with OpenCensus stats.
+
+    A view is registered for each metric the first time it is exported: a sum for
+    counters, the last value for gauges and a distribution over
+    DISTRIBUTION_BOUNDARIES for distributions. The views are exported by the
+    exporters registered with view_manager, such as the Azure metrics exporter.
+    """
+    def __init__(self, view_manager, stats_recorder):
+        self.view_manager = view_manager
+        self.stats_recorder = stats_recorder
+        self.metrics = {}
+
+    def __call__(self, metric_name, metric_value, kind):
+        try:
+            if not metric_name in self.metrics:
+                self.metrics[metric_name] = self._register(metric_name, metric_value, kind)
+
+            measure = self.metrics[metric_name]['measure']
+            mmap = self.metrics[metric_name]['measurement_map']
+            tmap = self.metrics[metric_name]['tag_map']
+            if kind == METRIC_KIND_DISTRIBUTION:
+                for value in metric_value:
+                    mmap.measure_float_put(measure, value)
+                    mmap.record(tmap)
+            else:
+                mmap.measure_int_put(measure, metric_value)
+                mmap.record(tmap)
+        except Exception as e:
+            print('Exception when tracking a metric:')
+            print(e)
+
+    def _register(self, metric_name, metric_value, kind):
+        from opencensus.stats import aggregation as aggregation_module
+        from opencensus.stats import measure as measure_module
+        from opencensus.stats import view as view_module
+        from opencensus.tags import tag_map as tag_map_module
+
+        if kind == METRIC_KIND_DISTRIBUTION:
+            metrics_measure = measure_module.MeasureFloat(metric_name, metric_name, metric_name)
+            aggregation = aggregation_module.DistributionAggregation(DISTRIBUTION_BOUNDARIES)
+        elif kind == METRIC_KIND_COUNTER:
+            metrics_measure = measure_module.MeasureInt(metric_name, metric_name, metric_name)
+            aggregation = aggregation_module.SumAggregation()
+        else:
+            metrics_measure = measure_module.MeasureInt(metric_name, metric_name, metric_name)
+            aggregation = aggregation_module.LastValueAggregation(value=metric_value)
+        self.view_manager.register_view(view_module.View(metric_name, metric_name, [], metrics_measure, aggregation))
+        return {'measure': metrics_measure, 'measurement_map': self.stats_recorder.new_measurement_map(), 'tag_map': tag_map_module.TagMap()}
+
+
+class StreamSink:
+    """Writes metrics and logs as JSON lines, for running and testing without Azure."""
+    def __init__(self, stream):
+        self.stream = stream
+
+    def export_metrics(self, counters, gauges, distributions):
+        now = time.time()
+        for name, value in counters.items():
+            self._write({'time': now, 'type': METRIC_KIND_COUNTER, 'name': name, 'value': value})
+        for name, value in gauges.items():
+            self._write({'time': now, 'type': METRIC_KIND_GAUGE, 'name': name, 'value': value})
+        for name, values in distributions.items():
+            self._write({'time': now, 'type': METRIC_KIND_DISTRIBUTION, 'name': name, 'count': len(values), 'sum': sum(values), 'min': min(values), 'max': max(values)})
+        self.stream.flush()
+
+    def export_logs(self, records):
+        for record in records:
+            entry = {'time': record.created, 'type': 'log', 'level': record.levelname, 'message': record.getMessage()}
+            properties = getattr(record, 'custom_dimensions', None)
+            if properties:
+                entry['properties'] = properties
+            if record.exc_text:
+                entry['exception'] = record.exc_text
+            elif record.exc_info:
+                entry['exception'] = _exception_formatter.formatException(record.exc_info)
+            self._write(entry)
+        self.stream.flush()
+
+    def _write(self, entry):
+        self.stream.write(json.dumps(entry, default=str) + '\n')
+
+
+class FileSink(StreamSink):
+    def __init__(self, path=TELEMETRY_FILE):
+        super().__init__(open(path, 'a'))
+
+
+class NullSink:
+    def export_metrics(self, counters, gauges, distributions):
+        pass
+
+    def export_logs(self, records):
+        pass
+
+
+def create_sink(sink_type=TELEMETRY_SINK, export_metric=None):
+    """Creates the sink named by TELEMETRY_SINK. export_metric is used by the opencensus sink."""
+    if sink_type == 'opencensus':
+        return LoggingSink(export_metric)
+    elif sink_type == 'stdout':
+        return StreamSink(sys.stdout)
+    elif sink_type == 'file':
+        return FileSink()
+    elif sink_type == 'none':
+        return NullSink()
+    else:
+        raise ValueError('Unknown telemetry sink "{}". Supported sinks are: opencensus, stdout, file, none.'.format(sink_type))
@@ -0,0 +1,285 @@
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License.
+# Runs models over rasters larger than their input by cutting them into overlapping
+# tiles, and stitches the per-tile outputs back together. Tiles are produced and
+# batched lazily, so memory use depends on the tile and batch sizes, not on the
+# size of the raster. Requires numpy; Pillow is needed for image rasters.
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+from os import getenv
+
+import numpy as np
+
+TILE_SIZE = int(getenv('TILE_SIZE', '1024'))
+TILE_OVERLAP = int(getenv('TILE_OVERLAP', '128'))
+TILE_BATCH_SIZE = int(getenv('TILE_BATCH_SIZE', '4'))
+# Model calls that run at once. Batches waiting for a worker are limited to the same number.
+TILE_WORKERS = int(getenv('TILE_WORKERS', '2'))
+
+_NPY_MAGIC = b'\x93NUMPY'
+
+
+def tile_windows(width, height, tile_size=TILE_SIZE, overlap=TILE_OVERLAP):
+    """Returns the (left, top, right, bottom) windows of the tiles that cover a raster.
+
+    Neighbouring tiles share overlap pixels. The last row and column are moved back
+    to end at the edge of the raster, so that every tile is tile_size wide and high
+    unless the raster itself is smaller.
+    """
+    if overlap >= tile_size:
+        raise ValueError('The tile overlap ({}) must be smaller than the tile size ({}).'.format(overlap, tile_size))
+    lefts = _tile_starts(width, tile_size, overlap)
+    tops = _tile_starts(height, tile_size, overlap)
+    return [(left, top, min(left + tile_size, width), min(top + tile_size, height)) for top in tops for left in lefts]
+
+
+def _tile_starts(length, tile_size, overlap):
+    if length <= tile_size:
+        return [0]
+    stride = tile_size - overlap
+    starts = list(range(0, length - tile_size, stride))
+    starts.append(length - tile_size)
+    return starts
+
+
+def open_raster(source):
+    """Returns a raster that iter_tiles() can cut without decoding or copying more than needed.
+
+    Args:
+        source: a numpy array (H x W or H x W x C), the path of a .npy file, a
+            bytes-like object or file-like object holding a .npy file or an image
+            (such as kwargs['request_body']), or a PIL image.
+
+    .npy files are memory-mapped, and .npy request bodies are wrapped without a
+    copy; large request bodies are themselves memory-mapped files. Images are
+    decoded once with Pillow and cropped per tile.
+    """
+    if isinstance(source, np.ndarray):
+        return source
+    if isinstance(source, str):
+        if source.endswith('.npy'):
+            return np.load(source, mmap_mode='r')
+        from PIL import Image
+        return Image.open(source)
+    if hasattr(source, 'getbuffer'):
+        source = source.getbuffer()
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        if bytes(source[:len(_NPY_MAGIC)]) == _NPY_MAGIC:
+            return _wrap_npy(source)
+        source = BytesIO(source)
+    if hasattr(source, 'read'):
+        from PIL import Image
+        return Image.open(source)
+    # Anything else is treated as a PIL image.
+    return source
+
+
+def _wrap_npy(buffer):
+    header = BytesIO(bytes(buffer[:64 * 1024]))
+    version = np.lib.format.read_magic(header)
+    if version == (1, 0):
+        shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(header)
+    else:
+        shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(header)
+    count = int(np.prod(shape))
+    array = np.frombuffer(buffer, dtype=dtype, count=count, offset=header.tell())
+    return array.reshape(shape, order='F' if fortran_order else 'C')
+
+
+def raster_size(raster):
+    """Returns (width, height) of a raster from open_raster()."""
+    if isinstance(raster, np.ndarray):
+        return raster.shape[1], raster.shape[0]
+    return raster.size
+
+
+def iter_tiles(raster, tile_size=TILE_SIZE, overlap=TILE_OVERLAP):
+    """Yields (window, tile) for each tile of a raster, one at a time.
+
+    Tiles of arrays are views, so only the pages of a memory-mapped raster that a
+    tile covers are read. Tiles of PIL images are cropped copies.
+    """
+    width, height = raster_size(raster)
+    for window in tile_windows(width, height, tile_size, overlap):
+        left, top, right, bottom = window
+        if isinstance(raster, np.ndarray):
+            yield window, raster[top:bottom, left:right]
+        else:
+            yield window, raster.crop(window)
+
+
+def run_tiled(raster, predict_batch, tile_size=TILE_SIZE, overlap=TILE_OVERLAP, batch_size=TILE_BATCH_SIZE, workers=TILE_WORKERS):
+    """Runs predict_batch over the tiles of a raster and yields (window, prediction) per tile, in tile order.
+
+    Args:
+        raster: a raster from open_raster(), or anything open_raster() accepts.
+        predict_batch: called with a list of up to batch_size tiles; returns one
+            prediction per tile. It is called from up to workers threads at once, so
+            it must be thread-safe (TFDetector.detect_batch and PyTorch models in
+            eval mode are).
+
+    At most 2 * workers batches are cut or in flight at any time, so tiles are
+    read from the raster only as fast as the model consumes them.
+    """
+    raster = open_raster(raster)
+    tiles = iter_tiles(raster, tile_size, overlap)
+    max_pending = 2 * max(1, workers)
+
+    with ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix='tile') as pool:
+        pending = deque()
+        exhausted = False
+        while pending or not exhausted:
+            while not exhausted and len(pending) < max_pending:
+                windows, batch = _next_batch(tiles, batch_size)
+                if not batch:
+                    exhausted = True
+                    break
+                pending.append((windows, pool.submit(predict_batch, batch)))
+
+            if pending:
+                windows, future = pending.popleft()
+                predictions = future.result()
+                if len(predictions) != len(windows):
+                    raise ValueError('predict_batch returned {} predictions for {} tiles.'.format(len(predictions), len(windows)))
+                for window, prediction in zip(windows, predictions):
+                    yield window, prediction
+
+
+def _next_batch(tiles, batch_size):
+    windows = []
+    batch = []
+    for window, tile in tiles:
+        windows.append(window)
+        batch.append(tile)
+        if len(batch) == batch_size:
+            break
+    return windows, batch
+
+
+def non_max_suppression(boxes, scores, iou_threshold, classes=None):
+    """Greedy non-maximum suppression.
+
+    Args:
+        boxes: [N, 4] array of (ymin, xmin, ymax, xmax), normalized or in pixels.
+        scores: [N] array of confidences.
+        iou_threshold: boxes overlapping a higher-scoring box by more than this
+            intersection over union are removed.
+        classes: optional [N] array. If given, only boxes of the same class suppress each other.
+
+    Returns:
+        the indexes of the kept boxes, highest score first.
+    """
+    boxes = np.asarray(boxes, np.float32)
+    ymin, xmin, ymax, xmax = boxes.T
+    areas = np.maximum(ymax - ymin, 0) * np.maximum(xmax - xmin, 0)
+    order = np.argsort(-np.asarray(scores), kind='stable')
+
+    keep = []
+    while order.size:
+        i = order[0]
+        keep.append(i)
+        rest = order[1:]
+        # Overlap of the best remaining box with all the others at once.
+        heights = np.maximum(np.minimum(ymax[i], ymax[rest]) - np.maximum(ymin[i], ymin[rest]), 0)
+        widths = np.maximum(np.minimum(xmax[i], xmax[rest]) - np.maximum(xmin[i], xmin[rest]), 0)
+        intersections = heights * widths
+        ious = intersections / np.maximum(areas[i] + areas[rest] - intersections, 1e-12)
+        suppressed = ious > iou_threshold
+        if classes is not None:
+            suppressed &= classes[rest] == classes[i]
+        order = rest[~suppressed]
+    return np.array(keep, dtype=np.int64)
+
+
+class DetectionStitcher:
+    """Combines per-tile detections into detections for the whole raster.
+
+    Boxes are added in tile-normalized coordinates and converted to pixels of the
+    raster. result() removes the duplicates that overlapping tiles produce for the
+    same object with per-class non-maximum suppression. Only the boxes are kept,
+    so memory use does not depend on the size of the raster.
+    """
+    def __init__(self, width, height, iou_threshold=0.5):
+        self.width = width
+        self.height = height
+        self.iou_threshold = iou_threshold
+        self._boxes = []
+        self._scores = []
+        self._classes = []
+
+    def add(self, window, boxes, scores, classes):
+        """Adds the detections of the tile at window; boxes are (ymin, xmin, ymax, xmax) normalized to the tile."""
+        boxes = np.asarray(boxes, np.float32).reshape(-1, 4)
+        if not boxes.shape[0]:
+            return
+        left, top, right, bottom = window
+        scale = np.array([bottom - top, right - left, bottom - top, right - left], np.float32)
+        offset = np.array([top, left, top, left], np.float32)
+        self._boxes.append(boxes * scale + offset)
+        self._scores.append(np.asarray(scores, np.float32).reshape(-1))
+        self._classes.append(np.asarray(classes).reshape(-1).astype(np.int64))
+
+    def result(self, normalized=True):
+        """Returns boxes, scores and classes for the raster, highest score first.
+
+        Boxes are normalized to the raster if normalized is True, and in pixels otherwise.
+        """
+        if not self._boxes:
+            return np.zeros((0, 4), np.float32), np.zeros(0, np.float32), np.zeros(0, np.int64)
+        boxes = np.concatenate(self._boxes)
+        scores = np.concatenate(self._scores)
+        classes = np.concatenate(self._classes)
+        keep = non_max_suppression(boxes, scores, self.iou_threshold, classes)
+        boxes = boxes[keep]
+        if normalized:
+            boxes = boxes / np.array([self.height, self.width, self.height, self.width], np.float32)
+        return boxes, scores[keep], classes[keep]
+
+
+class SeamBlender:
+    """Combines dense per-tile outputs, such as land-cover class scores, into one raster.
+
+    Each tile is weighted by a window that ramps up linearly across the overlap, so
+    overlapping predictions are blended without visible seams. The output and the
+    weights are accumulated in float32 arrays of the raster size; pass out_path to
+    keep them in memory-mapped files instead of memory.
+    """
+    def __init__(self, width, height, channels=1, overlap=TILE_OVERLAP, out_path=None):
+        self.overlap = overlap
+        shape = (height, width, channels)
+        if out_path:
+            self._output = np.lib.format.open_memmap(out_path, mode='w+', dtype=np.float32, shape=shape)
+            self._weights = np.lib.format.open_memmap(out_path + '.weights.npy', mode='w+', dtype=np.float32, shape=(height, width, 1))
+        else:
+            self._output = np.zeros(shape, np.float32)
+            self._weights = np.zeros((height, width, 1), np.float32)
+        self._ramps = {}
+
+    def _get_ramp(self, length):
+        # 1 in the middle, falling linearly to near 0 over the overlap at each end.
+        ramp = self._ramps.get(length)
+        if ramp is None:
+            ramp = np.ones(length, np.float32)
+            fade = min(self.overlap, length // 2)
+            if fade > 0:
+                steps = (np.arange(fade, dtype=np.float32) + 1) / (fade + 1)
+                ramp[:fade] = steps
+                ramp[length - fade:] = steps[::-1]
+            self._ramps[length] = ramp
+        return ramp
+
+    def add(self, window, prediction):
+        """Adds the H x W (x C) prediction of the tile at window."""
+        left, top, right, bottom = window
+        prediction = np.asarray(prediction, np.float32)
+        if prediction.ndim == 2:
+            prediction = prediction[:, :, np.newaxis]
+        weight = np.outer(self._get_ramp(bottom - top), self._get_ramp(right - left))[:, :, np.newaxis]
+        self._output[top:bottom, left:right] += prediction * weight
+        self._weights[top:bottom, left:right] += weight
+
+    def result(self):
+        """Returns the blended H x W x C output, normalized in place."""
+        np.divide(self._output, np.maximum(self._weights, 1e-12), out=self._output)
+        return self._output
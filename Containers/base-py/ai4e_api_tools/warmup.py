@@ -0,0 +1,119 @@
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License.
+# Warm-up hooks that run synthetic inferences in each worker process before it
+# reports itself ready, so the first real requests do not pay for lazy
+# initialization such as session creation or kernel compilation.
+from os import getenv
+import os
+import threading
+import time
+import traceback
+
+# How long a request to an endpoint waits for the warm-up of its worker before it is rejected with a 503.
+WARMUP_REQUEST_WAIT_SECONDS = float(getenv('WARMUP_REQUEST_WAIT_SECONDS', '60'))
+# Times a failing warm-up hook is run before the process is reported as failed.
+WARMUP_MAX_ATTEMPTS = int(getenv('WARMUP_MAX_ATTEMPTS', '3'))
+# Wait before the first retry of a failed hook. The wait doubles after every further failure.
+WARMUP_RETRY_SECONDS = float(getenv('WARMUP_RETRY_SECONDS', '5'))
+
+
+class WarmupRunner:
+    """Runs the registered warm-up hooks once in each process, on a background thread.
+
+    Hooks run in registration order, the first time ensure_started() is called in
+    a process, so workers forked from a preloaded app each warm up their own
+    sessions and caches. The process is ready once every hook has returned.
+
+    A hook that raises is retried up to max_attempts times in all, waiting
+    retry_seconds before the first retry and twice as long before each next one,
+    since early failures are often transient (a model file still downloading, a
+    GPU still busy). If it still fails, the warm-up stops and has_failed() is True
+    for the life of the process: it will never become ready, so the service also
+    fails its liveness check and the orchestrator restarts it.
+
+    on_hook_done, if given, is called with the name of each hook and the seconds it took.
+    """
+    def __init__(self, on_hook_done=None, max_attempts=WARMUP_MAX_ATTEMPTS, retry_seconds=WARMUP_RETRY_SECONDS):
+        self.on_hook_done = on_hook_done
+        self.max_attempts = max(1, max_attempts)
+        self.retry_seconds = retry_seconds
+        self._hooks = []
+        self._lock = threading.Lock()
+        self._pid = None
+        self._done = threading.Event()
+        self._failed = False
+
+    def register(self, func, name=None):
+        """Adds a hook, called with no arguments. Returns func, so this can be used as a decorator."""
+        with self._lock:
+            if self._pid is not None:
+                print('Warm-up hook {} was registered after warm-up started; it will only run in new processes.'.format(name or func.__name__))
+            self._hooks.append((name or func.__name__, func))
+        return func
+
+    def ensure_started(self):
+        if self._pid == os.getpid():
+            return
+
+        with self._lock:
+            if self._pid != os.getpid():
+                # Events and threads copied by fork() belong to the parent's warm-up.
+                self._done = threading.Event()
+                self._failed = False
+                self._pid = os.getpid()
+                if self._hooks:
+                    threading.Thread(target=self._run, args=(list(self._hooks), self._done), name='warmup', daemon=True).start()
+                else:
+                    self._done.set()
+
+    def is_ready(self):
+        """True if the warm-up of this process has finished without errors. Starts it if needed."""
+        self.ensure_started()
+        return self._done.is_set() and not self._failed
+
+    def has_failed(self):
+        """True if a hook of this process failed on every attempt."""
+        return self._pid == os.getpid() and self._failed
+
+    def wait(self, timeout):
+        """Waits up to timeout seconds for the warm-up of this process. Returns is_ready()."""
+        self.ensure_started()
+        self._done.wait(timeout)
+        return self.is_ready()
+
+    def _run(self, hooks, done):
+        print('Warming up process {}...'.format(os.getpid()))
+        started_at = time.monotonic()
+        for name, func in hooks:
+            hook_started_at = self._run_hook(name, func)
+            if hook_started_at is None:
+                self._failed = True
+                break
+            seconds = time.monotonic() - hook_started_at
+            print('Warm-up hook {} finished in {:.2f} seconds.'.format(name, seconds))
+            if self.on_hook_done:
+                try:
+                    self.on_hook_done(name, seconds)
+                except Exception as e:
+                    print('Exception when recording warm-up time:')
+                    print(e)
+
+        if self._failed:
+            print('Warm-up of process {} failed.'.format(os.getpid()))
+        else:
+            print('Process {} warmed up in {:.2f} seconds.'.format(os.getpid(), time.monotonic() - started_at))
+        done.set()
+
+    def _run_hook(self, name, func):
+        # Returns when the successful attempt started, or None if every attempt failed.
+        for attempt in range(1, self.max_attempts + 1):
+            attempt_started_at = time.monotonic()
+            try:
+                func()
+                return attempt_started_at
+            except Exception:
+                print('Exception in warm-up hook {} (attempt {} of {}):'.format(name, attempt, self.max_attempts))
+                traceback.print_exc()
+            if attempt < self.max_attempts:
+                time.sleep(self.retry_seconds * 2 ** (attempt - 1))
+        return None
@@ -0,0 +1,76 @@
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License.
+# Shared setup for the ai4e_api_tools tests. Run them from the repository root with:
+#   python -m pytest Containers/base-py/tests
+import atexit
+import os
+import signal
+import sys
+import tempfile
+import time
+import uuid
+
+import pytest
+
+TEST_DIR = tempfile.mkdtemp(prefix='ai4e_tests_')
+
+# Module-level settings are read when the modules are imported, so they are set first.
+os.environ.setdefault('API_PREFIX', '/v1/test')
+os.environ['LOCAL_BLOB_TEST_DIRECTORY'] = TEST_DIR
+os.environ['CONCURRENCY_LIMITER_DIR'] = TEST_DIR
+os.environ['METRICS_DIR'] = TEST_DIR
+os.environ['TELEMETRY_SINK'] = 'none'
+os.environ['TASK_COMPACTION_INTERVAL_SECONDS'] = '0'
+os.environ['TASK_WAIT_POLL_SECONDS'] = '0.05'
+os.environ['WARMUP_REQUEST_WAIT_SECONDS'] = '2'
+
+_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..', '..'))
+# ai4e_api_tools is on the PYTHONPATH in the container, and common is copied next to it.
+sys.path.insert(0, os.path.join(_ROOT, 'Containers', 'common'))
+sys.path.insert(0, os.path.join(_ROOT, 'Containers', 'base-py', 'ai4e_api_tools'))
+
+
+def _wait_until(predicate, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+
+@pytest.fixture
+def wait_until():
+    """Returns a function that polls predicate() until it is true, and returns False after timeout seconds."""
+    return _wait_until
+
+
+@pytest.fixture
+def make_service(monkeypatch):
+    """Returns a function that creates an APIService on a new Flask app, with its own API_PREFIX.
+
+    The services are shut down and their signal handlers removed after the test.
+    """
+    from flask import Flask
+    from ai4e_app_insights_wrapper import AI4EAppInsights
+    from ai4e_service import APIService
+
+    services = []
+
+    def make():
+        monkeypatch.setenv('API_PREFIX', '/v1/' + uuid.uuid4().hex[:8])
+        app = Flask(__name__)
+        with app.app_context():
+            service = APIService(app, AI4EAppInsights())
+        services.append(service)
+        return service
+
+    yield make
+
+    for service in reversed(services):
+        atexit.unregister(service._drain_at_exit)
+        for signum, handler in service._previous_signal_handlers.items():
+            signal.signal(signum, handler)
+        for task_executor in service.func_executors.values():
+            task_executor.cancel_queued()
+            task_executor.shutdown(wait=False)
@@ -0,0 +1,42 @@
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License.
+from concurrent.futures import ThreadPoolExecutor
+import threading
+
+from ai4e_log_context import build_log_properties, get_log_context, log_context
+
+BASE = {'service_owner': 'owner', 'service_name': 'name'}
+
+
+def test_fields_are_bound_inside_the_block():
+    assert dict(get_log_context()) == {}
+    with log_context(task_id='1'):
+        with log_context(endpoint='/example'):
+            assert dict(get_log_context()) == {'task_id': '1', 'endpoint': '/example'}
+        assert dict(get_log_context()) == {'task_id': '1'}
+    assert dict(get_log_context()) == {}
+
+
+def test_build_log_properties():
+    with log_context(task_id='1'):
+        properties = build_log_properties(BASE)
+        assert properties == {**BASE, 'task_id': '1'}
+        # The merged dict is built once per context and logger.
+        assert build_log_properties(BASE) is properties
+
+        assert build_log_properties(BASE, task_id='2', additional_properties={'x': 1}) == {**BASE, 'task_id': '2', 'x': 1}
+    assert BASE == {'service_owner': 'owner', 'service_name': 'name'}
+    assert build_log_properties(BASE) == BASE
+
+
+def test_contexts_are_not_shared_between_threads():
+    barrier = threading.Barrier(4)
+
+    def log(task_id):
+        with log_context(task_id=task_id):
+            # Every thread has entered its context before any of them reads it.
+            barrier.wait(5)
+            return build_log_properties(BASE)['task_id']
+
+    with ThreadPoolExecutor(4) as pool:
+        assert list(pool.map(log, ['a', 'b', 'c', 'd'])) == ['a', 'b', 'c', 'd']
@@ -0,0 +1,434 @@
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License.
+import io
+import threading
+from types import SimpleNamespace
+
+import pytest
+
+import ai4e_service
+from task_management.task_store import TASK_STATE_COMPLETED, TASK_STATE_FAILED
+
+
+def task_id_of(response):
+    assert response.status_code == 200, response.data
+    return response.data.decode('utf-8').split(': ')[1]
+
+
+@pytest.fixture
+def release():
+    release = threading.Event()
+    yield release
+    release.set()
+
+
+def add_blocking_endpoint(service, release, api_path='/slow', **kwargs):
+    @service.api_async_func(api_path=api_path, methods=['POST'], **kwargs)
+    def slow(*args, **kwargs):
+        release.wait(5)
+        service.api_task_manager.CompleteTask(kwargs['taskId'], 'done')
+
+
+def test_sync_endpoint(make_service):
+    service = make_service()
+
+    @service.api_sync_func(api_path='/echo/<string:text>', methods=['GET'], maximum_concurrent_requests=2)
+    def echo(*args, **kwargs):
+        return 'Echo: ' + kwargs['text']
+
+    response = service.app.test_client().get(service.api_prefix + '/echo/hi')
+    assert response.status_code == 200
+    assert response.data == b'Echo: hi'
+
+
+def test_async_endpoint_runs_task(make_service, release, wait_until):
+    service = make_service()
+    add_blocking_endpoint(service, release, maximum_concurrent_requests=2)
+    release.set()
+
+    task_id = task_id_of(service.app.test_client().post(service.api_prefix + '/slow'))
+    assert wait_until(lambda: service.api_task_manager.GetTaskStatus(task_id)['State'] == TASK_STATE_COMPLETED)
+
+
+def test_async_endpoint_queue_limit(make_service, release, wait_until):
+    service = make_service()
+    add_blocking_endpoint(service, release, maximum_concurrent_requests=1, max_queue_size=1)
+    client = service.app.test_client()
+
+    task_ids = [task_id_of(client.post(service.api_prefix + '/slow')) for _ in range(2)]
+    # One task runs and one waits in the queue; the next request is rejected.
+    assert client.post(service.api_prefix + '/slow').status_code == 503
+    assert service.api_task_manager.GetTaskStatus(task_ids[1])['Status'] == 'queued'
+
+    release.set()
+    assert wait_until(lambda: all(service.api_task_manager.GetTaskStatus(task_id)['State'] == TASK_STATE_COMPLETED for task_id in task_ids))
+
+
+def test_async_endpoint_without_limit_is_not_capped(make_service, release, wait_until):
+    service = make_service()
+    add_blocking_endpoint(service, release)
+    client = service.app.test_client()
+
+    request_count = ai4e_service.ASYNC_DEFAULT_MAX_WORKERS + 4
+    task_ids = [task_id_of(client.post(service.api_prefix + '/slow')) for _ in range(request_count)]
+    executor = service.func_executors[service.api_prefix + '/slow']
+    assert wait_until(lambda: executor.running_count == ai4e_service.ASYNC_DEFAULT_MAX_WORKERS)
+    assert executor.queued_count == 4
+
+    release.set()
+    assert wait_until(lambda: all(service.api_task_manager.GetTaskStatus(task_id)['State'] == TASK_STATE_COMPLETED for task_id in task_ids))
+
+
+def test_async_endpoint_in_process_executor(make_service, wait_until):
+    service = make_service()
+
+    @service.api_async_func(api_path='/cpu', methods=['POST'], maximum_concurrent_requests=1, executor='process')
+    def cpu(*args, **kwargs):
+        # Runs in a forked child; the status goes straight to the shared task store.
+        service.api_task_manager.CompleteTask(kwargs['taskId'], 'done in child')
+
+    # The child is forked before the first task, as from gunicorn's post_worker_init hook.
+    service.start_executors()
+    assert list(service.func_executors[service.api_prefix + '/cpu']._children) == [0]
+
+    task_id = task_id_of(service.app.test_client().post(service.api_prefix + '/cpu'))
+    assert wait_until(lambda: service.api_task_manager.GetTaskStatus(task_id)['Status'] == 'done in child', timeout=10)
+    assert wait_until(lambda: service.func_executors[service.api_prefix + '/cpu'].running_count == 0)
+
+
+def test_admission_is_released_when_request_metric_fails(make_service, monkeypatch):
+    service = make_service()
+
+    @service.api_sync_func(api_path='/echo', methods=['GET'], maximum_concurrent_requests=1)
+    def echo(*args, **kwargs):
+        return 'ok'
+
+    def fail(*args, **kwargs):
+        raise RuntimeError('telemetry is down')
+
+    monkeypatch.setattr(service.log, 'track_metric', fail)
+    assert service.app.test_client().get(service.api_prefix + '/echo').status_code == 500
+    assert service.concurrency_limiter.get_in_flight(service.api_prefix + '/echo') == 0
+
+
+def test_metric_failures_do_not_fail_requests(make_service, monkeypatch):
+    service = make_service()
+
+    @service.api_sync_func(api_path='/echo', methods=['GET'])
+    def echo(*args, **kwargs):
+        return 'ok'
+
+    @service.api_sync_func(api_path='/full', methods=['GET'], maximum_concurrent_requests=0)
+    def full(*args, **kwargs):
+        return 'ok'
+
+    def fail(*args, **kwargs):
+        raise OSError('metrics file is gone')
+
+    monkeypatch.setattr(service.metrics, 'record_request', fail)
+    monkeypatch.setattr(service.metrics, 'record_rejection', fail)
+    client = service.app.test_client()
+    assert client.get(service.api_prefix + '/echo').data == b'ok'
+    # The rejection is still a 503 rather than a 500.
+    assert client.get(service.api_prefix + '/full').status_code == 503
+
+
+def test_sync_limit_applies_to_paths_with_parameters(make_service, release, wait_until):
+    service = make_service()
+
+    @service.api_sync_func(api_path='/classify/<string:name>', methods=['GET'], maximum_concurrent_requests=1)
+    def classify(*args, **kwargs):
+        release.wait(5)
+        return kwargs['name']
+
+    client = service.app.test_client()
+    first = threading.Thread(target=client.get, args=(service.api_prefix + '/classify/a',))
+    first.start()
+    assert wait_until(lambda: service.concurrency_limiter.get_in_flight(service.api_prefix + '/classify/<string:name>') == 1)
+
+    # Another value of the parameter counts against the same limit.
+    assert client.get(service.api_prefix + '/classify/b').status_code == 503
+    release.set()
+    first.join()
+    assert client.get(service.api_prefix + '/classify/b').data == b'b'
+
+
+def test_sync_endpoint_with_batch_function(make_service):
+    service = make_service()
+    batch_sizes = []
+
+    def classify_batch(items):
+        batch_sizes.append(len(items))
+        return [item.upper() for item in items]
+
+    @service.api_sync_func(api_path='/upper/<string:text>', methods=['GET'], maximum_concurrent_requests=4, batch_function=classify_batch, max_batch_size=4, max_batch_wait_ms=200)
+    def upper(*args, **kwargs):
+        return kwargs['batcher'].submit(kwargs['text'])
+
+    client = service.app.test_client()
+    responses = {}
+    threads = [threading.Thread(target=lambda text=text: responses.update({text: client.get(service.api_prefix + '/upper/' + text).data})) for text in 'abcd']
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert responses == {'a': b'A', 'b': b'B', 'c': b'C', 'd': b'D'}
+    assert sum(batch_sizes) == 4 and len(batch_sizes) < 4
+
+
+def chunked(data):
+    """Test client arguments for a chunked request body, which has no Content-Length."""
+    return {'input_stream': io.BytesIO(data), 'headers': {'Transfer-Encoding': 'chunked'}, 'environ_overrides': {'wsgi.input_terminated': True}}
+
+
+def test_sync_endpoint_with_streamed_body(make_service):
+    service = make_service()
+
+    @service.api_sync_func(api_path='/size', methods=['POST'], stream_request_body=True, content_max_length=100)
+    def size(*args, **kwargs):
+        return str(len(kwargs['request_body'].getbuffer()))
+
+    client = service.app.test_client()
+    assert client.post(service.api_prefix + '/size', data=b'x' * 100).data == b'100'
+    assert client.post(service.api_prefix + '/size', **chunked(b'x' * 100)).data == b'100'
+    assert client.post(service.api_prefix + '/size', data=b'x' * 101).status_code == 413
+    assert client.post(service.api_prefix + '/size', **chunked(b'x' * 101)).status_code == 413
+
+
+def test_async_task_runs_in_log_context(make_service, wait_until):
+    from ai4e_log_context import get_log_context
+    service = make_service()
+    seen = {}
+
+    @service.api_async_func(api_path='/logged', methods=['POST'], maximum_concurrent_requests=1)
+    def logged(*args, **kwargs):
+        seen.update(get_log_context())
+        service.api_task_manager.CompleteTask(kwargs['taskId'], 'done')
+
+    task_id = task_id_of(service.app.test_client().post(service.api_prefix + '/logged'))
+    assert wait_until(lambda: service.api_task_manager.GetTaskStatus(task_id)['State'] == TASK_STATE_COMPLETED)
+    assert seen == {'task_id': task_id}
+
+
+def test_metrics_endpoint(make_service):
+    service = make_service()
+
+    @service.api_sync_func(api_path='/echo/<string:text>', methods=['GET'], maximum_concurrent_requests=2)
+    def echo(*args, **kwargs):
+        return kwargs['text']
+
+    client = service.app.test_client()
+    client.get(service.api_prefix + '/echo/hi')
+    text = client.get(service.api_prefix + '/metrics').data.decode('utf-8')
+    assert 'ai4e_requests_total{{endpoint="{}/echo/<string:text>"}} 1'.format(service.api_prefix) in text
+
+
+def test_task_status_long_poll(make_service):
+    service = make_service()
+    task_id = service.api_task_manager.AddTask(SimpleNamespace(path=service.api_prefix + '/slow'))['TaskId']
+    threading.Timer(0.1, service.api_task_manager.UpdateTaskStatus, args=(task_id, 'running')).start()
+
+    client = service.app.test_client()
+    status = client.get(service.api_prefix + '/task/{}?wait=5&version=0'.format(task_id)).get_json()
+    assert (status['Status'], status['Version']) == ('running', 1)
+    assert client.get(service.api_prefix + '/task/{}?wait=soon'.format(task_id)).status_code == 400
+
+
+def test_task_events(make_service):
+    service = make_service()
+    task_manager = service.api_task_manager
+    task_id = task_manager.AddTask(SimpleNamespace(path=service.api_prefix + '/slow'))['TaskId']
+
+    def update():
+        task_manager.UpdateTaskStatus(task_id, 'running')
+        task_manager.CompleteTask(task_id, 'completed')
+
+    threading.Timer(0.1, update).start()
+    response = service.app.test_client().get(service.api_prefix + '/task/{}/events'.format(task_id))
+    assert response.mimetype == 'text/event-stream'
+
+    events = [event for event in response.get_data(as_text=True).split('\n\n') if event.startswith('id:')]
+    versions = [int(event.split('\n')[0][len('id:'):]) for event in events]
+    # The stream starts with the current status and ends once the task has completed.
+    assert versions[0] == 0 and versions[-1] == 2
+    assert versions == sorted(set(versions))
+    assert '"completed"' in events[-1]
+
+    # A client that reconnects with Last-Event-ID only gets newer events.
+    response = service.app.test_client().get(service.api_prefix + '/task/{}/events'.format(task_id), headers={'Last-Event-ID': '2'})
+    assert 'id:' not in response.get_data(as_text=True)
+
+
+def test_task_result(make_service):
+    service = make_service()
+    task_manager = service.api_task_manager
+    task_id = task_manager.AddTask(SimpleNamespace(path=service.api_prefix + '/slow'))['TaskId']
+    client = service.app.test_client()
+    assert client.get(service.api_prefix + '/task/{}/result'.format(task_id)).status_code == 404
+
+    task_manager.CompleteTask(task_id, 'completed', b'0123456789', 'image/png')
+    response = client.get(service.api_prefix + '/task/{}/result'.format(task_id))
+    assert (response.status_code, response.mimetype, response.data) == (200, 'image/png', b'0123456789')
+
+    response = client.get(service.api_prefix + '/task/{}/result'.format(task_id), headers={'Range': 'bytes=2-5'})
+    assert (response.status_code, response.data, response.headers['Content-Range']) == (206, b'2345', 'bytes 2-5/10')
+    assert client.get(service.api_prefix + '/task/{}/result'.format(task_id), headers={'Range': 'bytes=20-30'}).status_code == 416
+
+
+def test_sync_response_cache(make_service):
+    from response_cache import ResponseCache
+    service = make_service()
+    calls = []
+
+    @service.api_sync_func(api_path='/upper', methods=['POST'], maximum_concurrent_requests=1, response_cache=ResponseCache(disk_dir=''), cache_key_params=['lang'])
+    def upper(*args, **kwargs):
+        from flask import request
+        calls.append(1)
+        return request.get_data(as_text=True).upper()
+
+    client = service.app.test_client()
+    responses = [client.post(service.api_prefix + '/upper?lang=' + lang, data=b'x').data for lang in ('en', 'en', 'fr')]
+    assert responses == [b'X', b'X', b'X']
+    # The second request is answered from the cache; another cache_key_params value is not.
+    assert len(calls) == 2
+
+
+def test_async_response_cache(make_service, release, wait_until):
+    from response_cache import ResponseCache
+    service = make_service()
+    add_blocking_endpoint(service, release, maximum_concurrent_requests=1, response_cache=ResponseCache(disk_dir=''))
+    release.set()
+
+    client = service.app.test_client()
+    task_id = task_id_of(client.post(service.api_prefix + '/slow', data=b'image'))
+    assert task_id_of(client.post(service.api_prefix + '/slow', data=b'image')) == task_id
+    assert task_id_of(client.post(service.api_prefix + '/slow', data=b'other')) != task_id
+
+    # A failed task is run again.
+    assert wait_until(lambda: service.api_task_manager.GetTaskStatus(task_id)['State'] == TASK_STATE_COMPLETED)
+    service.api_task_manager.FailTask(task_id, 'failed')
+    assert task_id_of(client.post(service.api_prefix + '/slow', data=b'image')) != task_id
+
+
+def test_cache_errors_do_not_fail_requests(make_service, release, wait_until):
+    from response_cache import ResponseCache
+
+    class BrokenCache(ResponseCache):
+        def put(self, key, value):
+            raise OSError('disk full')
+
+    service = make_service()
+    add_blocking_endpoint(service, release, maximum_concurrent_requests=1, max_queue_size=0, response_cache=BrokenCache(disk_dir=''))
+    release.set()
+
+    client = service.app.test_client()
+    task_id = task_id_of(client.post(service.api_prefix + '/slow'))
+    assert wait_until(lambda: service.api_task_manager.GetTaskStatus(task_id)['State'] == TASK_STATE_COMPLETED)
+    # The task's slot was given back once, when it finished.
+    executor = service.func_executors[service.api_prefix + '/slow']
+    assert wait_until(lambda: executor.running_count == 0)
+    assert executor.reserve() and not executor.reserve()
+    executor.cancel_reservation()
+
+
+def test_health_after_failed_warmup(make_service):
+    service = make_service()
+    service.warmup.max_attempts = 1
+
+    @service.register_warmup
+    def broken():
+        raise RuntimeError('model not found')
+
+    client = service.app.test_client()
+    assert client.get(service.api_prefix + '/health/live').status_code == 200
+    assert not service.warmup.wait(5)
+    assert client.get(service.api_prefix + '/health/ready').status_code == 503
+    assert client.get(service.api_prefix + '/health/live').status_code == 503
+
+
+def assert_slot_is_free(executor):
+    assert executor.reserve()
+    executor.cancel_reservation()
+
+
+def test_async_oversized_chunked_body_does_not_leak_slot(make_service, release):
+    service = make_service()
+    add_blocking_endpoint(service, release, maximum_concurrent_requests=1, max_queue_size=0, stream_request_body=True, content_max_length=10)
+    release.set()
+    client = service.app.test_client()
+    executor = service.func_executors[service.api_prefix + '/slow']
+
+    for _ in range(3):
+        assert client.post(service.api_prefix + '/slow', **chunked(b'x' * 100)).status_code == 413
+    assert_slot_is_free(executor)
+    assert task_id_of(client.post(service.api_prefix + '/slow', **chunked(b'x' * 10)))
+
+
+def test_async_preprocessing_errors_do_not_leak_slot(make_service, release):
+    service = make_service()
+
+    def preprocess(request):
+        raise ValueError('bad request')
+
+    add_blocking_endpoint(service, release, maximum_concurrent_requests=1, max_queue_size=0, request_processing_function=preprocess)
+    client = service.app.test_client()
+    for _ in range(3):
+        assert client.post(service.api_prefix + '/slow').status_code == 500
+    assert_slot_is_free(service.func_executors[service.api_prefix + '/slow'])
+
+
+def test_async_submit_errors_fail_the_task(make_service, release, monkeypatch):
+    service = make_service()
+    add_blocking_endpoint(service, release, maximum_concurrent_requests=1, max_queue_size=0)
+    executor = service.func_executors[service.api_prefix + '/slow']
+    failed = []
+    monkeypatch.setattr(service.api_task_manager, 'FailTask', lambda task_id, status: failed.append(task_id))
+
+    def submit(args, kwargs, priority):
+        raise RuntimeError('queue closed')
+    monkeypatch.setattr(executor, 'submit', submit)
+
+    assert service.app.test_client().post(service.api_prefix + '/slow').status_code == 500
+    assert len(failed) == 1 and not service._in_flight_tasks
+    assert_slot_is_free(executor)
+
+
+def test_drain_waits_for_tasks(make_service, release, wait_until):
+    service = make_service()
+    add_blocking_endpoint(service, release, maximum_concurrent_requests=1)
+    client = service.app.test_client()
+    task_id = task_id_of(client.post(service.api_prefix + '/slow'))
+
+    threading.Timer(0.2, release.set).start()
+    assert service.drain(timeout=5)
+    assert service.api_task_manager.GetTaskStatus(task_id)['State'] == TASK_STATE_COMPLETED
+    # New requests are refused and readiness fails, while liveness still succeeds.
+    assert client.post(service.api_prefix + '/slow').status_code == 503
+    assert client.get(service.api_prefix + '/health/ready').status_code == 503
+    assert client.get(service.api_prefix + '/health/live').status_code == 200
+
+
+def test_drain_interrupts_unfinished_tasks(make_service, release):
+    service = make_service()
+    add_blocking_endpoint(service, release, maximum_concurrent_requests=1)
+    client = service.app.test_client()
+    task_ids = [task_id_of(client.post(service.api_prefix + '/slow')) for _ in range(2)]
+
+    assert not service.drain(timeout=0.2)
+    for task_id in task_ids:
+        status = service.api_task_manager.GetTaskStatus(task_id)
+        assert (status['State'], status['Status']) == (TASK_STATE_FAILED, ai4e_service.TASK_INTERRUPTED_STATUS)
+
+
+def test_telemetry_is_flushed_at_exit_without_work(make_service, monkeypatch):
+    service = make_service()
+    flushes = []
+    monkeypatch.setattr(service.log, 'flush', lambda: flushes.append(1))
+
+    service._drain_at_exit()
+    assert flushes == [1]
+    # Once drained, exiting does not flush again.
+    service.drain(timeout=0)
+    service._drain_at_exit()
+    assert flushes == [1, 1]
@@ -0,0 +1,84 @@
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License.
+import threading
+import time
+from types import SimpleNamespace
+
+import pytest
+
+from task_management.api_task import TaskManager
+from task_management.task_results import LocalResultStore
+from task_management.task_store import SqliteTaskStore, TASK_STATE_ACTIVE, TASK_STATE_COMPLETED, TASK_STATE_FAILED
+
+REQUEST = SimpleNamespace(path='/v1/test/example')
+
+
+@pytest.fixture
+def task_manager(tmp_path):
+    return TaskManager(SqliteTaskStore(str(tmp_path / 'task_status.db')), LocalResultStore(str(tmp_path / 'results')))
+
+
+def test_add_task(task_manager):
+    task = task_manager.AddTask(REQUEST)
+    assert task['Status'] == 'created'
+    assert task['Endpoint'] == '/v1/test/example'
+    assert task_manager.GetTaskStatus(task['TaskId']) == task
+
+
+def test_task_lifecycle(task_manager):
+    task_id = task_manager.AddTask(REQUEST, 'queued')['TaskId']
+
+    task_manager.UpdateTaskStatus(task_id, 'running')
+    status = task_manager.GetTaskStatus(task_id)
+    assert (status['Status'], status['State'], status['Version']) == ('running', TASK_STATE_ACTIVE, 1)
+
+    task_manager.CompleteTask(task_id, 'completed')
+    status = task_manager.GetTaskStatus(task_id)
+    assert (status['Status'], status['State'], status['Version']) == ('completed', TASK_STATE_COMPLETED, 2)
+
+
+def test_fail_task(task_manager):
+    task_id = task_manager.AddTask(REQUEST)['TaskId']
+    task_manager.FailTask(task_id, 'failed')
+    assert task_manager.GetTaskStatus(task_id)['State'] == TASK_STATE_FAILED
+
+
+def test_unknown_task(task_manager):
+    assert task_manager.GetTaskStatus('missing')['Status'] == 'Not found.'
+    with pytest.raises(ValueError):
+        task_manager.UpdateTaskStatus('missing', 'running')
+
+
+def test_wait_for_task_status(task_manager):
+    task_id = task_manager.AddTask(REQUEST)['TaskId']
+    threading.Timer(0.05, task_manager.UpdateTaskStatus, args=(task_id, 'running')).start()
+
+    started = time.monotonic()
+    status = task_manager.WaitForTaskStatus(task_id, timeout=5)
+    # Updates made in this process wake the waiter right away.
+    assert time.monotonic() - started < 1
+    assert (status['Status'], status['Version']) == ('running', 1)
+
+
+def test_wait_for_task_status_since_version(task_manager):
+    task_id = task_manager.AddTask(REQUEST)['TaskId']
+    task_manager.UpdateTaskStatus(task_id, 'running')
+    # The status is newer than the version the caller has seen, so it is returned right away.
+    assert task_manager.WaitForTaskStatus(task_id, since_version=0, timeout=5)['Version'] == 1
+    # Nothing changes, so the current status is returned after the timeout.
+    assert task_manager.WaitForTaskStatus(task_id, since_version=1, timeout=0.1)['Version'] == 1
+
+
+def test_wait_for_finished_or_missing_task(task_manager):
+    task_id = task_manager.AddTask(REQUEST)['TaskId']
+    task_manager.CompleteTask(task_id, 'completed')
+    started = time.monotonic()
+    assert task_manager.WaitForTaskStatus(task_id, since_version=5, timeout=5)['State'] == TASK_STATE_COMPLETED
+    assert task_manager.WaitForTaskStatus('missing', timeout=5)['Status'] == 'Not found.'
+    assert time.monotonic() - started < 1
+
+
+def test_complete_task_with_result(task_manager):
+    task_id = task_manager.AddTask(REQUEST)['TaskId']
+    task_manager.CompleteTask(task_id, 'completed', b'image bytes', 'image/png')
+    assert task_manager.GetTaskStatus(task_id)['Result'] == {'ContentType': 'image/png', 'Size': 11}
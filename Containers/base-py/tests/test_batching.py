@@ -0,0 +1,102 @@
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License.
+from concurrent.futures import ThreadPoolExecutor
+import threading
+
+import pytest
+
+from batching import MicroBatcher
+
+
+class Model:
+    """A batch function that records the size of every batch it was called with."""
+    def __init__(self, fail=False):
+        self.batch_sizes = []
+        self.fail = fail
+
+    def __call__(self, items):
+        self.batch_sizes.append(len(items))
+        if self.fail:
+            raise RuntimeError('model failed')
+        return [item * 2 for item in items]
+
+
+def test_single_item():
+    model = Model()
+    assert MicroBatcher(model, max_batch_size=4, max_wait_ms=1).submit(3, timeout=5) == 6
+    assert model.batch_sizes == [1]
+
+
+def test_concurrent_items_share_a_batch():
+    model = Model()
+    batcher = MicroBatcher(model, max_batch_size=4, max_wait_ms=1000)
+    # The batch is run as soon as it is full, well before max_wait_ms.
+    futures = [batcher.submit_async(i) for i in range(4)]
+    assert [future.result(timeout=0.5) for future in futures] == [0, 2, 4, 6]
+    assert model.batch_sizes == [4]
+
+
+def test_batches_are_limited_to_max_batch_size():
+    model = Model()
+    batcher = MicroBatcher(model, max_batch_size=3, max_wait_ms=50)
+    with ThreadPoolExecutor(7) as pool:
+        results = list(pool.map(lambda i: batcher.submit(i, timeout=5), range(7)))
+    assert results == [i * 2 for i in range(7)]
+    assert sum(model.batch_sizes) == 7
+    assert max(model.batch_sizes) <= 3
+
+
+def test_exceptions_are_raised_in_every_caller():
+    batcher = MicroBatcher(Model(fail=True), max_batch_size=2, max_wait_ms=1000)
+    futures = [batcher.submit_async(i) for i in range(2)]
+    for future in futures:
+        with pytest.raises(RuntimeError):
+            future.result(timeout=5)
+
+
+def test_base_exceptions_do_not_stop_the_batcher():
+    def exit_once(items):
+        if items == [1]:
+            raise SystemExit(1)
+        return items
+
+    batcher = MicroBatcher(exit_once, max_batch_size=1)
+    with pytest.raises(SystemExit):
+        batcher.submit(1, timeout=5)
+    # The batching thread is still running.
+    assert batcher.submit(2, timeout=5) == 2
+
+
+def test_wrong_number_of_results():
+    batcher = MicroBatcher(lambda items: [], max_batch_size=1)
+    with pytest.raises(ValueError):
+        batcher.submit(1, timeout=5)
+
+
+def test_cancelled_items_are_skipped():
+    started = threading.Event()
+    release = threading.Event()
+    received = []
+
+    def model(items):
+        received.extend(items)
+        started.set()
+        release.wait(5)
+        return items
+
+    batcher = MicroBatcher(model, max_batch_size=1)
+    first = batcher.submit_async('first')
+    assert started.wait(5)
+    # Queued behind the running batch, so it can still be cancelled.
+    cancelled = batcher.submit_async('cancelled')
+    assert cancelled.cancel()
+    last = batcher.submit_async('last')
+    release.set()
+
+    assert (first.result(timeout=5), last.result(timeout=5)) == ('first', 'last')
+    assert received == ['first', 'last']
+
+
+def test_max_batch_size_must_be_positive():
+    with pytest.raises(ValueError):
+        MicroBatcher(Model(), max_batch_size=0)
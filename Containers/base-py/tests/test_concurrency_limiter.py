@@ -0,0 +1,93 @@
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License.
+import os
+import uuid
+
+import pytest
+
+from concurrency_limiter import SharedConcurrencyLimiter, get_process_start_time
+
+
+@pytest.fixture
+def name():
+    name = 'test-' + uuid.uuid4().hex
+    yield name
+    os.remove(SharedConcurrencyLimiter(name).path)
+
+
+@pytest.fixture
+def limiter(name):
+    return SharedConcurrencyLimiter(name, max_processes=4, max_endpoints=2)
+
+
+def run_in_child(function):
+    """Runs function in a forked child and returns its exit status."""
+    pid = os.fork()
+    if pid == 0:
+        try:
+            os._exit(function())
+        except BaseException:
+            os._exit(100)
+    _, exit_status = os.waitpid(pid, 0)
+    return os.WEXITSTATUS(exit_status)
+
+
+def test_acquire_and_release(limiter):
+    assert limiter.try_acquire('/a', 2)
+    assert limiter.try_acquire('/a', 2)
+    assert not limiter.try_acquire('/a', 2)
+    # Endpoints are counted separately, and None never rejects.
+    assert limiter.try_acquire('/b', 1)
+    assert limiter.try_acquire('/b', None)
+
+    limiter.release('/a')
+    assert limiter.get_in_flight('/a') == 1
+    assert limiter.try_acquire('/a', 2)
+
+
+def test_release_without_acquire_is_ignored(limiter):
+    limiter.release('/a')
+    assert limiter.get_in_flight('/a') == 0
+
+
+def test_limit_is_shared_between_processes(limiter, name):
+    assert limiter.try_acquire('/a', 2)
+    # A second instance on the same name stands in for another worker process.
+    other = SharedConcurrencyLimiter(name, max_processes=4, max_endpoints=2)
+    assert run_in_child(lambda: 0 if other.try_acquire('/a', 2) and not other.try_acquire('/a', 2) else 1) == 0
+
+
+def test_slots_of_exited_process_are_reclaimed(limiter):
+    assert limiter.try_acquire('/a', 2)
+    # The child exits while holding a slot.
+    assert run_in_child(lambda: 0 if limiter.try_acquire('/a', 2) else 1) == 0
+    assert limiter.get_in_flight('/a') == 2
+
+    # The next process to open the limiter gives the dead process's slot back.
+    assert run_in_child(lambda: limiter.get_in_flight('/a')) == 1
+
+
+def test_slots_of_reused_pid_are_reclaimed(limiter):
+    assert limiter.try_acquire('/a', 2)
+    assert get_process_start_time(os.getpid()) > 0
+    # Hand this process's row to a live process that started at another time, as when a pid is reused.
+    pid_offset = limiter._row_offset - 2
+    limiter._counters[pid_offset] = os.getppid()
+    limiter._counters[pid_offset + 1] = get_process_start_time(os.getppid()) + 1
+    assert run_in_child(lambda: limiter.get_in_flight('/a')) == 0
+
+
+def test_slots_of_live_process_are_kept(limiter):
+    assert limiter.try_acquire('/a', 2)
+    pid_offset = limiter._row_offset - 2
+    limiter._counters[pid_offset] = os.getppid()
+    limiter._counters[pid_offset + 1] = get_process_start_time(os.getppid())
+    assert run_in_child(lambda: limiter.get_in_flight('/a')) == 1
+
+
+def test_too_many_endpoints(limiter):
+    limiter.try_acquire('/a', None)
+    limiter.try_acquire('/b', None)
+    with pytest.raises(RuntimeError):
+        limiter.try_acquire('/c', None)
+
@@ -0,0 +1,76 @@
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License.
+import io
+
+import pytest
+
+np = pytest.importorskip('numpy')
+Image = pytest.importorskip('PIL.Image')
+
+from image_preprocessing import decode_image, decode_images, fit_size, to_batch, IMAGENET_MEAN, IMAGENET_STD
+
+
+def encode(size, color=(200, 100, 50), format='JPEG', mode='RGB'):
+    data = io.BytesIO()
+    Image.new(mode, size, color).save(data, format)
+    data.seek(0)
+    return data
+
+
+def test_fit_size():
+    assert fit_size((4000, 3000), 400) == (400, 300)
+    assert fit_size((3000, 4000), 400) == (300, 400)
+    assert fit_size((200, 100), 400) == (200, 100)
+    assert fit_size((10000, 1), 100) == (100, 1)
+
+
+def test_decode_image():
+    image = decode_image(encode((800, 600)), max_size=200)
+    assert (image.size, image.mode) == ((200, 150), 'RGB')
+
+    image = decode_image(encode((800, 600)), size=(64, 64))
+    assert image.size == (64, 64)
+    # The pixels survive the reduced-size decode.
+    assert np.abs(np.asarray(image, np.int32) - (200, 100, 50)).max() < 8
+
+
+def test_decode_image_modes():
+    image = decode_image(encode((30, 20), color=128, format='PNG', mode='L'))
+    assert (image.size, image.mode) == ((30, 20), 'RGB')
+    assert decode_image(encode((30, 20), color=128, format='PNG', mode='L'), mode=None).mode == 'L'
+
+
+def test_decode_images_keeps_order():
+    images = decode_images([encode((10 + i, 10)) for i in range(6)])
+    assert [image.size for image in images] == [(10 + i, 10) for i in range(6)]
+
+    with pytest.raises(OSError):
+        decode_images([encode((10, 10)), io.BytesIO(b'not an image')])
+
+
+def test_to_batch_layouts():
+    images = [np.full((2, 3, 3), i, np.uint8) for i in range(4)]
+    assert to_batch(images).shape == (4, 3, 2, 3)
+    batch = to_batch(images, dtype=np.uint8, channels_first=False)
+    assert batch.dtype == np.uint8
+    np.testing.assert_array_equal(batch, np.stack(images))
+
+
+def test_to_batch_normalizes():
+    image = np.random.RandomState(0).randint(0, 256, (4, 5, 3)).astype(np.uint8)
+    batch = to_batch([image], scale=1 / 255, mean=IMAGENET_MEAN, std=IMAGENET_STD)
+    expected = ((image / 255 - IMAGENET_MEAN) / IMAGENET_STD).transpose((2, 0, 1))
+    np.testing.assert_allclose(batch[0], expected, rtol=1e-5, atol=1e-5)
+
+
+def test_to_batch_into_preallocated_array():
+    out = np.zeros((2, 3, 4, 4), np.float32)
+    assert to_batch([np.ones((4, 4, 3), np.uint8)] * 2, out=out) is out
+    assert out.min() == 1
+
+    with pytest.raises(ValueError):
+        to_batch([np.ones((4, 4, 3), np.uint8)], out=out)
+    with pytest.raises(ValueError):
+        to_batch([np.ones((4, 4, 3), np.uint8), np.ones((5, 4, 3), np.uint8)])
+    with pytest.raises(ValueError):
+        to_batch([])
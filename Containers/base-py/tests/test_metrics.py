@@ -0,0 +1,107 @@
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License.
+import os
+import uuid
+
+import pytest
+
+from concurrency_limiter import is_process_alive
+from metrics import BUCKET_COUNT, HISTOGRAM_BUCKETS, EndpointMetrics, MetricsRegistry, bucket_index
+
+
+def test_bucket_index():
+    # A value equal to a bound is counted in that bound's bucket.
+    assert bucket_index(0) == 0
+    assert bucket_index(int(HISTOGRAM_BUCKETS[0] * 1000000)) == 0
+    assert bucket_index(int(HISTOGRAM_BUCKETS[0] * 1000000) + 1) == 1
+    # Values above the last bound go to the +Inf bucket.
+    assert bucket_index(10 ** 12) == BUCKET_COUNT - 1
+
+
+@pytest.fixture
+def registry():
+    return MetricsRegistry('test-' + uuid.uuid4().hex, max_series=4)
+
+
+def test_registry_collects_counters_and_histograms(registry):
+    registry.increment('requests', '/a')
+    registry.increment('requests', '/a', 2)
+    registry.observe('duration', '/a', 0.5)
+
+    totals = registry.collect()
+    assert totals[('requests', '/a')][0] == 3
+    duration = totals[('duration', '/a')]
+    assert (duration[-2], duration[-1]) == (500000, 1)
+
+
+def test_registry_sums_processes_and_removes_exited_ones(registry):
+    registry.increment('requests', '/a')
+
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read_fd)
+        registry.increment('requests', '/a', 2)
+        in_child = registry.collect()[('requests', '/a')][0]
+        os.write(write_fd, str(in_child).encode('utf-8'))
+        os._exit(0)
+    os.close(write_fd)
+    # While the child is alive, its counts are added to the parent's.
+    assert os.read(read_fd, 16) == b'3'
+    os.close(read_fd)
+    os.waitpid(pid, 0)
+
+    assert not is_process_alive(pid)
+    assert registry.collect()[('requests', '/a')][0] == 1
+    assert registry.get_process_ids() == [os.getpid()]
+
+
+def test_too_many_series_are_dropped(registry):
+    for i in range(4):
+        registry.increment('requests', str(i))
+    registry.increment('requests', 'one too many')
+    registry.observe('duration', 'one too many', 0.5)
+
+    totals = registry.collect()
+    assert sorted(totals) == [('requests', str(i)) for i in range(4)]
+
+
+def test_render_prometheus():
+    metrics = EndpointMetrics('test-' + uuid.uuid4().hex)
+    metrics.record_request('/a', 0.25, failed=True, queue_seconds=0.1)
+    metrics.record_rejection('/a')
+    text = metrics.render_prometheus(in_flight={'/a': 2})
+
+    assert '# TYPE ai4e_requests_total counter' in text
+    assert 'ai4e_requests_total{endpoint="/a"} 1' in text
+    assert 'ai4e_request_errors_total{endpoint="/a"} 1' in text
+    assert 'ai4e_requests_rejected_total{endpoint="/a"} 1' in text
+    assert '# TYPE ai4e_request_duration_seconds histogram' in text
+    assert 'ai4e_request_duration_seconds_bucket{endpoint="/a",le="0.1"} 0' in text
+    assert 'ai4e_request_duration_seconds_bucket{endpoint="/a",le="0.25"} 1' in text
+    assert 'ai4e_request_duration_seconds_bucket{endpoint="/a",le="+Inf"} 1' in text
+    assert 'ai4e_request_duration_seconds_sum{endpoint="/a"} 0.25' in text
+    assert 'ai4e_request_duration_seconds_count{endpoint="/a"} 1' in text
+    assert 'ai4e_task_queue_seconds_count{endpoint="/a"} 1' in text
+    assert 'ai4e_task_queue_seconds_bucket{endpoint="/a",le="0.1"} 1' in text
+    assert 'quantile' not in text
+    assert 'ai4e_requests_in_flight{endpoint="/a"} 2' in text
+
+
+def test_render_models_and_process_memory():
+    from model_loader import ModelInfo
+    metrics = EndpointMetrics('test-' + uuid.uuid4().hex)
+    models = [ModelInfo('detector', 1.5, os.getpid()), ModelInfo('classifier', 0.5, os.getppid())]
+    text = metrics.render_prometheus(models=models, process_memory={123: {'rss_bytes': 2048, 'pss_bytes': 1024}, 45: {'rss_bytes': 4096}})
+
+    assert 'ai4e_model_load_seconds{model="detector"} 1.5' in text
+    assert 'ai4e_model_preloaded{model="detector"} 0' in text
+    assert 'ai4e_model_preloaded{model="classifier"} 1' in text
+    assert 'ai4e_process_resident_memory_bytes{pid="45"} 4096' in text
+    assert 'ai4e_process_resident_memory_bytes{pid="123"} 2048' in text
+    assert 'ai4e_process_proportional_memory_bytes{pid="123"} 1024' in text
+    assert 'ai4e_process_shared_memory_bytes' not in text
+
+
+def test_is_process_alive():
+    assert is_process_alive(os.getpid())
@@ -0,0 +1,79 @@
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License.
+import os
+import uuid
+
+import pytest
+
+import model_loader
+from model_loader import PerProcess, get_loaded_models, get_process_memory, is_preloaded, load_model, map_file
+
+
+@pytest.fixture
+def name():
+    return 'model-' + uuid.uuid4().hex[:8]
+
+
+def run_in_child(function):
+    """Runs function in a forked child and returns its exit status."""
+    pid = os.fork()
+    if pid == 0:
+        try:
+            os._exit(0 if function() else 1)
+        except BaseException:
+            os._exit(2)
+    _, exit_status = os.waitpid(pid, 0)
+    return os.WEXITSTATUS(exit_status)
+
+
+def test_load_model_once(name, monkeypatch):
+    monkeypatch.setattr(model_loader, 'MODEL_FREEZE_GC', False)
+    calls = []
+
+    def loader(path, scale=1):
+        calls.append(path)
+        return {'path': path, 'scale': scale}
+
+    model = load_model(name, loader, 'weights.pb', scale=2)
+    assert model == {'path': 'weights.pb', 'scale': 2}
+    assert load_model(name, loader, 'other.pb') is model
+    assert calls == ['weights.pb']
+
+    info = [info for info in get_loaded_models() if info.name == name][0]
+    assert info.pid == os.getpid() and info.load_seconds >= 0
+
+
+def test_models_loaded_before_fork_are_preloaded(name, monkeypatch):
+    monkeypatch.setattr(model_loader, 'MODEL_FREEZE_GC', False)
+    load_model(name, dict)
+    assert not is_preloaded(name)
+    assert run_in_child(lambda: is_preloaded(name)) == 0
+    assert not is_preloaded('missing')
+
+
+def test_per_process_value():
+    per_process = PerProcess(object)
+    assert per_process.get_if_created() is None
+    value = per_process.get()
+    assert per_process.get() is value and per_process.get_if_created() is value
+    # A forked child creates its own value.
+    assert run_in_child(lambda: per_process.get_if_created() is None and per_process.get() is not value) == 0
+
+
+def test_map_file(tmp_path):
+    path = tmp_path / 'weights.bin'
+    path.write_bytes(b'0123456789')
+    mapped = map_file(str(path))
+    assert mapped[2:5] == b'234'
+    with pytest.raises(TypeError):
+        mapped[0] = 1
+    mapped.close()
+
+
+@pytest.mark.skipif(not os.path.exists('/proc/self/status'), reason='Process memory is read from /proc.')
+def test_get_process_memory():
+    memory = get_process_memory()
+    assert memory['rss_bytes'] > 0
+    if 'pss_bytes' in memory:
+        assert memory['shared_bytes'] + memory['private_bytes'] == pytest.approx(memory['rss_bytes'], rel=0.1)
+    assert get_process_memory(2 ** 22 + 12345) == {}
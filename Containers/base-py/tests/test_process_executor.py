@@ -0,0 +1,141 @@
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License.
+import io
+import os
+import queue
+
+import pytest
+
+from payload_buffers import MemoryViewReader, get_payload_buffer, open_shared_payload, remove_shared_payload, write_shared_payload
+from task_executor import ProcessTaskExecutor, create_executor
+
+
+def test_memory_view_reader():
+    data = bytearray(b'0123456789')
+    reader = MemoryViewReader(data)
+    assert reader.read(4) == b'0123'
+    reader.seek(-2, io.SEEK_END)
+    assert reader.read() == b'89'
+    assert reader.tell() == 10
+    assert len(reader) == 10
+
+    # The reader is a view of data rather than a copy.
+    data[0:1] = b'x'
+    assert bytes(reader.getbuffer()[:1]) == b'x'
+    with pytest.raises(ValueError):
+        reader.seek(-1)
+
+
+def test_get_payload_buffer():
+    assert bytes(get_payload_buffer(b'abc')) == b'abc'
+    assert bytes(get_payload_buffer(io.BytesIO(b'abc'))) == b'abc'
+    assert bytes(get_payload_buffer(MemoryViewReader(b'abc'))) == b'abc'
+    assert get_payload_buffer('abc') is None
+
+
+def test_shared_payload_round_trip():
+    path = write_shared_payload(b'payload')
+    try:
+        shared = open_shared_payload(path, 7)
+        assert shared[:] == b'payload'
+        shared.close()
+    finally:
+        remove_shared_payload(path)
+    assert not os.path.exists(path)
+    # Removing twice is not an error.
+    remove_shared_payload(path)
+
+    path = write_shared_payload(b'')
+    assert open_shared_payload(path, 0) == b''
+    remove_shared_payload(path)
+
+
+def write_job(output_dir):
+    """Returns a job function that writes what it received to output_dir/<name>, from the child process."""
+    def job(name, data=None, file=None, text=None, fail=False):
+        if fail:
+            raise ValueError('job failed')
+        with open(os.path.join(output_dir, name), 'w') as f:
+            f.write(repr((os.getpid(), type(data).__name__, bytes(data) if data is not None else None,
+                          file.read() if file is not None else None, text)))
+    return job
+
+
+def read_output(output_dir, name):
+    with open(os.path.join(output_dir, name)) as f:
+        return eval(f.read())
+
+
+@pytest.fixture
+def done():
+    return queue.Queue()
+
+
+def test_jobs_run_in_child_process(tmp_path, done):
+    executor = ProcessTaskExecutor('test', write_job(str(tmp_path)), max_workers=1,
+                                   job_done_callback=lambda args, kwargs, queue_seconds, run_seconds, failed: done.put((args[0], failed)))
+    assert executor.reserve()
+    executor.submit(('a',), {'data': b'bytes', 'file': io.BytesIO(b'stream'), 'text': 'plain'})
+    assert done.get(timeout=10) == ('a', False)
+
+    pid, data_type, data, file_data, text = read_output(str(tmp_path), 'a')
+    assert pid != os.getpid()
+    # Payloads arrive as views of shared memory instead of pickled copies.
+    assert (data_type, data, file_data, text) == ('memoryview', b'bytes', b'stream', 'plain')
+    executor.shutdown()
+
+
+def test_child_is_reused_and_errors_are_reported(tmp_path, done):
+    executor = ProcessTaskExecutor('test', write_job(str(tmp_path)), max_workers=1, max_queue_size=2,
+                                   job_done_callback=lambda args, kwargs, queue_seconds, run_seconds, failed: done.put((args[0], failed)))
+    for name, fail in [('a', False), ('bad', True), ('b', False)]:
+        assert executor.reserve()
+        executor.submit((name,), {'fail': fail})
+    assert [done.get(timeout=10) for _ in range(3)] == [('a', False), ('bad', True), ('b', False)]
+    assert read_output(str(tmp_path), 'a')[0] == read_output(str(tmp_path), 'b')[0]
+    executor.shutdown()
+
+
+def test_children_start_with_the_pool(tmp_path, done, wait_until):
+    marker = str(tmp_path / 'initialized')
+
+    def initializer():
+        with open(marker, 'a') as f:
+            f.write('{}\n'.format(os.getpid()))
+
+    def initialized_pids():
+        if not os.path.exists(marker):
+            return []
+        with open(marker) as f:
+            return f.read().split()
+
+    executor = ProcessTaskExecutor('test', write_job(str(tmp_path)), max_workers=2, process_initializer=initializer,
+                                   job_done_callback=lambda args, kwargs, queue_seconds, run_seconds, failed: done.put(failed))
+    # Every child is forked and initialized by start(), before any job.
+    executor.start()
+    assert wait_until(lambda: len(initialized_pids()) == 2)
+
+    assert executor.reserve()
+    executor.submit(('a',))
+    assert done.get(timeout=10) is False
+    assert str(read_output(str(tmp_path), 'a')[0]) in initialized_pids()
+    # Jobs reuse the children that were started.
+    assert len(initialized_pids()) == 2
+    executor.shutdown()
+
+
+def test_lost_job_handler(done):
+    lost = queue.Queue()
+    executor = ProcessTaskExecutor('test', lambda name: os._exit(1), max_workers=1,
+                                   lost_job_handler=lambda args, kwargs: lost.put(args[0]),
+                                   job_done_callback=lambda args, kwargs, queue_seconds, run_seconds, failed: done.put(failed))
+    assert executor.reserve()
+    executor.submit(('a',))
+    assert lost.get(timeout=10) == 'a'
+    assert done.get(timeout=10) is True
+    executor.shutdown()
+
+
+def test_create_process_executor():
+    executor = create_executor('process', 'test', print, 1)
+    assert isinstance(executor, ProcessTaskExecutor)
@@ -0,0 +1,135 @@
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License.
+import io
+import pickle
+
+import pytest
+
+import request_body
+from request_body import BufferPool, RequestBodyTooLarge, read_request_body
+
+BODY = bytes(range(256)) * 400
+
+
+class ChunkedStream(io.RawIOBase):
+    """A stream that returns at most chunk_size bytes per read, like a chunked request."""
+    def __init__(self, data, chunk_size=1000):
+        self._data = io.BytesIO(data)
+        self._chunk_size = chunk_size
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        chunk = self._data.read(min(len(b), self._chunk_size))
+        b[:len(chunk)] = chunk
+        return len(chunk)
+
+
+@pytest.fixture
+def pool(monkeypatch):
+    pool = BufferPool()
+    monkeypatch.setattr(request_body, '_pool', pool)
+    return pool
+
+
+def test_buffer_pool_reuses_buffers(pool):
+    buffer = pool.get(5000)
+    assert len(buffer) == 8192
+    pool.put(buffer)
+    assert pool.get(6000) is buffer
+    assert pool.get(6000) is not buffer
+
+
+@pytest.mark.parametrize('content_length', [len(BODY), None])
+def test_read_body(pool, content_length):
+    with read_request_body(ChunkedStream(BODY), content_length) as body:
+        assert body.size == len(BODY)
+        assert bytes(body.getbuffer()) == BODY
+        assert body.read(3) == BODY[:3]
+
+
+def test_small_chunked_body_uses_small_buffer(pool, monkeypatch):
+    sizes = []
+    get = pool.get
+    monkeypatch.setattr(pool, 'get', lambda size: sizes.append(size) or get(size))
+
+    with read_request_body(ChunkedStream(b'small'), None, spool_bytes=16 * 1024 * 1024) as body:
+        assert bytes(body.getbuffer()) == b'small'
+    assert sizes == [request_body.READ_CHUNK_SIZE]
+
+    # Buffers are doubled as a larger body arrives.
+    sizes.clear()
+    with read_request_body(ChunkedStream(BODY, chunk_size=4096), None, spool_bytes=16 * 1024 * 1024) as body:
+        assert bytes(body.getbuffer()) == BODY
+    assert sizes == [65536, 131072]
+
+
+def test_chunked_body_is_spooled_past_threshold(pool):
+    with read_request_body(ChunkedStream(BODY), None, spool_bytes=8192) as body:
+        assert body._spool_file is not None
+        assert bytes(body.getbuffer()) == BODY
+
+
+def test_large_body_is_spooled(pool):
+    with read_request_body(io.BytesIO(BODY), len(BODY), spool_bytes=8192) as body:
+        assert body._spool_file is not None
+        assert bytes(body.getbuffer()) == BODY
+
+
+@pytest.mark.parametrize('spool_bytes', [8192, 1024 * 1024])
+def test_chunked_body_over_max_length(pool, spool_bytes):
+    with pytest.raises(RequestBodyTooLarge):
+        read_request_body(ChunkedStream(BODY), None, max_length=len(BODY) - 1, spool_bytes=spool_bytes)
+    # A body of exactly max_length is accepted.
+    with read_request_body(ChunkedStream(BODY), None, max_length=len(BODY), spool_bytes=spool_bytes) as body:
+        assert body.size == len(BODY)
+
+
+def test_content_length_over_max_length(pool):
+    with pytest.raises(RequestBodyTooLarge):
+        read_request_body(io.BytesIO(BODY), len(BODY), max_length=10)
+
+
+def test_empty_body(pool):
+    with read_request_body(io.BytesIO(b''), None) as body:
+        assert body.size == 0
+        assert body.read() == b''
+
+
+def test_close_returns_buffer_to_pool(pool):
+    body = read_request_body(io.BytesIO(b'abc'), 3)
+    buffer = body._pooled_buffer
+    body.close()
+    assert pool.get(3) is buffer
+
+
+@pytest.mark.skipif(not hasattr(pickle, 'PickleBuffer'), reason='pickle.PickleBuffer needs Python 3.8')
+def test_close_with_view_exported_by_endpoint(pool):
+    body = read_request_body(io.BytesIO(b'abc'), 3)
+    buffer = body._pooled_buffer
+    # The endpoint still holds an export of the view, so the view cannot be released.
+    held = pickle.PickleBuffer(body.getbuffer())
+    body.close()
+
+    # The buffer is not reused while the endpoint can still read it.
+    assert pool.get(3) is not buffer
+    assert bytes(held.raw()) == b'abc'
+
+
+def test_slice_of_buffer_survives_close(pool):
+    body = read_request_body(io.BytesIO(b'A' * 100), 100)
+    view = body.getbuffer()[0:10]
+    body.close()
+
+    # The next request must not get the buffer the slice still reads.
+    read_request_body(io.BytesIO(b'B' * 100), 100)
+    assert bytes(view) == b'A' * 10
+
+
+def test_peek_buffer_keeps_buffer_pooled(pool):
+    body = read_request_body(io.BytesIO(b'abc'), 3)
+    buffer = body._pooled_buffer
+    assert bytes(body.peek_buffer()) == b'abc'
+    body.close()
+    assert pool.get(3) is buffer
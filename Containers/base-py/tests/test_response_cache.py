@@ -0,0 +1,77 @@
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License.
+import os
+import time
+
+import pytest
+
+from response_cache import CachedTask, ResponseCache, decode_response, encode_response, make_cache_key
+
+
+def test_cache_key():
+    key = make_cache_key('/v1/test/classify', {'name': 'a'}, {'threshold': ['0.5']}, b'image')
+    assert len(key) == 16
+    assert key == make_cache_key('/v1/test/classify', {'name': 'a'}, {'threshold': ['0.5']}, memoryview(b'image'))
+    for other in (make_cache_key('/v1/test/detect', {'name': 'a'}, {'threshold': ['0.5']}, b'image'),
+                  make_cache_key('/v1/test/classify', {'name': 'b'}, {'threshold': ['0.5']}, b'image'),
+                  make_cache_key('/v1/test/classify', {'name': 'a'}, {'threshold': ['0.9']}, b'image'),
+                  make_cache_key('/v1/test/classify', {'name': 'a'}, {'threshold': ['0.5']}, b'other')):
+        assert other != key
+
+
+@pytest.mark.parametrize('value', ['text', b'\x00bytes', {'a': [1, 2]}, [1, 'b'], CachedTask('1234')])
+def test_encode_response(value):
+    assert decode_response(encode_response(value)) == value
+
+
+def test_encode_uncacheable_response():
+    assert encode_response(('text', 500)) is None
+    assert encode_response({'a': object()}) is None
+
+
+def test_memory_cache_is_bounded():
+    cache = ResponseCache(max_bytes=20, disk_dir='')
+    assert cache.put(b'a', 'x' * 8)
+    assert cache.put(b'b', 'y' * 8)
+    # Reading a makes b the least recently used entry.
+    assert cache.get(b'a') == 'x' * 8
+    assert cache.put(b'c', 'z' * 8)
+    assert (cache.get(b'a'), cache.get(b'b'), cache.get(b'c')) == ('x' * 8, None, 'z' * 8)
+
+    assert not cache.put(b'd', ('text', 500))
+    cache.put(b'e', 'too large' * 10)
+    assert cache.get(b'e') is None
+
+    cache.delete(b'a')
+    assert cache.get(b'a') is None
+
+
+def test_expired_entries_are_missing():
+    cache = ResponseCache(ttl_seconds=0.05, disk_dir='')
+    cache.put(b'a', 'text')
+    time.sleep(0.1)
+    assert cache.get(b'a') is None
+
+
+def test_disk_cache_is_shared(tmp_path):
+    cache = ResponseCache(disk_dir=str(tmp_path))
+    cache.put(b'a', {'label': 'cat'})
+    # Another worker process using the same directory.
+    assert ResponseCache(disk_dir=str(tmp_path)).get(b'a') == {'label': 'cat'}
+
+    cache.delete(b'a')
+    assert ResponseCache(disk_dir=str(tmp_path)).get(b'a') is None
+
+
+def test_disk_cache_is_bounded(tmp_path, monkeypatch):
+    monkeypatch.setattr('response_cache.RESPONSE_CACHE_EVICT_SECONDS', 0)
+    cache = ResponseCache(disk_dir=str(tmp_path), disk_max_bytes=60)
+    # Each file holds a timestamp, a type byte and 20 bytes of text.
+    for i, key in enumerate([b'a', b'b', b'c']):
+        cache.put(key, 'x' * 20)
+        last_used = time.time() - 10 + i
+        os.utime(str(tmp_path / key.hex()), (last_used, last_used))
+    cache.put(b'd', 'x' * 20)
+
+    # The least recently used files are removed.
+    assert sorted(os.listdir(str(tmp_path))) == [b'c'.hex(), b'd'.hex()]
@@ -0,0 +1,142 @@
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License.
+import queue
+import threading
+
+import pytest
+
+from task_executor import ThreadTaskExecutor, create_executor
+
+
+class Jobs:
+    """A job function that blocks until released, and records what ran and what finished."""
+    def __init__(self):
+        self.release = threading.Event()
+        self.started = queue.Queue()
+        self.done = queue.Queue()
+
+    def run(self, name, fail=False):
+        self.started.put(name)
+        self.release.wait(5)
+        if fail:
+            raise RuntimeError('job failed')
+
+    def on_done(self, args, kwargs, queue_seconds, run_seconds, failed):
+        self.done.put((args[0], failed))
+
+    def wait_done(self, count):
+        return [self.done.get(timeout=5) for _ in range(count)]
+
+
+@pytest.fixture
+def jobs():
+    jobs = Jobs()
+    yield jobs
+    jobs.release.set()
+
+
+def submit(executor, name, priority=0, **kwargs):
+    assert executor.reserve()
+    executor.submit((name,), kwargs, priority)
+
+
+def test_runs_at_most_max_workers_jobs(jobs, wait_until):
+    executor = ThreadTaskExecutor('test', jobs.run, max_workers=2, max_queue_size=2, job_done_callback=jobs.on_done)
+    for i in range(4):
+        submit(executor, i)
+
+    # Both workers and the whole queue are taken.
+    assert not executor.reserve()
+    assert wait_until(lambda: executor.running_count == 2)
+    assert executor.queued_count == 2
+
+    jobs.release.set()
+    assert sorted(jobs.wait_done(4)) == [(0, False), (1, False), (2, False), (3, False)]
+    # Finished jobs give their slots back.
+    assert wait_until(lambda: executor.reserve())
+    executor.shutdown()
+
+
+def test_queue_is_ordered_by_priority(jobs, wait_until):
+    executor = ThreadTaskExecutor('test', jobs.run, max_workers=1, max_queue_size=3, job_done_callback=jobs.on_done)
+    submit(executor, 'first')
+    assert jobs.started.get(timeout=5) == 'first'
+
+    submit(executor, 'low', priority=5)
+    submit(executor, 'high', priority=1)
+    submit(executor, 'high again', priority=1)
+    jobs.release.set()
+
+    assert [name for name, _ in jobs.wait_done(4)] == ['first', 'high', 'high again', 'low']
+    executor.shutdown()
+
+
+def test_failed_jobs_are_reported(jobs):
+    executor = ThreadTaskExecutor('test', jobs.run, max_workers=1, max_queue_size=0, job_done_callback=jobs.on_done)
+    jobs.release.set()
+    submit(executor, 'bad', fail=True)
+    assert jobs.wait_done(1) == [('bad', True)]
+
+    # The worker keeps running after an exception.
+    submit(executor, 'good')
+    assert jobs.wait_done(1) == [('good', False)]
+    executor.shutdown()
+
+
+def test_job_done_callback_exception_does_not_stop_the_worker(jobs):
+    def on_done(args, kwargs, queue_seconds, run_seconds, failed):
+        jobs.on_done(args, kwargs, queue_seconds, run_seconds, failed)
+        raise RuntimeError('callback failed')
+
+    executor = ThreadTaskExecutor('test', jobs.run, max_workers=1, max_queue_size=0, job_done_callback=on_done)
+    jobs.release.set()
+    submit(executor, 'first')
+    assert jobs.wait_done(1) == [('first', False)]
+    submit(executor, 'second')
+    assert jobs.wait_done(1) == [('second', False)]
+    executor.shutdown()
+
+
+def test_start_starts_the_workers(jobs):
+    executor = ThreadTaskExecutor('test', jobs.run, max_workers=2)
+    executor.start()
+    assert [worker.is_alive() for worker in executor._workers] == [True, True]
+    executor.shutdown()
+
+
+def test_unbounded_queue(jobs, wait_until):
+    executor = ThreadTaskExecutor('test', jobs.run, max_workers=1, max_queue_size=None, job_done_callback=jobs.on_done)
+    for i in range(50):
+        submit(executor, i)
+    assert wait_until(lambda: executor.queued_count == 49)
+
+    jobs.release.set()
+    assert len(jobs.wait_done(50)) == 50
+    executor.shutdown()
+
+
+def test_cancel_reservation(jobs):
+    executor = ThreadTaskExecutor('test', jobs.run, max_workers=1, max_queue_size=0)
+    assert executor.reserve()
+    assert not executor.reserve()
+    executor.cancel_reservation()
+    assert executor.reserve()
+
+
+def test_shutdown_runs_queued_jobs_and_stops_admission(jobs):
+    executor = ThreadTaskExecutor('test', jobs.run, max_workers=1, max_queue_size=2, job_done_callback=jobs.on_done)
+    for i in range(3):
+        submit(executor, i)
+    jobs.release.set()
+
+    executor.shutdown(wait=True)
+    assert len(jobs.wait_done(3)) == 3
+    assert not executor.reserve()
+
+
+def test_create_executor():
+    assert isinstance(create_executor('thread', 'test', print, 1), ThreadTaskExecutor)
+    with pytest.raises(ValueError):
+        create_executor('unknown', 'test', print, 1)
+    with pytest.raises(ValueError):
+        ThreadTaskExecutor('test', print, max_workers=0)
@@ -0,0 +1,42 @@
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License.
+import threading
+import time
+
+from task_management.task_notifier import TaskStatusNotifier
+
+
+def test_wait_returns_when_notified():
+    notifier = TaskStatusNotifier()
+    with notifier.watch('a') as watcher:
+        threading.Timer(0.05, notifier.notify, args=('a',)).start()
+        started = time.monotonic()
+        assert watcher.wait(5)
+        assert time.monotonic() - started < 1
+
+
+def test_wait_times_out():
+    notifier = TaskStatusNotifier()
+    with notifier.watch('a') as watcher:
+        notifier.notify('b')
+        assert not watcher.wait(0.05)
+
+
+def test_notification_before_wait_is_not_missed():
+    notifier = TaskStatusNotifier()
+    with notifier.watch('a') as watcher:
+        notifier.notify('a')
+        assert watcher.wait(0)
+        # Each notification is only reported once.
+        assert not watcher.wait(0)
+
+
+def test_watches_are_removed():
+    notifier = TaskStatusNotifier()
+    with notifier.watch('a'):
+        with notifier.watch('a'):
+            pass
+        assert 'a' in notifier._watches
+    assert notifier._watches == {}
+    # Notifying a task nobody watches does nothing.
+    notifier.notify('a')
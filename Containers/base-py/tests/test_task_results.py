@@ -0,0 +1,64 @@
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License.
+import io
+
+import pytest
+
+from task_management.task_results import BlobResultStore, LocalResultStore, create_result_store, encode_result, BYTES_CONTENT_TYPE, JSON_CONTENT_TYPE, NUMPY_CONTENT_TYPE
+
+
+def test_encode_result():
+    assert encode_result({'a': [1, 2]}) == (JSON_CONTENT_TYPE, b'{"a":[1,2]}')
+    assert encode_result(b'\x00\x01') == (BYTES_CONTENT_TYPE, b'\x00\x01')
+    assert encode_result(bytearray(b'jpeg'), 'image/jpeg') == ('image/jpeg', b'jpeg')
+
+
+def test_encode_numpy_result():
+    np = pytest.importorskip('numpy')
+    content_type, data = encode_result(np.arange(3))
+    assert content_type == NUMPY_CONTENT_TYPE
+    np.testing.assert_array_equal(np.load(io.BytesIO(data)), np.arange(3))
+
+
+@pytest.fixture
+def result_store(tmp_path):
+    return LocalResultStore(str(tmp_path / 'results'), inline_bytes=16)
+
+
+def read(result_store, task_id, descriptor, start=0, stop=None):
+    return b''.join(result_store.iter_range(task_id, descriptor, start, descriptor['Size'] if stop is None else stop, chunk_size=3))
+
+
+def test_small_json_results_are_inline(result_store):
+    descriptor = result_store.save('a', {'x': 1})
+    assert descriptor == {'ContentType': JSON_CONTENT_TYPE, 'Size': 7, 'Value': {'x': 1}}
+    assert read(result_store, 'a', descriptor) == b'{"x":1}'
+    assert read(result_store, 'a', descriptor, 1, 4) == b'"x"'
+
+
+def test_large_results_are_written(result_store):
+    descriptor = result_store.save('a', list(range(20)))
+    assert 'Value' not in descriptor
+    assert read(result_store, 'a', descriptor) == encode_result(list(range(20)))[1]
+
+    descriptor = result_store.save('b', b'0123456789')
+    assert read(result_store, 'b', descriptor, 2, 8) == b'234567'
+
+    result_store.delete(['a', 'b', 'missing'])
+    with pytest.raises(FileNotFoundError):
+        read(result_store, 'b', descriptor)
+
+
+def test_blob_result_store(tmp_path):
+    pytest.importorskip('azure.storage.blob')
+    from aad_blob import AadBlob
+    result_store = BlobResultStore(AadBlob(local_test_directory=str(tmp_path)), inline_bytes=0)
+    descriptor = result_store.save('a', b'0123456789')
+    assert read(result_store, 'a', descriptor, 2, 8) == b'234567'
+    result_store.delete(['a'])
+
+
+def test_create_result_store(tmp_path):
+    assert isinstance(create_result_store(str(tmp_path), 'local'), LocalResultStore)
+    with pytest.raises(ValueError):
+        create_result_store(str(tmp_path), 'unknown')
@@ -0,0 +1,36 @@
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License.
+import threading
+
+from task_management.task_retention import TaskCompactor
+
+
+class RecordingStore:
+    def __init__(self):
+        self.calls = []
+        self.compacted = threading.Event()
+
+    def compact(self, ttl_seconds, max_tasks, tombstone_seconds, batch_size, on_expired):
+        self.calls.append((ttl_seconds, max_tasks, tombstone_seconds, batch_size, on_expired))
+        self.compacted.set()
+        return 0
+
+
+def test_compact_passes_settings_to_store():
+    store = RecordingStore()
+    compactor = TaskCompactor(store, ttl_seconds={'completed': 10}, max_tasks=5, tombstone_seconds=20, batch_size=2, on_expired=print)
+    compactor.compact()
+    assert store.calls == [({'completed': 10}, 5, 20, 2, print)]
+
+
+def test_background_compaction():
+    store = RecordingStore()
+    compactor = TaskCompactor(store, interval_seconds=0.01)
+    compactor.ensure_started()
+    assert store.compacted.wait(5)
+
+
+def test_interval_of_zero_disables_compaction():
+    store = RecordingStore()
+    TaskCompactor(store, interval_seconds=0).ensure_started()
+    assert not store.compacted.wait(0.1)
@@ -0,0 +1,208 @@
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License.
+import os
+import threading
+import time
+
+import pytest
+
+from task_management.fake_redis import FakeRedis
+from task_management.task_store import JsonFileTaskStore, RedisTaskStore, SqliteTaskStore, create_task_store, format_timestamp, TASK_STATE_ACTIVE, TASK_STATE_COMPLETED, TASK_STATE_EXPIRED, TASK_STATE_FAILED
+
+
+def make_record(task_id, endpoint='/v1/test/example', status='created', timestamp='2020-01-01 00:00:00'):
+    return {'TaskId': task_id, 'Status': status, 'Timestamp': timestamp, 'Endpoint': endpoint, 'State': TASK_STATE_ACTIVE, 'Version': 0}
+
+
+@pytest.fixture(params=['sqlite', 'json', 'redis'])
+def store(request, tmp_path):
+    if request.param == 'sqlite':
+        return SqliteTaskStore(str(tmp_path / 'task_status.db'))
+    if request.param == 'redis':
+        return RedisTaskStore(FakeRedis(), 'test')
+    return JsonFileTaskStore(str(tmp_path / 'task_status.json'))
+
+
+def open_again(store):
+    """Returns another store on the same data, as another worker process would open it."""
+    if isinstance(store, SqliteTaskStore):
+        return SqliteTaskStore(store.db_path)
+    if isinstance(store, RedisTaskStore):
+        return RedisTaskStore(store.client, store.prefix)
+    return JsonFileTaskStore(store.json_path)
+
+
+def test_add_and_get(store):
+    store.add(make_record('a'))
+    assert store.get('a') == make_record('a')
+    assert store.get('missing') is None
+
+
+def test_update_increments_version(store):
+    store.add(make_record('a'))
+    assert store.update('a', 'running', '2020-01-01 00:00:01')
+    assert store.update('a', {'progress': 0.5}, '2020-01-01 00:00:02')
+
+    record = store.get('a')
+    assert record['Status'] == {'progress': 0.5}
+    assert record['Timestamp'] == '2020-01-01 00:00:02'
+    assert record['State'] == TASK_STATE_ACTIVE
+    assert record['Version'] == 2
+
+
+def test_update_missing_task(store):
+    assert not store.update('missing', 'running', '2020-01-01 00:00:01')
+    assert store.get('missing') is None
+
+
+def test_update_state_and_result(store):
+    store.add(make_record('a'))
+    result = {'ContentType': 'application/json', 'Size': 2, 'Value': {}}
+    store.update('a', 'completed', '2020-01-01 00:00:01', TASK_STATE_COMPLETED, result)
+    assert store.get('a')['State'] == TASK_STATE_COMPLETED
+    assert store.get('a')['Result'] == result
+
+    # A later update without a result removes it.
+    store.update('a', 'failed', '2020-01-01 00:00:02', TASK_STATE_FAILED)
+    assert store.get('a')['State'] == TASK_STATE_FAILED
+    assert 'Result' not in store.get('a')
+
+
+def test_records_are_shared_between_instances(store):
+    other = open_again(store)
+    store.add(make_record('a'))
+    assert other.update('a', 'running', '2020-01-01 00:00:01')
+    assert store.get('a')['Status'] == 'running'
+
+
+def test_sqlite_store_survives_fork(tmp_path):
+    store = SqliteTaskStore(str(tmp_path / 'task_status.db'))
+    store.add(make_record('a'))
+
+    pid = os.fork()
+    if pid == 0:
+        # The child must open its own connection rather than reuse the parent's.
+        ok = store.update('a', 'from child', '2020-01-01 00:00:01')
+        os._exit(0 if ok else 1)
+    _, exit_status = os.waitpid(pid, 0)
+
+    assert os.WEXITSTATUS(exit_status) == 0
+    assert store.get('a')['Status'] == 'from child'
+
+
+def test_fork_waits_for_sqlite_calls(tmp_path):
+    store = SqliteTaskStore(str(tmp_path / 'task_status.db'))
+    store.add(make_record('a'))
+
+    # Another thread is inside a SQLite call for the next 0.2 seconds.
+    connection = store._connection()
+    connection.__enter__()
+    threading.Timer(0.2, connection.__exit__, args=(None, None, None)).start()
+
+    started = time.monotonic()
+    pid = os.fork()
+    if pid == 0:
+        os._exit(0 if store.update('a', 'from child', '2020-01-01 00:00:01') else 1)
+    assert time.monotonic() - started >= 0.2
+    _, exit_status = os.waitpid(pid, 0)
+    assert os.WEXITSTATUS(exit_status) == 0
+
+
+def test_create_task_store(tmp_path):
+    assert isinstance(create_task_store(str(tmp_path), 'sqlite'), SqliteTaskStore)
+    assert isinstance(create_task_store(str(tmp_path), 'json'), JsonFileTaskStore)
+    with pytest.raises(ValueError):
+        create_task_store(str(tmp_path), 'unknown')
+
+
+def add_finished(store, task_id, state, timestamp):
+    store.add(make_record(task_id, timestamp=timestamp))
+    store.update(task_id, state, timestamp, state)
+
+
+def test_compact_expires_by_state(store):
+    old = format_timestamp(time.time() - 3600)
+    add_finished(store, 'old completed', TASK_STATE_COMPLETED, old)
+    add_finished(store, 'old failed', TASK_STATE_FAILED, old)
+    store.add(make_record('old active', timestamp=old))
+    add_finished(store, 'new completed', TASK_STATE_COMPLETED, format_timestamp(time.time()))
+
+    expired_ids = []
+    ttl_seconds = {TASK_STATE_COMPLETED: 60, TASK_STATE_FAILED: 60, TASK_STATE_ACTIVE: 0}
+    assert store.compact(ttl_seconds, tombstone_seconds=3600, on_expired=expired_ids.extend) == 2
+
+    assert sorted(expired_ids) == ['old completed', 'old failed']
+    # Removed tasks are remembered as expired, without a version.
+    expired = store.get('old completed')
+    assert (expired['Status'], expired['State'], expired['Endpoint']) == (TASK_STATE_EXPIRED, TASK_STATE_EXPIRED, '/v1/test/example')
+    assert 'Version' not in expired
+    # A TTL of 0 keeps tasks forever.
+    assert store.get('old active')['State'] == TASK_STATE_ACTIVE
+    assert store.get('new completed')['State'] == TASK_STATE_COMPLETED
+    # Compaction is idempotent.
+    assert store.compact(ttl_seconds) == 0
+
+
+def test_compact_limits_task_count(store):
+    for i in range(5):
+        add_finished(store, 'completed {}'.format(i), TASK_STATE_COMPLETED, format_timestamp(time.time() - 100 + i))
+    store.add(make_record('active', timestamp=format_timestamp(time.time() - 1000)))
+
+    assert store.compact({}, max_tasks=3, tombstone_seconds=3600, batch_size=1) == 3
+    # The oldest finished tasks go first; active tasks are never removed for the limit.
+    assert [store.get('completed {}'.format(i))['State'] for i in range(5)] == [TASK_STATE_EXPIRED] * 3 + [TASK_STATE_COMPLETED] * 2
+    assert store.get('active')['State'] == TASK_STATE_ACTIVE
+
+
+def test_concurrent_updates_are_not_lost(store):
+    store.add(make_record('a'))
+    stores = [open_again(store) for _ in range(4)]
+
+    def update(other):
+        for _ in range(25):
+            assert other.update('a', 'running', '2020-01-01 00:00:01')
+
+    threads = [threading.Thread(target=update, args=(other,)) for other in stores]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert store.get('a')['Version'] == 100
+
+
+def test_redis_update_of_removed_task_writes_nothing():
+    client = FakeRedis()
+    store = RedisTaskStore(client, 'test')
+    store.add(make_record('a', timestamp=format_timestamp(time.time() - 3600)))
+    store.compact({TASK_STATE_ACTIVE: 60}, tombstone_seconds=3600)
+
+    assert not store.update('a', 'running', '2020-01-01 00:00:01')
+    assert client.hgetall(store._task_key('a')) == {}
+    assert client.zcard(store._index_key(TASK_STATE_ACTIVE)) == 0
+    assert store.get('a')['State'] == TASK_STATE_EXPIRED
+
+
+def test_redis_compaction_without_tombstones_deletes_tasks():
+    client = FakeRedis()
+    store = RedisTaskStore(client, 'test')
+    add_finished(store, 'a', TASK_STATE_COMPLETED, format_timestamp(time.time() - 3600))
+    assert store.compact({TASK_STATE_COMPLETED: 60}, tombstone_seconds=0) == 1
+
+    assert store.get('a') is None
+    assert client.get(store._expired_key('a')) is None
+    assert client.zcard(store._index_key(TASK_STATE_COMPLETED)) == 0
+
+
+def test_redis_compaction_keeps_tasks_updated_since_selection():
+    store = RedisTaskStore(FakeRedis(), 'test')
+    old = time.time() - 3600
+    add_finished(store, 'completed again', TASK_STATE_COMPLETED, format_timestamp(old))
+    store.add(make_record('restarted', timestamp=format_timestamp(old)))
+    # As if both were selected for expiry, then updated before the transaction ran.
+    store.update('completed again', TASK_STATE_COMPLETED, format_timestamp(time.time()), TASK_STATE_COMPLETED)
+    store.update('restarted', 'running', format_timestamp(old), TASK_STATE_ACTIVE)
+
+    assert store._expire(['completed again'], time.time(), 3600, None, (TASK_STATE_COMPLETED,), time.time() - 60) == 0
+    assert store._expire(['restarted'], time.time(), 3600, None, (TASK_STATE_COMPLETED, TASK_STATE_FAILED)) == 0
+    assert store.get('completed again')['State'] == TASK_STATE_COMPLETED
+    assert store.get('restarted')['State'] == TASK_STATE_ACTIVE
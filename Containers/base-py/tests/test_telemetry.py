@@ -0,0 +1,164 @@
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License.
+import io
+import json
+import logging
+import uuid
+
+import pytest
+
+from telemetry import (LoggingSink, NullSink, OpenCensusMetricExporter, StreamSink, TelemetryPipeline, TokenBucket, create_sink,
+                       METRIC_KIND_COUNTER, METRIC_KIND_DISTRIBUTION, METRIC_KIND_GAUGE)
+
+
+class RecordingSink:
+    def __init__(self):
+        self.metrics = []
+        self.records = []
+
+    def export_metrics(self, counters, gauges, distributions):
+        self.metrics.append((counters, gauges, distributions))
+
+    def export_logs(self, records):
+        self.records.extend(records)
+
+
+@pytest.fixture
+def sink():
+    return RecordingSink()
+
+
+@pytest.fixture
+def logger():
+    logger = logging.getLogger('test_telemetry')
+    logger.setLevel(logging.INFO)
+    return logger
+
+
+def make_pipeline(sink, **kwargs):
+    # A long flush interval, so only the test flushes.
+    return TelemetryPipeline(sink, flush_seconds=3600, **kwargs)
+
+
+def test_metrics_are_aggregated(sink):
+    pipeline = make_pipeline(sink)
+    pipeline.increment('requests')
+    pipeline.increment('requests', 2)
+    pipeline.gauge('queue', 5)
+    pipeline.gauge('queue', 3)
+    pipeline.distribution('latency', 10)
+    pipeline.distribution('latency', 20)
+    pipeline.flush()
+
+    assert sink.metrics == [({'requests': 3}, {'queue': 3}, {'latency': [10, 20]})]
+    # Nothing is exported when nothing was recorded.
+    pipeline.flush()
+    assert len(sink.metrics) == 1
+
+
+def test_logs_keep_their_time_and_exception(sink, logger):
+    pipeline = make_pipeline(sink)
+    try:
+        raise ValueError('failed')
+    except ValueError:
+        pipeline.log(logger, logging.ERROR, 'with exception', extra={'custom_dimensions': {'task_id': '1'}}, exc_info=True)
+    pipeline.log(logger, logging.DEBUG, 'disabled level')
+    pipeline.flush()
+
+    (record,) = sink.records
+    assert record.getMessage() == 'with exception'
+    assert record.custom_dimensions == {'task_id': '1'}
+    assert record.exc_info[0] is ValueError
+    # The traceback was formatted when the message was logged, and its frames are not kept.
+    assert record.exc_info[2] is None
+    assert 'raise ValueError' in record.exc_text and record.exc_text.endswith('ValueError: failed')
+    assert logging.Formatter().format(record).endswith('ValueError: failed')
+
+
+def test_logs_below_warning_are_sampled(sink, logger):
+    pipeline = make_pipeline(sink, log_rate=0, log_burst=2)
+    for i in range(5):
+        pipeline.log(logger, logging.INFO, 'info {}'.format(i))
+    pipeline.log(logger, logging.WARNING, 'always kept')
+    pipeline.flush()
+
+    assert [record.getMessage() for record in sink.records] == ['info 0', 'info 1', 'always kept']
+    assert sink.metrics == [({'telemetry_logs_sampled_out': 3}, {}, {})]
+
+
+def test_full_buffer_drops_oldest(sink):
+    pipeline = make_pipeline(sink, buffer_size=2)
+    for name in ['a', 'b', 'c']:
+        pipeline.increment(name)
+    pipeline.flush()
+    assert sink.metrics == [({'b': 1, 'c': 1}, {}, {})]
+
+
+def test_sink_errors_do_not_raise():
+    class FailingSink(NullSink):
+        def export_metrics(self, counters, gauges, distributions):
+            raise IOError('export failed')
+
+    pipeline = make_pipeline(FailingSink())
+    pipeline.increment('requests')
+    pipeline.flush()
+
+
+def test_buffered_telemetry_is_flushed_at_exit(sink):
+    pipeline = make_pipeline(sink)
+    # Nothing to flush in a process that has not used the pipeline.
+    pipeline._flush_at_exit()
+    pipeline.increment('requests')
+    pipeline._flush_at_exit()
+    assert sink.metrics == [({'requests': 1}, {}, {})]
+
+
+def test_token_bucket():
+    bucket = TokenBucket(rate=0, burst=2)
+    assert bucket.try_take()
+    assert bucket.try_take()
+    assert not bucket.try_take()
+
+
+def test_stream_sink(logger):
+    stream = io.StringIO()
+    sink = StreamSink(stream)
+    sink.export_metrics({'requests': 2}, {'queue': 1}, {'latency': [1, 3]})
+    sink.export_logs([logger.makeRecord(logger.name, logging.INFO, '', 0, 'hello', None, None)])
+
+    entries = [json.loads(line) for line in stream.getvalue().splitlines()]
+    assert [(entry['type'], entry.get('name')) for entry in entries] == [('counter', 'requests'), ('gauge', 'queue'), ('distribution', 'latency'), ('log', None)]
+    assert (entries[2]['count'], entries[2]['sum'], entries[2]['min'], entries[2]['max']) == (2, 4, 1, 3)
+    assert entries[3]['message'] == 'hello'
+
+
+def test_logging_sink_exports_each_metric():
+    exported = []
+    LoggingSink(lambda name, value, kind: exported.append((name, value, kind))).export_metrics({'requests': 2}, {'queue': 1}, {'latency': [1]})
+    assert exported == [('requests', 2, METRIC_KIND_COUNTER), ('queue', 1, METRIC_KIND_GAUGE), ('latency', [1], METRIC_KIND_DISTRIBUTION)]
+
+
+def test_opencensus_metric_exporter():
+    stats = pytest.importorskip('opencensus.stats.stats').stats
+    # Views are registered globally, so the names are unique to this test.
+    requests_name = 'requests_' + uuid.uuid4().hex
+    latency_name = 'latency_' + uuid.uuid4().hex
+    export_metric = OpenCensusMetricExporter(stats.view_manager, stats.stats_recorder)
+    export_metric(requests_name, 2, METRIC_KIND_COUNTER)
+    export_metric(requests_name, 3, METRIC_KIND_COUNTER)
+    export_metric(latency_name, [5, 50], METRIC_KIND_DISTRIBUTION)
+    # Errors are printed rather than raised.
+    export_metric(latency_name, ['not a number'], METRIC_KIND_DISTRIBUTION)
+
+    requests = stats.view_manager.get_view(requests_name)
+    assert [aggregation.sum_data for aggregation in requests.tag_value_aggregation_data_map.values()] == [5]
+    latency = stats.view_manager.get_view(latency_name)
+    assert [aggregation.count_data for aggregation in latency.tag_value_aggregation_data_map.values()] == [2]
+
+
+def test_create_sink():
+    assert isinstance(create_sink('none'), NullSink)
+    assert isinstance(create_sink('stdout'), StreamSink)
+    assert isinstance(create_sink('opencensus'), LoggingSink)
+    with pytest.raises(ValueError):
+        create_sink('unknown')
@@ -0,0 +1,118 @@
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License.
+import io
+import threading
+
+import pytest
+
+np = pytest.importorskip('numpy')
+
+from tiling import DetectionStitcher, SeamBlender, iter_tiles, non_max_suppression, open_raster, raster_size, run_tiled, tile_windows
+
+
+def test_tile_windows_cover_the_raster():
+    windows = tile_windows(250, 100, tile_size=100, overlap=20)
+    # Columns start every 80 pixels; the last one is moved back to end at the edge.
+    assert windows == [(0, 0, 100, 100), (80, 0, 180, 100), (150, 0, 250, 100)]
+    assert tile_windows(50, 40, tile_size=100, overlap=20) == [(0, 0, 50, 40)]
+    with pytest.raises(ValueError):
+        tile_windows(250, 100, tile_size=100, overlap=100)
+
+
+def test_open_raster():
+    array = np.arange(60, dtype=np.uint8).reshape(6, 10)
+    assert open_raster(array) is array
+
+    npy = io.BytesIO()
+    np.save(npy, array)
+    wrapped = open_raster(npy)
+    np.testing.assert_array_equal(wrapped, array)
+    assert raster_size(wrapped) == (10, 6)
+
+
+def test_raster_of_request_body_survives_close():
+    from request_body import read_request_body
+
+    npy = io.BytesIO()
+    np.save(npy, np.full((6, 10), 7, np.uint8))
+    data = npy.getvalue()
+    body = read_request_body(io.BytesIO(data), len(data))
+    raster = open_raster(body)
+    body.close()
+
+    # Another request of the same size must not be read into the raster's buffer.
+    read_request_body(io.BytesIO(b'x' * len(data)), len(data))
+    assert (raster == 7).all()
+
+
+def test_open_npy_file_is_memory_mapped(tmp_path):
+    path = str(tmp_path / 'raster.npy')
+    np.save(path, np.ones((6, 10), np.float32))
+    raster = open_raster(path)
+    assert isinstance(raster, np.memmap)
+    tiles = [tile for _, tile in iter_tiles(raster, tile_size=4, overlap=1)]
+    assert len(tiles) == 6 and all(tile.shape == (4, 4) for tile in tiles)
+
+
+def test_open_image_raster():
+    Image = pytest.importorskip('PIL.Image')
+    data = io.BytesIO()
+    Image.new('RGB', (30, 20)).save(data, 'PNG')
+    raster = open_raster(data.getvalue())
+    assert raster_size(raster) == (30, 20)
+    assert [tile.size for _, tile in iter_tiles(raster, tile_size=20, overlap=5)] == [(20, 20), (20, 20)]
+
+
+def test_run_tiled_keeps_tile_order():
+    raster = np.arange(100 * 100).reshape(100, 100)
+    called = []
+    lock = threading.Lock()
+
+    def predict_batch(tiles):
+        with lock:
+            called.append(len(tiles))
+        return [tile[0, 0] for tile in tiles]
+
+    results = list(run_tiled(raster, predict_batch, tile_size=30, overlap=10, batch_size=4, workers=3))
+    windows = tile_windows(100, 100, 30, 10)
+    assert [window for window, _ in results] == windows
+    assert [prediction for _, prediction in results] == [raster[top, left] for left, top, _, _ in windows]
+    assert max(called) == 4 and sum(called) == len(windows)
+
+
+def test_run_tiled_checks_predictions():
+    with pytest.raises(ValueError):
+        list(run_tiled(np.zeros((10, 10)), lambda tiles: [], tile_size=5, overlap=1))
+
+
+def test_non_max_suppression():
+    boxes = [[0, 0, 10, 10], [1, 0, 10, 10], [0, 0, 10, 10], [20, 20, 30, 30]]
+    scores = [0.5, 0.9, 0.8, 0.1]
+    assert non_max_suppression(boxes, scores, 0.5).tolist() == [1, 3]
+    # Boxes of other classes are kept.
+    assert non_max_suppression(boxes, scores, 0.5, np.array([1, 1, 2, 1])).tolist() == [1, 2, 3]
+
+
+def test_detection_stitcher_merges_tile_duplicates():
+    stitcher = DetectionStitcher(200, 100, iou_threshold=0.5)
+    # The same object seen by two overlapping tiles.
+    stitcher.add((0, 0, 100, 100), [[0.2, 0.8, 0.4, 1.0]], [0.9], [1])
+    stitcher.add((80, 0, 180, 100), [[0.2, 0.0, 0.4, 0.2]], [0.7], [1])
+    stitcher.add((100, 0, 200, 100), [], [], [])
+
+    boxes, scores, classes = stitcher.result(normalized=False)
+    np.testing.assert_allclose(boxes, [[20, 80, 40, 100]])
+    assert scores.tolist() == pytest.approx([0.9]) and classes.tolist() == [1]
+    np.testing.assert_allclose(stitcher.result()[0], [[0.2, 0.4, 0.4, 0.5]])
+    assert DetectionStitcher(10, 10).result()[0].shape == (0, 4)
+
+
+def test_seam_blender(tmp_path):
+    blender = SeamBlender(30, 10, channels=2, overlap=5, out_path=str(tmp_path / 'blended.npy'))
+    for window in tile_windows(30, 10, tile_size=20, overlap=10):
+        blender.add(window, np.ones((10, 20, 2)) * window[0])
+    result = blender.result()
+    assert result.shape == (10, 30, 2)
+    # Pixels covered by one tile keep its value; the overlap is a blend.
+    assert result[0, 0, 0] == 0 and result[0, 29, 1] == pytest.approx(10)
+    assert 0 < result[0, 15, 0] < 10
@@ -0,0 +1,66 @@
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License.
+import os
+
+from warmup import WarmupRunner
+
+
+class FlakyHook:
+    """A warm-up hook that raises until it has been called more than failures times."""
+    def __init__(self, failures):
+        self.failures = failures
+        self.calls = 0
+
+    def __call__(self):
+        self.calls += 1
+        if self.calls <= self.failures:
+            raise RuntimeError('not yet')
+
+
+def test_ready_after_hooks_run():
+    done = []
+    runner = WarmupRunner(on_hook_done=lambda name, seconds: done.append(name))
+    runner.register(lambda: None, name='first')
+    runner.register(FlakyHook(0), name='second')
+    assert runner.wait(5)
+    assert done == ['first', 'second']
+    assert not runner.has_failed()
+
+
+def test_no_hooks_is_ready():
+    assert WarmupRunner().is_ready()
+
+
+def test_failed_hook_is_retried():
+    hook = FlakyHook(2)
+    runner = WarmupRunner(max_attempts=3, retry_seconds=0.01)
+    runner.register(hook, name='flaky')
+    assert runner.wait(5)
+    assert hook.calls == 3
+
+
+def test_hook_that_keeps_failing():
+    hook = FlakyHook(10)
+    later = FlakyHook(0)
+    runner = WarmupRunner(max_attempts=2, retry_seconds=0.01)
+    runner.register(hook, name='broken')
+    runner.register(later, name='later')
+
+    assert not runner.wait(5)
+    assert runner.has_failed()
+    # The warm-up stops at the hook that failed.
+    assert (hook.calls, later.calls) == (2, 0)
+
+
+def test_forked_process_warms_up_again():
+    hook = FlakyHook(10)
+    runner = WarmupRunner(max_attempts=1)
+    runner.register(hook, name='broken')
+    assert not runner.wait(5) and runner.has_failed()
+
+    pid = os.fork()
+    if pid == 0:
+        # The child starts its own warm-up, with the parent's failure forgotten.
+        os._exit(0 if not runner.has_failed() and not runner.wait(5) and runner.has_failed() else 1)
+    _, exit_status = os.waitpid(pid, 0)
+    assert os.WEXITSTATUS(exit_status) == 0
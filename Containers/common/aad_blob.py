@@ -1,7 +1,8 @@
 # Copyright (c) Microsoft Corporation. All rights reserved.
 # Licensed under the MIT License.
+from azure.core.exceptions import ResourceNotFoundError
 from azure.identity import ClientSecretCredential, ManagedIdentityCredential
-from azure.storage.blob import BlobServiceClient, BlobClient
+from azure.storage.blob import BlobServiceClient, BlobClient, BlobBlock
 
 from datetime import datetime, timezone
 from email.utils import formatdate
@@ -10,23 +11,41 @@ import io
 import os
 from shutil import copyfile
 from pathlib import Path
+import threading
+import time
+import weakref
 import requests
+from requests.adapters import HTTPAdapter
+
+from blob_cache import fetch_with_blob_client
+from blob_transfer import DEFAULT_MAX_CONCURRENCY, DEFAULT_CHUNK_SIZE, ChunkIteratorReader, MemoryViewWriter, block_list_xml, download_into, download_to_file, read_response_into, upload_file_in_blocks
 
 CLIENT_SECRET_CRED_TYPE = "client_secret"
 MANAGED_IDENTITY_CRED_TYPE = "managed_identity"
 LOCAL_CRED_TYPE = "local"
 
+STORAGE_SCOPE = 'https://storage.azure.com/.default'
+# Refresh cached tokens this long before they expire, so requests never race an expiring token.
+TOKEN_REFRESH_MARGIN_SECONDS = int(os.getenv('AAD_TOKEN_REFRESH_MARGIN_SECONDS', '300'))
+# Number of pooled HTTP connections kept per storage account.
+HTTP_POOL_SIZE = int(os.getenv('AAD_BLOB_HTTP_POOL_SIZE', '16'))
+
+# Every AadBlob, so a forked child can drop the state it inherited from its parent.
+_instances = weakref.WeakSet()
+
 # There are 3 ways to use this class:
 #   1. ClientSecretCredential - provide aad_tenant_id, aad_application_id, aad_application_secret
 #   2. ManagedIdentityCredential - provide aad_application_id. Application must be a managed identity: https://docs.microsoft.com/en-us/azure/active-directory/managed-identities-azure-resources/overview
 #   3. Local - provide local_test_directory. Circumvents AAD for testing purposes only.
+# Pass a blob_cache.BlobCache as blob_cache to serve repeated reads from local disk.
 class AadBlob:
-    def __init__(self, aad_tenant_id=None, aad_application_id=None, aad_application_secret=None, aad_account_name=None, local_test_directory=None):
+    def __init__(self, aad_tenant_id=None, aad_application_id=None, aad_application_secret=None, aad_account_name=None, local_test_directory=None, blob_cache=None):
         self.aad_tenant_id = aad_tenant_id
         self.aad_application_id = aad_application_id
         self.aad_application_secret = aad_application_secret
         self.aad_account_name = aad_account_name
         self.local_test_directory=local_test_directory
+        self.blob_cache = blob_cache
 
         self.account_url="https://{}.blob.core.windows.net".format(self.aad_account_name)
 
@@ -37,27 +56,56 @@ class AadBlob:
             else:
                 self.credential_type = CLIENT_SECRET_CRED_TYPE
 
+        # The credential, token and clients are created on first use and reused for every call.
+        self._reset()
+        _instances.add(self)
+
+    def _reset(self):
+        # Also called in a forked child: the lock may have been held by another thread of the parent,
+        # and pooled connections and credentials must not be shared with the parent process.
+        self._lock = threading.Lock()
+        self._credential = None
+        self._access_token = None
+        self._blob_service_client = None
+        self._session = None
+
+    def _get_credential(self):
+        if self._credential is None:
+            if self.credential_type is MANAGED_IDENTITY_CRED_TYPE:
+                self._credential = ManagedIdentityCredential(client_id=self.aad_application_id)
+            else:
+                self._credential = ClientSecretCredential(
+                    self.aad_tenant_id,
+                    self.aad_application_id,
+                    self.aad_application_secret
+                )
+        return self._credential
+
     def _get_managed_identity_credential(self):
-        cred = ManagedIdentityCredential(client_id=self.aad_application_id)
-        return cred.get_token('https://storage.azure.com/.default').token
+        with self._lock:
+            if self._access_token is None or self._access_token.expires_on - time.time() < TOKEN_REFRESH_MARGIN_SECONDS:
+                self._access_token = self._get_credential().get_token(STORAGE_SCOPE)
+            return self._access_token.token
 
     def _get_blob_service_client(self):
-        token_credential = ClientSecretCredential(
-            self.aad_tenant_id,
-            self.aad_application_id,
-            self.aad_application_secret
-        )
+        with self._lock:
+            if self._blob_service_client is None:
+                # The client keeps its HTTP connection pool, and the credential caches and refreshes its token.
+                self._blob_service_client = BlobServiceClient(
+                    account_url=self.account_url,
+                    credential=self._get_credential()
+                )
+            return self._blob_service_client
+
+    def _get_session(self):
+        with self._lock:
+            if self._session is None:
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=HTTP_POOL_SIZE)
+                session.mount('https://', adapter)
+                self._session = session
+            return self._session
 
-        blob_service_client = BlobServiceClient(
-            account_url="https://{}.blob.core.windows.net".format(self.aad_account_name),
-            credential=token_credential
-        )
-
-        return blob_service_client
-
-
-
-    
     # Write Blobs............................
     def _upload_managed_identity_blob(self, container, blob, data):
         token_credential = self._get_managed_identity_credential()
@@ -70,19 +118,21 @@ class AadBlob:
                     'x-ms-blob-type': 'BlockBlob',
                     'Content-Length': str(len(data))}
 
-        r = requests.put(blob_uri, headers=headers, data=data)
+        r = self._get_session().put(blob_uri, headers=headers, data=data)
         r.raise_for_status()
         return r
 
     def _write_blob(self, container, blob, data):
         if self.credential_type is MANAGED_IDENTITY_CRED_TYPE:
             get_response = self._upload_managed_identity_blob(container, blob, data)
+            self._invalidate_cached_blob(container, blob)
             return get_response
 
         else: # CLIENT_SECRET_CRED_TYPE:
             blob_service_client = self._get_blob_service_client()
             blob_client = blob_service_client.get_blob_client(container, blob)
             blob_client.upload_blob(data, overwrite=True)
+            self._invalidate_cached_blob(container, blob)
 
     def write_blob_from_text(self, container, blob, text):
         print("{} for {}/{}".format('write_blob_from_text', container, blob))
@@ -98,24 +148,22 @@ class AadBlob:
             f = open(abosolute_file_name, 'w')
             f.write(text)
             f.close()
+            self._invalidate_cached_blob(container, blob)
             return abosolute_file_name
 
     def create_blob_from_path(self, container, blob, path):
         print("{} for {}/{}".format('create_blob_from_path', container, blob))
 
         if not self.credential_type is LOCAL_CRED_TYPE:
-            with open(path, "rb") as handle:
-                data = handle.read()
-                return self._write_blob(container, blob, data)
+            return self.upload_blob_from_path(container, blob, path)
 
         else: # LOCAL_CRED_TYPE
             abosolute_file_name = os.path.join(self.local_test_directory, container, blob)
             if not os.path.exists(os.path.dirname(abosolute_file_name)):
                 os.makedirs(os.path.dirname(abosolute_file_name))
 
-            f = open(abosolute_file_name, 'wb')
-            f.write(blob)
-            f.close()
+            copyfile(path, abosolute_file_name)
+            self._invalidate_cached_blob(container, blob)
             return abosolute_file_name
 
     # Get Blobs............................
@@ -127,7 +175,7 @@ class AadBlob:
                     'x-ms-version': '2019-07-07',
                     'x-ms-date': formatdate(timeval=None, localtime=False, usegmt=True)}
 
-        return requests.get(blob_uri, headers=headers)
+        return self._get_session().get(blob_uri, headers=headers)
 
     def _get_blob(self, container, blob, encoding = None):
         file_type = ('w' if encoding else 'wb')
@@ -145,7 +193,14 @@ class AadBlob:
 
     def save_blob_locally(self, container, blob, local_file, encoding = None):
         file_type = ('w' if encoding else 'wb')
-        if self.credential_type is MANAGED_IDENTITY_CRED_TYPE:
+        if self.blob_cache is not None:
+            copyfile(self.get_cached_blob_path(container, blob), local_file)
+
+        elif encoding is None and not self.credential_type is LOCAL_CRED_TYPE:
+            # Binary blobs are streamed to disk in parallel chunks.
+            self.download_blob_to_file(container, blob, local_file)
+
+        elif self.credential_type is MANAGED_IDENTITY_CRED_TYPE:
             with open(local_file, file_type) as open_file:
                 data = self._get_blob(container, blob, encoding)
                 open_file.write(data)
@@ -173,33 +228,36 @@ class AadBlob:
     def get_blob(self, container, blob):
         print("{} for {}/{}".format('get_blob', container, blob))
 
+        if self.blob_cache is not None:
+            return open(self.get_cached_blob_path(container, blob), 'rb')
+
         if self.credential_type is CLIENT_SECRET_CRED_TYPE:
             blob_service_client = self._get_blob_service_client()
             blob_client = blob_service_client.get_blob_client(container, blob)
 
-            with io.BytesIO() as output_stream:
-                download_stream = blob_client.download_blob()
-                download_stream.readinto(output_stream)
-                return output_stream
+            output_stream = io.BytesIO()
+            download_stream = blob_client.download_blob()
+            download_stream.readinto(output_stream)
+            output_stream.seek(0)
+            return output_stream
         else:
-            abosolute_file_name = os.path.join('.', container, blob)
-
-            if self.credential_type is MANAGED_IDENTITY_CRED_TYPE:
-                self.save_blob_locally(container, blob, abosolute_file_name)
-            else:
-                abosolute_file_name = os.path.join(self.local_test_directory, container, blob)
-
-            return open(abosolute_file_name)
+            return self.open_blob_stream(container, blob)
 
     def get_blob_to_bytes(self, container, blob):
         print("{} for {}/{}".format('get_blob_to_bytes', container, blob))
 
+        if self.blob_cache is not None:
+            with open(self.get_cached_blob_path(container, blob), 'rb') as f:
+                return f.read()
+
         if self.credential_type is MANAGED_IDENTITY_CRED_TYPE:
-            data = self._get_blob(container, blob)
+            # Ranged parallel download into a single preallocated buffer.
+            data = bytearray(self.get_blob_size(container, blob))
+            download_into(memoryview(data), len(data), self._get_range_reader(container, blob))
             return data
         elif self.credential_type is CLIENT_SECRET_CRED_TYPE:
             data = self._get_blob(container, blob)
-            return data.content_as_bytes()
+            return data.content_as_bytes(max_concurrency=DEFAULT_MAX_CONCURRENCY)
         else: # LOCAL_CRED_TYPE
             abosolute_file_name = os.path.join(self.local_test_directory, container, blob)
             f = open(abosolute_file_name, 'rb')
@@ -210,6 +268,10 @@ class AadBlob:
     def get_blob_to_text(self, container, blob):
         print("{} for {}/{}".format('get_blob_to_text', container, blob))
 
+        if self.blob_cache is not None:
+            with open(self.get_cached_blob_path(container, blob), 'r', encoding='UTF-8') as f:
+                return f.read()
+
         if self.credential_type is MANAGED_IDENTITY_CRED_TYPE:
             data = self._get_blob(container, blob, encoding='UTF-8')
             return data
@@ -225,25 +287,226 @@ class AadBlob:
             return txt
 
 
+    # Streaming and parallel transfers............................
+    def _get_managed_identity_headers(self):
+        return { 'Authorization': "Bearer " + self._get_managed_identity_credential(),
+                 'x-ms-version': '2019-07-07',
+                 'x-ms-date': formatdate(timeval=None, localtime=False, usegmt=True)}
+
+    def _get_local_blob_path(self, container, blob):
+        return os.path.join(self.local_test_directory, container, blob)
+
+    def get_blob_size(self, container, blob):
+        if self.credential_type is MANAGED_IDENTITY_CRED_TYPE:
+            r = self._get_session().head(self.get_blob_uri(container, blob), headers=self._get_managed_identity_headers())
+            r.raise_for_status()
+            return int(r.headers['Content-Length'])
+
+        elif self.credential_type is CLIENT_SECRET_CRED_TYPE:
+            blob_client = self._get_blob_service_client().get_blob_client(container, blob)
+            return blob_client.get_blob_properties().size
+
+        else: # LOCAL_CRED_TYPE
+            return os.path.getsize(self._get_local_blob_path(container, blob))
+
+    def _get_range_reader(self, container, blob):
+        # Returns a function that fills a memoryview with the blob bytes starting at offset.
+        if self.credential_type is MANAGED_IDENTITY_CRED_TYPE:
+            blob_uri = self.get_blob_uri(container, blob)
+
+            def read_range_into(offset, view):
+                headers = self._get_managed_identity_headers()
+                headers['x-ms-range'] = 'bytes={}-{}'.format(offset, offset + len(view) - 1)
+                with self._get_session().get(blob_uri, headers=headers, stream=True) as r:
+                    r.raise_for_status()
+                    read_response_into(r, view)
+
+        elif self.credential_type is CLIENT_SECRET_CRED_TYPE:
+            blob_client = self._get_blob_service_client().get_blob_client(container, blob)
+
+            def read_range_into(offset, view):
+                blob_client.download_blob(offset=offset, length=len(view)).readinto(MemoryViewWriter(view))
+
+        else: # LOCAL_CRED_TYPE
+            local_path = self._get_local_blob_path(container, blob)
+
+            def read_range_into(offset, view):
+                with open(local_path, 'rb') as f:
+                    f.seek(offset)
+                    f.readinto(view)
+
+        return read_range_into
+
+    def download_blob_to_file(self, container, blob, local_file, max_concurrency=DEFAULT_MAX_CONCURRENCY, chunk_size=DEFAULT_CHUNK_SIZE):
+        """Downloads a blob to local_file with up to max_concurrency ranged requests of chunk_size bytes."""
+        print("{} for {}/{}".format('download_blob_to_file', container, blob))
+
+        if self.credential_type is LOCAL_CRED_TYPE:
+            copyfile(self._get_local_blob_path(container, blob), local_file)
+            return
+
+        size = self.get_blob_size(container, blob)
+        download_to_file(local_file, size, self._get_range_reader(container, blob), max_concurrency, chunk_size)
+
+    def download_blob_into(self, container, blob, buffer, max_concurrency=DEFAULT_MAX_CONCURRENCY, chunk_size=DEFAULT_CHUNK_SIZE):
+        """Downloads a blob into a caller-supplied writable buffer (for example a bytearray). Returns the blob size."""
+        print("{} for {}/{}".format('download_blob_into', container, blob))
+
+        size = self.get_blob_size(container, blob)
+        download_into(memoryview(buffer).cast('B'), size, self._get_range_reader(container, blob), max_concurrency, chunk_size)
+        return size
+
+    def iter_blob_chunks(self, container, blob, chunk_size=DEFAULT_CHUNK_SIZE):
+        """Yields the blob contents as bytes chunks over a single streamed request."""
+        if self.credential_type is MANAGED_IDENTITY_CRED_TYPE:
+            with self._get_session().get(self.get_blob_uri(container, blob), headers=self._get_managed_identity_headers(), stream=True) as r:
+                r.raise_for_status()
+                for chunk in r.iter_content(chunk_size):
+                    yield chunk
+
+        elif self.credential_type is CLIENT_SECRET_CRED_TYPE:
+            blob_client = self._get_blob_service_client().get_blob_client(container, blob)
+            for chunk in blob_client.download_blob().chunks():
+                yield chunk
+
+        else: # LOCAL_CRED_TYPE
+            with open(self._get_local_blob_path(container, blob), 'rb') as f:
+                for chunk in iter(lambda: f.read(chunk_size), b''):
+                    yield chunk
+
+    def open_blob_stream(self, container, blob, chunk_size=DEFAULT_CHUNK_SIZE):
+        """Returns a read-only file-like object that streams the blob."""
+        if self.credential_type is LOCAL_CRED_TYPE:
+            return open(self._get_local_blob_path(container, blob), 'rb')
+        return io.BufferedReader(ChunkIteratorReader(self.iter_blob_chunks(container, blob, chunk_size)))
+
+    def upload_blob_from_path(self, container, blob, path, max_concurrency=DEFAULT_MAX_CONCURRENCY, block_size=DEFAULT_CHUNK_SIZE):
+        """Uploads a local file as blocks of block_size bytes, with up to max_concurrency blocks in flight."""
+        print("{} for {}/{}".format('upload_blob_from_path', container, blob))
+
+        if self.credential_type is MANAGED_IDENTITY_CRED_TYPE:
+            blob_uri = self.get_blob_uri(container, blob)
+
+            def put_block(block_id, data):
+                r = self._get_session().put(blob_uri, params={'comp': 'block', 'blockid': block_id}, headers=self._get_managed_identity_headers(), data=data)
+                r.raise_for_status()
+
+            def commit_blocks(block_ids):
+                r = self._get_session().put(blob_uri, params={'comp': 'blocklist'}, headers=self._get_managed_identity_headers(), data=block_list_xml(block_ids))
+                r.raise_for_status()
+
+        elif self.credential_type is CLIENT_SECRET_CRED_TYPE:
+            blob_client = self._get_blob_service_client().get_blob_client(container, blob)
+
+            def put_block(block_id, data):
+                blob_client.stage_block(block_id, data)
+
+            def commit_blocks(block_ids):
+                blob_client.commit_block_list([BlobBlock(block_id=block_id) for block_id in block_ids])
+
+        else: # LOCAL_CRED_TYPE
+            return self.create_blob_from_path(container, blob, path)
+
+        upload_file_in_blocks(path, put_block, commit_blocks, max_concurrency, block_size)
+        self._invalidate_cached_blob(container, blob)
+
+    def read_blob_range(self, container, blob, offset, length):
+        """Returns length bytes of the blob starting at offset, in a single ranged request."""
+        buffer = bytearray(length)
+        self._get_range_reader(container, blob)(offset, memoryview(buffer))
+        return buffer
+
+    def delete_blob(self, container, blob):
+        """Deletes a blob. Returns False if the blob did not exist."""
+        print("{} for {}/{}".format('delete_blob', container, blob))
+
+        if self.credential_type is MANAGED_IDENTITY_CRED_TYPE:
+            r = self._get_session().delete(self.get_blob_uri(container, blob), headers=self._get_managed_identity_headers())
+            if r.status_code == 404:
+                return False
+            r.raise_for_status()
+
+        elif self.credential_type is CLIENT_SECRET_CRED_TYPE:
+            try:
+                self._get_blob_service_client().get_blob_client(container, blob).delete_blob()
+            except ResourceNotFoundError:
+                return False
+
+        else: # LOCAL_CRED_TYPE
+            try:
+                os.remove(self._get_local_blob_path(container, blob))
+            except FileNotFoundError:
+                return False
+
+        self._invalidate_cached_blob(container, blob)
+        return True
+
+    # Cached reads............................
+    def _get_cache_key(self, container, blob):
+        if self.credential_type is LOCAL_CRED_TYPE:
+            return '{}/{}/{}'.format(os.path.abspath(self.local_test_directory), container, blob)
+        return '{}/{}/{}'.format(self.account_url, container, blob)
+
+    def _invalidate_cached_blob(self, container, blob):
+        if self.blob_cache is not None:
+            self.blob_cache.invalidate(self._get_cache_key(container, blob))
+
+    def _get_cache_fetch(self, container, blob):
+        if self.credential_type is MANAGED_IDENTITY_CRED_TYPE:
+            blob_uri = self.get_blob_uri(container, blob)
+
+            def fetch(etag, destination_path):
+                headers = self._get_managed_identity_headers()
+                if etag is not None:
+                    headers['If-None-Match'] = etag
+                with self._get_session().get(blob_uri, headers=headers, stream=True) as r:
+                    if r.status_code == 304:
+                        return None
+                    r.raise_for_status()
+                    with open(destination_path, 'wb') as f:
+                        for chunk in r.iter_content(DEFAULT_CHUNK_SIZE):
+                            f.write(chunk)
+                    return r.headers['ETag']
+            return fetch
+
+        elif self.credential_type is CLIENT_SECRET_CRED_TYPE:
+            return fetch_with_blob_client(self._get_blob_service_client().get_blob_client(container, blob))
+
+        else: # LOCAL_CRED_TYPE
+            local_path = self._get_local_blob_path(container, blob)
+
+            def fetch(etag, destination_path):
+                stat = os.stat(local_path)
+                local_etag = '"{}-{}"'.format(stat.st_mtime_ns, stat.st_size)
+                if local_etag == etag:
+                    return None
+                copyfile(local_path, destination_path)
+                return local_etag
+            return fetch
+
+    def get_cached_blob_path(self, container, blob):
+        """Returns the path of an up-to-date copy of the blob in blob_cache, downloading it only if it changed."""
+        if self.blob_cache is None:
+            raise ValueError('This AadBlob was created without a blob_cache.')
+        return self.blob_cache.get_path(self._get_cache_key(container, blob), self._get_cache_fetch(container, blob))
+
     # Helpers............................
     def does_blob_exist(self, container, blob):
         if self.credential_type is MANAGED_IDENTITY_CRED_TYPE:
             token_credential = self._get_managed_identity_credential()
-            
-            container_uri = "{}/{}?restype=container&comp=list&prefix{}".format(self.account_url, container, blob)
 
             headers = { 'Authorization': "Bearer " + token_credential,
                         'x-ms-version': '2019-07-07',
                         'x-ms-date': formatdate(timeval=None, localtime=False, usegmt=True)}
 
-            blobs = requests.get(container_uri, headers=headers).json()
-            if (len(blobs['Blobs']) > 0):
-                return True
-            else:
+            r = self._get_session().head(self.get_blob_uri(container, blob), headers=headers)
+            if r.status_code == 404:
                 return False
+            r.raise_for_status()
+            return True
 
         elif self.credential_type is CLIENT_SECRET_CRED_TYPE:
-            service = self._get_service()
+            service = self._get_blob_service_client()
             cc = service.get_container_client(container)
             blob_list = cc.list_blobs(name_starts_with=blob)
             for b in blob_list:
@@ -263,3 +526,11 @@ class AadBlob:
         else:
             return os.path.join(self.local_test_directory, container, blob)
 
+
+def _reset_after_fork():
+    for instance in list(_instances):
+        instance._reset()
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_after_fork)
+
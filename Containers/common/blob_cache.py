@@ -0,0 +1,298 @@
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License.
+# On-disk cache for blobs that are read over and over, such as lookup tables and model weights.
+import fcntl
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+from concurrent.futures import Future
+
+from azure.core import MatchConditions
+from azure.core.exceptions import ResourceNotModifiedError
+
+from blob_transfer import DEFAULT_MAX_CONCURRENCY
+
+BLOB_CACHE_DIR = os.getenv('BLOB_CACHE_DIR', os.path.join(tempfile.gettempdir(), 'ai4e_blob_cache'))
+BLOB_CACHE_MAX_BYTES = int(os.getenv('BLOB_CACHE_MAX_BYTES', str(1024 * 1024 * 1024)))
+# Seconds a cached copy is served without asking storage whether it changed. 0 revalidates on every read.
+# A read with a different SAS token than the one that last validated the copy always revalidates.
+BLOB_CACHE_REVALIDATE_SECONDS = float(os.getenv('BLOB_CACHE_REVALIDATE_SECONDS', '0'))
+
+
+class BlobCache:
+    """Caches blobs in a local directory, keyed by account/container/blob and ETag.
+
+    Callers supply fetch(etag, destination_path). It must make a conditional request
+    with If-None-Match: etag (when etag is not None). It returns None if the blob is
+    unchanged, or otherwise writes the blob to destination_path and returns the new ETag.
+
+    Each cached version is stored in a file named after the hash of its key and ETag.
+    When the total size exceeds max_size_bytes, the least recently used files are
+    evicted. Concurrent reads of the same key make only one request: threads of
+    a process wait on the first caller, and processes sharing the directory wait
+    on an flock for the key.
+    """
+    def __init__(self, cache_dir=BLOB_CACHE_DIR, max_size_bytes=BLOB_CACHE_MAX_BYTES, revalidate_seconds=BLOB_CACHE_REVALIDATE_SECONDS):
+        self.cache_dir = cache_dir
+        self.max_size_bytes = max_size_bytes
+        self.revalidate_seconds = revalidate_seconds
+        os.makedirs(cache_dir, exist_ok=True)
+
+        self._lock = threading.Lock()
+        self._in_flight = {}
+        self._stats = {'hits': 0, 'misses': 0, 'revalidations': 0, 'evictions': 0, 'bytes_downloaded': 0}
+
+    def get_stats(self):
+        """Returns hit, miss, revalidation and eviction counts for this process."""
+        with self._lock:
+            return dict(self._stats)
+
+    def get_path(self, key, fetch, credential=None):
+        """Returns the path of an up-to-date local copy of the blob identified by key.
+
+        credential identifies the access used for fetch, such as a SAS token. A copy
+        that was last validated with a different credential is always revalidated, even
+        within revalidate_seconds, so an expired or read-less token gets the storage
+        error instead of the cached bytes.
+
+        The file may be evicted later by another reader, so open it right away.
+        """
+        credential_hash = hashlib.sha256(credential.encode('utf-8')).hexdigest() if credential is not None else None
+        # Only callers with the same credential share a request.
+        in_flight_key = (key, credential_hash)
+        with self._lock:
+            future = self._in_flight.get(in_flight_key)
+            is_leader = future is None
+            if is_leader:
+                future = Future()
+                self._in_flight[in_flight_key] = future
+
+        if not is_leader:
+            # Waiters count as whatever the request they waited on was.
+            path, hit = future.result()
+            self._count('hits' if hit else 'misses')
+            return path
+
+        try:
+            path, hit = self._get_path_locked(key, fetch, credential_hash)
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result((path, hit))
+            return path
+        finally:
+            with self._lock:
+                self._in_flight.pop(in_flight_key, None)
+
+    def invalidate(self, key):
+        """Forgets the cached copy of key, for example after the blob was overwritten."""
+        with self._key_lock(key):
+            meta = self._read_meta(key)
+            if meta is not None:
+                _remove(self._meta_path(key))
+                _remove(os.path.join(self.cache_dir, meta['data']))
+
+    def _get_path_locked(self, key, fetch, credential_hash):
+        # Returns the path and whether it was served without a download.
+        with self._key_lock(key):
+            meta = self._read_meta(key)
+            data_path = os.path.join(self.cache_dir, meta['data']) if meta else None
+            if data_path is None or not os.path.exists(data_path):
+                meta = None
+
+            if meta is not None and time.time() - meta['validated'] < self.revalidate_seconds and meta.get('credential') == credential_hash:
+                self._count('hits')
+                os.utime(data_path)
+                return data_path, True
+
+            fd, temp_path = tempfile.mkstemp(prefix='download_', suffix='.tmp', dir=self.cache_dir)
+            os.close(fd)
+            try:
+                etag = fetch(meta['etag'] if meta else None, temp_path)
+                if etag is None:
+                    # Not modified.
+                    self._count('hits')
+                    self._count('revalidations')
+                    meta['validated'] = time.time()
+                    meta['credential'] = credential_hash
+                    self._write_meta(key, meta)
+                    os.utime(data_path)
+                    return data_path, True
+
+                self._count('misses')
+                size = os.path.getsize(temp_path)
+                with self._lock:
+                    self._stats['bytes_downloaded'] += size
+                new_data = hashlib.sha256('{}\n{}'.format(key, etag).encode('utf-8')).hexdigest() + '.blob'
+                new_path = os.path.join(self.cache_dir, new_data)
+                os.replace(temp_path, new_path)
+            finally:
+                _remove(temp_path)
+
+            self._write_meta(key, {'key': key, 'etag': etag, 'data': new_data, 'validated': time.time(), 'credential': credential_hash})
+            if meta is not None and meta['data'] != new_data:
+                _remove(data_path)
+
+        self._evict(keep=new_path)
+        return new_path, False
+
+    def _evict(self, keep):
+        # A key is cached as a data file, a .json metadata file and a .lock file, which are evicted together.
+        entries = []
+        referenced = set()
+        with os.scandir(self.cache_dir) as it:
+            files = [(entry.name, entry.path) for entry in it]
+
+        for name, path in files:
+            if not name.endswith('.json'):
+                continue
+            meta = _read_json(path)
+            if meta is None:
+                continue
+            data_path = os.path.join(self.cache_dir, meta['data'])
+            referenced.add(data_path)
+            try:
+                meta_stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            try:
+                data_stat = os.stat(data_path)
+                entries.append((data_stat.st_mtime, data_stat.st_size + meta_stat.st_size, data_path, meta['key']))
+            except FileNotFoundError:
+                entries.append((meta_stat.st_mtime, meta_stat.st_size, data_path, meta['key']))
+
+        for name, path in files:
+            # Data files that no metadata refers to.
+            if name.endswith('.blob') and path not in referenced:
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path, None))
+
+        total = sum(size for _, size, _, _ in entries)
+        entries.sort(key=lambda entry: entry[0])
+        for _, size, data_path, key in entries:
+            if total <= self.max_size_bytes:
+                break
+            if data_path == keep:
+                continue
+            if key is None:
+                _remove(data_path)
+            elif not self._evict_key(key, data_path):
+                continue
+            total -= size
+            self._count('evictions')
+
+    def _evict_key(self, key, data_path):
+        # Keys that are being read are skipped rather than waited for.
+        lock = self._key_lock(key)
+        if not lock.acquire(blocking=False):
+            return False
+        try:
+            meta = self._read_meta(key)
+            if meta is None or os.path.join(self.cache_dir, meta['data']) != data_path:
+                # Updated since the directory was scanned.
+                return False
+            _remove(data_path)
+            _remove(self._meta_path(key))
+            _remove(lock.path)
+            return True
+        finally:
+            lock.release()
+
+    def _count(self, name):
+        with self._lock:
+            self._stats[name] += 1
+
+    def _key_hash(self, key):
+        return hashlib.sha256(key.encode('utf-8')).hexdigest()
+
+    def _meta_path(self, key):
+        return os.path.join(self.cache_dir, self._key_hash(key) + '.json')
+
+    def _read_meta(self, key):
+        return _read_json(self._meta_path(key))
+
+    def _write_meta(self, key, meta):
+        fd, temp_path = tempfile.mkstemp(suffix='.tmp', dir=self.cache_dir)
+        with os.fdopen(fd, 'w') as f:
+            json.dump(meta, f)
+        os.replace(temp_path, self._meta_path(key))
+
+    def _key_lock(self, key):
+        return _FileLock(os.path.join(self.cache_dir, self._key_hash(key) + '.lock'))
+
+
+class _FileLock:
+    """An flock on a lock file, which its holder may remove when the key is evicted."""
+    def __init__(self, path):
+        self.path = path
+        self._fd = None
+
+    def acquire(self, blocking=True):
+        while True:
+            fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                os.close(fd)
+                return False
+
+            try:
+                is_current = os.stat(self.path).st_ino == os.fstat(fd).st_ino
+            except FileNotFoundError:
+                is_current = False
+            if is_current:
+                self._fd = fd
+                return True
+            # The file was removed while we waited for it, so lock the one that replaced it.
+            os.close(fd)
+
+    def release(self):
+        fcntl.flock(self._fd, fcntl.LOCK_UN)
+        os.close(self._fd)
+        self._fd = None
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *args):
+        self.release()
+
+
+def _read_json(path):
+    try:
+        with open(path, 'r') as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def fetch_with_blob_client(blob_client, max_concurrency=DEFAULT_MAX_CONCURRENCY):
+    """Returns a BlobCache fetch function that downloads through an Azure SDK BlobClient."""
+    def fetch(etag, destination_path):
+        try:
+            if etag is None:
+                downloader = blob_client.download_blob(max_concurrency=max_concurrency)
+            else:
+                downloader = blob_client.download_blob(etag=etag, match_condition=MatchConditions.IfModified, max_concurrency=max_concurrency)
+        except ResourceNotModifiedError:
+            return None
+
+        with open(destination_path, 'wb') as f:
+            downloader.readinto(f)
+        return downloader.properties.etag
+    return fetch
@@ -0,0 +1,134 @@
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License.
+# Helpers shared by AadBlob and SasBlob for chunked, parallel blob transfers that
+# write straight into a file or caller-supplied buffer.
+import base64
+from concurrent.futures import ThreadPoolExecutor
+import io
+import mmap
+import os
+
+DEFAULT_MAX_CONCURRENCY = int(os.getenv('BLOB_MAX_CONCURRENCY', '4'))
+DEFAULT_CHUNK_SIZE = int(os.getenv('BLOB_CHUNK_SIZE', str(4 * 1024 * 1024)))
+
+
+class MemoryViewWriter(io.RawIOBase):
+    """A writable stream that fills a fixed memoryview, for SDK calls that write into a stream."""
+    def __init__(self, view):
+        super().__init__()
+        self._view = view
+        self._position = 0
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        count = len(b)
+        self._view[self._position:self._position + count] = b
+        self._position += count
+        return count
+
+    def tell(self):
+        return self._position
+
+
+class ChunkIteratorReader(io.RawIOBase):
+    """A read-only stream over an iterator of bytes chunks. Wrap in io.BufferedReader for efficient small reads."""
+    def __init__(self, chunks):
+        super().__init__()
+        self._chunks = iter(chunks)
+        self._pending = memoryview(b'')
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while not self._pending:
+            try:
+                self._pending = memoryview(next(self._chunks))
+            except StopIteration:
+                return 0
+        count = min(len(b), len(self._pending))
+        b[:count] = self._pending[:count]
+        self._pending = self._pending[count:]
+        return count
+
+
+def iter_ranges(size, chunk_size):
+    """Yields (offset, length) pairs covering size bytes."""
+    for offset in range(0, size, chunk_size):
+        yield offset, min(chunk_size, size - offset)
+
+
+def download_into(view, size, read_range_into, max_concurrency=DEFAULT_MAX_CONCURRENCY, chunk_size=DEFAULT_CHUNK_SIZE):
+    """Fills view[:size] by calling read_range_into(offset, view_slice) for each chunk, in parallel.
+
+    read_range_into must fill the whole slice it is given.
+    """
+    if len(view) < size:
+        raise ValueError('Buffer of {} bytes is too small for a blob of {} bytes.'.format(len(view), size))
+
+    ranges = list(iter_ranges(size, chunk_size))
+    if len(ranges) <= 1 or max_concurrency <= 1:
+        for offset, length in ranges:
+            read_range_into(offset, view[offset:offset + length])
+        return
+
+    with ThreadPoolExecutor(max_workers=min(max_concurrency, len(ranges))) as executor:
+        futures = [executor.submit(read_range_into, offset, view[offset:offset + length]) for offset, length in ranges]
+        for future in futures:
+            future.result()
+
+
+def download_to_file(local_file, size, read_range_into, max_concurrency=DEFAULT_MAX_CONCURRENCY, chunk_size=DEFAULT_CHUNK_SIZE):
+    """Downloads size bytes into local_file through a memory map, so chunks land in the page cache directly."""
+    with open(local_file, 'w+b') as f:
+        if size == 0:
+            return
+        f.truncate(size)
+        with mmap.mmap(f.fileno(), size) as mapped:
+            view = memoryview(mapped)
+            try:
+                download_into(view, size, read_range_into, max_concurrency, chunk_size)
+            finally:
+                view.release()
+
+
+def read_response_into(response, view):
+    """Reads a streamed requests response into view until it is full."""
+    position = 0
+    while position < len(view):
+        count = response.raw.readinto(view[position:])
+        if not count:
+            raise IOError('Blob download ended after {} of {} bytes.'.format(position, len(view)))
+        position += count
+
+
+def upload_file_in_blocks(path, put_block, commit_blocks, max_concurrency=DEFAULT_MAX_CONCURRENCY, block_size=DEFAULT_CHUNK_SIZE):
+    """Uploads a file as blocks in parallel, then commits the block list.
+
+    put_block(block_id, data) uploads one block and commit_blocks(block_ids) commits
+    them in order. At most max_concurrency blocks are held in memory at once.
+    """
+    size = os.path.getsize(path)
+    ranges = list(iter_ranges(size, block_size))
+    block_ids = [base64.b64encode('{:08d}'.format(i).encode('utf-8')).decode('utf-8') for i in range(len(ranges))]
+
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        def upload_block(index):
+            offset, length = ranges[index]
+            put_block(block_ids[index], os.pread(fd, length, offset))
+
+        with ThreadPoolExecutor(max_workers=max(1, min(max_concurrency, len(ranges)))) as executor:
+            for future in [executor.submit(upload_block, i) for i in range(len(ranges))]:
+                future.result()
+    finally:
+        os.close(fd)
+
+    commit_blocks(block_ids)
+
+
+def block_list_xml(block_ids):
+    return '<?xml version="1.0" encoding="utf-8"?><BlockList>{}</BlockList>'.format(
+        ''.join('<Latest>{}</Latest>'.format(block_id) for block_id in block_ids))
@@ -6,9 +6,16 @@ from datetime import datetime, timedelta
 from urllib.parse import urlsplit, urlparse
 
 from azure.identity import ClientSecretCredential
-from azure.storage.blob import BlobServiceClient, generate_container_sas, ContainerSasPermissions, ContainerClient, BlobClient
+from azure.storage.blob import BlobServiceClient, generate_container_sas, ContainerSasPermissions, ContainerClient, BlobClient, BlobBlock
 
+from blob_cache import fetch_with_blob_client
+from blob_transfer import DEFAULT_MAX_CONCURRENCY, DEFAULT_CHUNK_SIZE, ChunkIteratorReader, MemoryViewWriter, download_into, download_to_file, upload_file_in_blocks
+
+# Pass a blob_cache.BlobCache as blob_cache to serve repeated reads from local disk.
 class SasBlob:
+    def __init__(self, blob_cache=None):
+        self.blob_cache = blob_cache
+
     def _get_resource_reference(self, prefix):
         return '{}{}'.format(prefix, str(uuid.uuid4()).replace('-', ''))
 
@@ -68,6 +75,7 @@ class SasBlob:
         blob_client = container_client.get_blob_client(blob_name)
 
         blob_client.upload_blob(input_bytes, overwrite=True)
+        self._invalidate_cached(container_sas_uri, blob_name)
         
         account_name = self.get_account_from_uri(container_sas_uri)
         container_name = self.get_container_from_uri(container_sas_uri)
@@ -78,6 +86,7 @@ class SasBlob:
         container_client = ContainerClient.from_container_url(container_sas_uri)
         blob_client = container_client.get_blob_client(blob_name)
         blob_client.upload_blob(text, overwrite=True)
+        self._invalidate_cached(container_sas_uri, blob_name)
 
         account_name = self.get_account_from_uri(container_sas_uri)
         container_name = self.get_container_from_uri(container_sas_uri)
@@ -88,6 +97,7 @@ class SasBlob:
         container_client = ContainerClient.from_container_url(container_sas_uri)
         blob_client = container_client.get_blob_client(blob_name)
         blob_client.upload_blob(input_stream, overwrite=True)
+        self._invalidate_cached(container_sas_uri, blob_name)
         
         account_name = self.get_account_from_uri(container_sas_uri)
         container_name = self.get_container_from_uri(container_sas_uri)
@@ -95,12 +105,75 @@ class SasBlob:
         return 'https://{}.blob.core.windows.net/{}/{}?{}'.format(account_name, container_name, blob_name, sas_key)
 
     def get_blob(self, sas_uri):
+        if self.blob_cache is not None:
+            return open(self.get_cached_path(sas_uri), 'rb')
+
         blob_client = BlobClient.from_blob_url(sas_uri)
         download_stream = blob_client.download_blob()
 
-        with io.BytesIO() as output_stream:
-            download_stream.readinto(output_stream)
-            return output_stream
+        output_stream = io.BytesIO()
+        download_stream.readinto(output_stream)
+        output_stream.seek(0)
+        return output_stream
+
+    def _get_range_reader(self, blob_client):
+        def read_range_into(offset, view):
+            blob_client.download_blob(offset=offset, length=len(view)).readinto(MemoryViewWriter(view))
+        return read_range_into
+
+    def download_to_file(self, sas_uri, local_file, max_concurrency=DEFAULT_MAX_CONCURRENCY, chunk_size=DEFAULT_CHUNK_SIZE):
+        """Downloads a blob to local_file with up to max_concurrency ranged requests of chunk_size bytes."""
+        blob_client = BlobClient.from_blob_url(sas_uri)
+        size = blob_client.get_blob_properties().size
+        download_to_file(local_file, size, self._get_range_reader(blob_client), max_concurrency, chunk_size)
+
+    def download_into(self, sas_uri, buffer, max_concurrency=DEFAULT_MAX_CONCURRENCY, chunk_size=DEFAULT_CHUNK_SIZE):
+        """Downloads a blob into a caller-supplied writable buffer (for example a bytearray). Returns the blob size."""
+        blob_client = BlobClient.from_blob_url(sas_uri)
+        size = blob_client.get_blob_properties().size
+        download_into(memoryview(buffer).cast('B'), size, self._get_range_reader(blob_client), max_concurrency, chunk_size)
+        return size
+
+    def iter_chunks(self, sas_uri):
+        """Yields the blob contents as bytes chunks over a single streamed download."""
+        blob_client = BlobClient.from_blob_url(sas_uri)
+        for chunk in blob_client.download_blob().chunks():
+            yield chunk
+
+    def open_stream(self, sas_uri):
+        """Returns a read-only file-like object that streams the blob."""
+        return io.BufferedReader(ChunkIteratorReader(self.iter_chunks(sas_uri)))
+
+    def upload_from_path(self, container_sas_uri, blob_name, path, max_concurrency=DEFAULT_MAX_CONCURRENCY, block_size=DEFAULT_CHUNK_SIZE):
+        """Uploads a local file as blocks of block_size bytes, with up to max_concurrency blocks in flight."""
+        container_client = ContainerClient.from_container_url(container_sas_uri)
+        blob_client = container_client.get_blob_client(blob_name)
+
+        upload_file_in_blocks(
+            path,
+            lambda block_id, data: blob_client.stage_block(block_id, data),
+            lambda block_ids: blob_client.commit_block_list([BlobBlock(block_id=block_id) for block_id in block_ids]),
+            max_concurrency,
+            block_size)
+        self._invalidate_cached(container_sas_uri, blob_name)
+
+        return self.get_blob_sas_uri(container_sas_uri, blob_name)
+
+    def get_cached_path(self, sas_uri):
+        """Returns the path of an up-to-date copy of the blob in blob_cache, downloading it only if it changed."""
+        if self.blob_cache is None:
+            raise ValueError('This SasBlob was created without a blob_cache.')
+        key = self._get_cache_key(sas_uri, urlsplit(sas_uri).path[1:].split('/', 1)[1])
+        # A copy validated with another token is revalidated, so this token must still grant read access.
+        return self.blob_cache.get_path(key, fetch_with_blob_client(BlobClient.from_blob_url(sas_uri)), credential=self.get_sas_key_from_uri(sas_uri))
+
+    def _get_cache_key(self, sas_uri, blob_name):
+        # The SAS token is not part of the key, so every token for the same blob shares one copy.
+        return '{}/{}/{}'.format(self.get_account_from_uri(sas_uri), self.get_container_from_uri(sas_uri), blob_name)
+
+    def _invalidate_cached(self, container_sas_uri, blob_name):
+        if self.blob_cache is not None:
+            self.blob_cache.invalidate(self._get_cache_key(container_sas_uri, blob_name))
 
     def save_local_text(self, sas_uri, local_file):
         blob_client = BlobClient.from_blob_url(sas_uri)
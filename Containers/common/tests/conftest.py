@@ -0,0 +1,9 @@
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License.
+# Shared setup for the blob helper tests. Run them from the repository root with:
+#   python -m pytest Containers/common/tests
+import os
+import sys
+
+_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..', '..'))
+sys.path.insert(0, os.path.join(_ROOT, 'Containers', 'common'))
@@ -0,0 +1,82 @@
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License.
+import os
+import time
+from types import SimpleNamespace
+
+import pytest
+
+pytest.importorskip('azure.identity')
+pytest.importorskip('azure.storage.blob')
+pytest.importorskip('adal')
+
+from aad_blob import AadBlob, TOKEN_REFRESH_MARGIN_SECONDS
+
+
+class FakeCredential:
+    def __init__(self, lifetime):
+        self.lifetime = lifetime
+        self.token_count = 0
+
+    def get_token(self, scope):
+        self.token_count += 1
+        return SimpleNamespace(token='token-{}'.format(self.token_count), expires_on=time.time() + self.lifetime)
+
+
+@pytest.fixture
+def client_secret_blob():
+    return AadBlob('tenant', 'application', 'secret', 'account')
+
+
+def test_clients_are_reused(client_secret_blob):
+    assert client_secret_blob._get_session() is client_secret_blob._get_session()
+    assert client_secret_blob._get_blob_service_client() is client_secret_blob._get_blob_service_client()
+    assert client_secret_blob._get_credential() is client_secret_blob._get_credential()
+
+
+def test_token_is_cached_until_it_nearly_expires(client_secret_blob):
+    credential = FakeCredential(lifetime=TOKEN_REFRESH_MARGIN_SECONDS + 60)
+    client_secret_blob._credential = credential
+    assert client_secret_blob._get_managed_identity_credential() == 'token-1'
+    assert client_secret_blob._get_managed_identity_credential() == 'token-1'
+
+    credential.lifetime = TOKEN_REFRESH_MARGIN_SECONDS - 60
+    client_secret_blob._access_token = None
+    assert client_secret_blob._get_managed_identity_credential() == 'token-2'
+    # The new token expires within the margin, so it is refreshed on the next call.
+    assert client_secret_blob._get_managed_identity_credential() == 'token-3'
+
+
+def test_state_is_reset_after_fork(client_secret_blob):
+    session = client_secret_blob._get_session()
+    client_secret_blob._get_blob_service_client()
+    client_secret_blob._credential = FakeCredential(lifetime=3600)
+    client_secret_blob._get_managed_identity_credential()
+    # A lock held by another thread at fork time would otherwise stay locked in the child.
+    client_secret_blob._lock.acquire()
+
+    pid = os.fork()
+    if pid == 0:
+        blob = client_secret_blob
+        reset = (blob._credential is None and blob._access_token is None and blob._blob_service_client is None
+                 and blob._session is None and blob._get_session() is not session)
+        os._exit(0 if reset else 1)
+    _, exit_status = os.waitpid(pid, 0)
+    client_secret_blob._lock.release()
+
+    assert os.WEXITSTATUS(exit_status) == 0
+    # The parent keeps its state.
+    assert client_secret_blob._get_session() is session
+    assert client_secret_blob._access_token is not None
+
+
+def test_local_blobs(tmp_path):
+    blob = AadBlob(local_test_directory=str(tmp_path))
+    blob.write_blob_from_text('container', 'dir/a.txt', 'hello')
+    assert blob.does_blob_exist('container', 'dir/a.txt')
+    assert blob.get_blob_to_text('container', 'dir/a.txt') == 'hello'
+    assert blob.get_blob_to_bytes('container', 'dir/a.txt') == b'hello'
+    assert blob.read_blob_range('container', 'dir/a.txt', 1, 3) == b'ell'
+    assert blob.delete_blob('container', 'dir/a.txt')
+    assert not blob.delete_blob('container', 'dir/a.txt')
+    assert not blob.does_blob_exist('container', 'dir/a.txt')
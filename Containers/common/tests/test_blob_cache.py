@@ -0,0 +1,173 @@
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License.
+import os
+import threading
+import time
+
+import pytest
+
+pytest.importorskip('azure.core')
+
+from blob_cache import BlobCache
+
+
+class Blob:
+    """A fetch function over an in-memory blob that answers If-None-Match like storage."""
+    def __init__(self, data=b'version 1', error=None):
+        self.data = data
+        self.version = 1
+        self.error = error
+        self.fetch_count = 0
+        self.started = threading.Event()
+        self.release = threading.Event()
+        self.release.set()
+
+    def update(self, data):
+        self.data = data
+        self.version += 1
+
+    def __call__(self, etag, destination_path):
+        self.fetch_count += 1
+        self.started.set()
+        self.release.wait(5)
+        if self.error:
+            raise self.error
+        current = '"{}"'.format(self.version)
+        if etag == current:
+            return None
+        with open(destination_path, 'wb') as f:
+            f.write(self.data)
+        return current
+
+
+def read(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+@pytest.fixture
+def cache(tmp_path):
+    return BlobCache(str(tmp_path / 'cache'), max_size_bytes=1024, revalidate_seconds=0)
+
+
+def test_revalidates_with_etag(cache):
+    blob = Blob()
+    assert read(cache.get_path('a', blob)) == b'version 1'
+    assert read(cache.get_path('a', blob)) == b'version 1'
+    assert cache.get_stats()['misses'] == 1
+    assert cache.get_stats()['revalidations'] == 1
+
+    blob.update(b'version 2')
+    assert read(cache.get_path('a', blob)) == b'version 2'
+    assert cache.get_stats()['misses'] == 2
+
+
+def test_fresh_copy_is_not_revalidated(tmp_path):
+    cache = BlobCache(str(tmp_path), revalidate_seconds=60)
+    blob = Blob()
+    cache.get_path('a', blob)
+    cache.get_path('a', blob)
+    assert blob.fetch_count == 1
+
+
+def test_other_credential_revalidates(tmp_path):
+    cache = BlobCache(str(tmp_path), revalidate_seconds=60)
+    blob = Blob()
+    cache.get_path('a', blob, credential='sig=first')
+    cache.get_path('a', blob, credential='sig=first')
+    assert blob.fetch_count == 1
+
+    # A token that can no longer read the blob gets the error, not the cached copy.
+    blob.error = PermissionError('expired token')
+    with pytest.raises(PermissionError):
+        cache.get_path('a', blob, credential='sig=expired')
+
+    blob.error = None
+    assert read(cache.get_path('a', blob, credential='sig=second')) == b'version 1'
+    assert blob.fetch_count == 3
+    # The copy was validated with the second token, so the first one must revalidate again.
+    cache.get_path('a', blob, credential='sig=first')
+    assert blob.fetch_count == 4
+
+
+def test_concurrent_reads_share_one_request(cache):
+    blob = Blob()
+    blob.release.clear()
+    paths = []
+    threads = [threading.Thread(target=lambda: paths.append(cache.get_path('a', blob))) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    assert blob.started.wait(5)
+    # Give the other threads time to start waiting on the first one.
+    time.sleep(0.2)
+    blob.release.set()
+    for thread in threads:
+        thread.join()
+
+    assert len(set(paths)) == 1
+    assert blob.fetch_count == 1
+    # The waiters report the miss of the request they waited on.
+    assert cache.get_stats()['misses'] == 4
+    assert cache.get_stats()['hits'] == 0
+
+
+def test_waiters_get_the_leader_error(cache):
+    blob = Blob(error=IOError('storage unavailable'))
+    blob.release.clear()
+    errors = []
+
+    def get():
+        try:
+            cache.get_path('a', blob)
+        except IOError as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=get) for _ in range(3)]
+    for thread in threads:
+        thread.start()
+    assert blob.started.wait(5)
+    blob.release.set()
+    for thread in threads:
+        thread.join()
+    assert len(errors) == 3
+
+
+def test_invalidate(cache):
+    blob = Blob()
+    cache.get_path('a', blob)
+    cache.invalidate('a')
+    cache.get_path('a', blob)
+    assert cache.get_stats()['misses'] == 2
+
+
+def test_least_recently_used_blobs_are_evicted(cache):
+    first = cache.get_path('a', Blob(b'a' * 600))
+    os.utime(first, (1, 1))
+    second = cache.get_path('b', Blob(b'b' * 600))
+    assert not os.path.exists(first)
+    assert os.path.exists(second)
+    assert cache.get_stats()['evictions'] == 1
+
+
+def test_eviction_removes_the_whole_key(cache):
+    first = cache.get_path('a', Blob(b'a' * 600))
+    os.utime(first, (1, 1))
+    cache.get_path('b', Blob(b'b' * 600))
+    # Only the files of 'b' are left.
+    assert len(os.listdir(cache.cache_dir)) == 3
+    assert cache._read_meta('a') is None
+    assert not os.path.exists(cache._key_lock('a').path)
+
+    # The copy was evicted, so it is downloaded again.
+    blob = Blob(b'a' * 600)
+    assert read(cache.get_path('a', blob)) == b'a' * 600
+    assert blob.fetch_count == 1
+
+
+def test_metadata_counts_towards_the_size_limit(cache):
+    first = cache.get_path('a', Blob(b'a' * 450))
+    os.utime(first, (1, 1))
+    # 900 bytes of data fit in 1024, but not with the metadata of both keys.
+    second = cache.get_path('b', Blob(b'b' * 450))
+    assert not os.path.exists(first)
+    assert os.path.exists(second)
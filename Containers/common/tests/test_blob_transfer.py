@@ -0,0 +1,109 @@
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License.
+import io
+import threading
+from types import SimpleNamespace
+
+import pytest
+
+from blob_transfer import ChunkIteratorReader, MemoryViewWriter, block_list_xml, download_into, download_to_file, iter_ranges, read_response_into, upload_file_in_blocks
+
+BLOB = bytes(range(256)) * 40
+
+
+def range_reader(data, calls=None):
+    def read_range_into(offset, view):
+        if calls is not None:
+            calls.append((offset, len(view)))
+        view[:] = data[offset:offset + len(view)]
+    return read_range_into
+
+
+def test_iter_ranges():
+    assert list(iter_ranges(10, 4)) == [(0, 4), (4, 4), (8, 2)]
+    assert list(iter_ranges(0, 4)) == []
+
+
+@pytest.mark.parametrize('max_concurrency', [1, 4])
+def test_download_into(max_concurrency):
+    calls = []
+    buffer = bytearray(len(BLOB) + 10)
+    download_into(memoryview(buffer), len(BLOB), range_reader(BLOB, calls), max_concurrency, chunk_size=1000)
+    assert bytes(buffer[:len(BLOB)]) == BLOB
+    assert sorted(calls) == list(iter_ranges(len(BLOB), 1000))
+
+
+def test_download_into_small_buffer():
+    with pytest.raises(ValueError):
+        download_into(memoryview(bytearray(10)), 11, range_reader(BLOB))
+
+
+def test_download_errors_are_raised():
+    def read_range_into(offset, view):
+        if offset > 0:
+            raise IOError('range failed')
+        view[:] = BLOB[:len(view)]
+
+    with pytest.raises(IOError):
+        download_into(memoryview(bytearray(len(BLOB))), len(BLOB), read_range_into, 4, chunk_size=1000)
+
+
+def test_download_to_file(tmp_path):
+    path = str(tmp_path / 'blob')
+    download_to_file(path, len(BLOB), range_reader(BLOB), 4, chunk_size=1000)
+    with open(path, 'rb') as f:
+        assert f.read() == BLOB
+
+    download_to_file(path, 0, range_reader(b''))
+    with open(path, 'rb') as f:
+        assert f.read() == b''
+
+
+def test_memory_view_writer():
+    buffer = bytearray(6)
+    writer = MemoryViewWriter(memoryview(buffer))
+    writer.write(b'abc')
+    writer.write(b'def')
+    assert buffer == b'abcdef'
+    assert writer.tell() == 6
+
+
+def test_chunk_iterator_reader():
+    reader = io.BufferedReader(ChunkIteratorReader([b'ab', b'', b'cde', b'f']))
+    assert reader.read(3) == b'abc'
+    assert reader.read() == b'def'
+    assert reader.read() == b''
+
+
+def test_read_response_into():
+    response = SimpleNamespace(raw=io.BytesIO(b'abcdef'))
+    buffer = bytearray(4)
+    read_response_into(response, memoryview(buffer))
+    assert buffer == b'abcd'
+
+    with pytest.raises(IOError):
+        read_response_into(SimpleNamespace(raw=io.BytesIO(b'ab')), memoryview(bytearray(4)))
+
+
+def test_upload_file_in_blocks(tmp_path):
+    path = str(tmp_path / 'upload')
+    with open(path, 'wb') as f:
+        f.write(BLOB)
+
+    blocks = {}
+    lock = threading.Lock()
+    committed = []
+
+    def put_block(block_id, data):
+        with lock:
+            blocks[block_id] = data
+
+    upload_file_in_blocks(path, put_block, committed.extend, max_concurrency=4, block_size=1000)
+    assert len(committed) == 11
+    # Block ids have the same length and commit in file order.
+    assert len(set(len(block_id) for block_id in committed)) == 1
+    assert b''.join(blocks[block_id] for block_id in committed) == BLOB
+
+
+def test_block_list_xml():
+    assert block_list_xml(['a', 'b']) == '<?xml version="1.0" encoding="utf-8"?><BlockList><Latest>a</Latest><Latest>b</Latest></BlockList>'
@@ -0,0 +1,32 @@
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License.
+import pytest
+
+pytest.importorskip('azure.storage.blob')
+
+from sas_blob import SasBlob
+
+SAS_URI = 'https://account.blob.core.windows.net/container/dir/blob.bin?sv=2019-07-07&sp=r&sig=abc'
+
+
+class RecordingCache:
+    def __init__(self):
+        self.calls = []
+
+    def get_path(self, key, fetch, credential=None):
+        self.calls.append((key, credential))
+        return '/cached/path'
+
+
+def test_uri_parts():
+    sas_blob = SasBlob()
+    assert sas_blob.get_account_from_uri(SAS_URI) == 'account'
+    assert sas_blob.get_container_from_uri(SAS_URI) == 'container'
+    assert sas_blob.get_sas_key_from_uri(SAS_URI) == 'sv=2019-07-07&sp=r&sig=abc'
+
+
+def test_cached_path_is_keyed_without_the_token():
+    cache = RecordingCache()
+    assert SasBlob(blob_cache=cache).get_cached_path(SAS_URI) == '/cached/path'
+    # Every token shares the copy, but the cache is told which token read it.
+    assert cache.calls == [('account/container/dir/blob.bin', 'sv=2019-07-07&sp=r&sig=abc')]
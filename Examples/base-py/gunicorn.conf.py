@@ -0,0 +1,27 @@
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License.
+# gunicorn settings for runserver.py, used with: gunicorn -c gunicorn.conf.py runserver:app
+import os
+
+# gunicorn replaces the SIGTERM handler of APIService in each worker and finishes the running
+# requests itself; worker_exit then drains the async tasks. Leave time for both.
+graceful_timeout = int(float(os.getenv('DRAIN_TIMEOUT_SECONDS', '25'))) + 5
+
+
+def post_worker_init(worker):
+    # The worker has not started any threads yet, so executor = 'process' children forked now
+    # cannot inherit a lock held by another thread.
+    import runserver
+    runserver.ai4e_service.start_executors()
+
+
+def worker_int(worker):
+    # SIGINT or SIGQUIT: refuse new requests; worker_exit drains before the worker exits.
+    import runserver
+    runserver.ai4e_service.is_terminating = True
+
+
+def worker_exit(server, worker):
+    # Runs in the worker after it stops serving, for every way it stops.
+    import runserver
+    runserver.ai4e_service.drain()
@@ -2,6 +2,7 @@ from io import StringIO
 from os import getenv
 import tempfile
 from aad_blob import AadBlob
+from blob_cache import BlobCache
 import pandas as pd
 
 aad_blob_connector = AadBlob(
@@ -9,7 +10,9 @@ aad_blob_connector = AadBlob(
                             getenv('AAD_APPLICATION_ID'),
                             getenv('AAD_APPLICATION_SECRET'),
                             getenv('AAD_ACCOUNT_NAME'),
-                            getenv('LOCAL_BLOB_TEST_DIRECTORY', None))
+                            getenv('LOCAL_BLOB_TEST_DIRECTORY', None),
+                            # Set BLOB_CACHE_DIR to keep reference data on local disk between requests.
+                            BlobCache() if getenv('BLOB_CACHE_DIR') else None)
 
 class BlobHelper:
     def __init__(self, container_name, run_directory):
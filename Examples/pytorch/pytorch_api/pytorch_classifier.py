@@ -5,18 +5,29 @@ import torch.nn.functional as F
 from inception import Inception3
 from PIL import Image
 
+from image_preprocessing import IMAGENET_MEAN, IMAGENET_STD, decode_image, decode_images, to_batch
+
 use_gpu = True
 dtype = torch.float32
 
 device = torch.device('cuda') if use_gpu and torch.cuda.is_available() else torch.device('cpu')
 print('Using device: ', device)
 
+# The model was trained on 299 x 299 crops normalized with the ImageNet mean and std;
+# see https://github.com/macaodha/inat_comp_2018/blob/master/train_inat.py
+input_size = (299, 299)
+
 
 def load_model(model_path, device=device):
     print('pytorch_classifier.py: Loading model...')
     num_classes = 8142
 
-    checkpoint = torch.load(model_path, map_location=device)
+    try:
+        # Memory-maps the tensors of the checkpoint instead of reading the file into memory first.
+        checkpoint = torch.load(model_path, map_location=device, mmap=True)
+    except (TypeError, RuntimeError):
+        # PyTorch before 2.1, or a checkpoint saved in the legacy (non-zip) format.
+        checkpoint = torch.load(model_path, map_location=device)
 
     # reference: https://github.com/macaodha/inat_comp_2018/blob/master/train_inat.py
     model = Inception3(transform_input=True)
@@ -30,20 +41,36 @@ def load_model(model_path, device=device):
     return model
 
 
-def classify(model, image_bytes):
-    img = Image.open(image_bytes)
+def load_image(image_bytes):
+    """Decodes an image into an RGB PIL image of the model's input size.
+
+    JPEGs are decoded directly at a reduced size, so large photos are never held at
+    full resolution.
+    """
+    return decode_image(image_bytes, size=input_size)
+
 
-    image_np = np.asarray(img, np.uint8)
+def load_images(images_bytes):
+    """Decodes several images in parallel with load_image()."""
+    return decode_images(images_bytes, size=input_size)
 
-    # swap color axis because numpy image is H x W x C, torch image is C X H X W
-    image_np = image_np.transpose((2, 0, 1))
-    image_np = image_np[:3, :, :] # Remove the alpha channel
-    image_np = np.expand_dims(image_np, axis=0)  # add a batch dimension
-    img_input = torch.from_numpy(image_np).type(torch.float32).to(device=device, dtype=dtype)
+
+def classify_batch(model, images):
+    """Classifies a list of images from load_image with one model call.
+
+    The images are converted, normalized and transposed to C x H x W straight into
+    one batch array, which the input tensor shares. Returns one result string per
+    image, in input order.
+    """
+    image_batch = to_batch(images, dtype=np.float32, channels_first=True, scale=1 / 255, mean=IMAGENET_MEAN, std=IMAGENET_STD)
+    img_input = torch.from_numpy(image_batch).to(device=device, dtype=dtype)
 
     with torch.no_grad():
         scores = model(img_input)
 
-    scores = scores.cpu().data.numpy()
-    clss = np.argmax(scores[0])
-    return 'Most likely category is {}'.format(str(clss))
+    classes = np.argmax(scores.cpu().data.numpy(), axis=1)
+    return ['Most likely category is {}'.format(str(clss)) for clss in classes]
+
+
+def classify(model, image_bytes):
+    return classify_batch(model, [load_image(image_bytes)])[0]
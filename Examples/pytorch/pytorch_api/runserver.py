@@ -5,9 +5,10 @@ from flask_restful import Resource, Api
 from ai4e_app_insights import AppInsights
 from ai4e_app_insights_wrapper import AI4EAppInsights
 from ai4e_service import APIService
+from response_cache import ResponseCache
+import model_loader
 from PIL import Image
 import pytorch_classifier
-from io import BytesIO
 from os import getenv
 
 print("Creating Application")
@@ -27,33 +28,40 @@ with app.app_context():
 # Load the model
 # The model was copied to this location when the container was built; see ../Dockerfile
 model_path = '/app/pytorch_api/iNat_2018_InceptionV3.pth.tar'
-model = pytorch_classifier.load_model(model_path)
-
-# Define a function for processing request data, if appliciable.  This function loads data or files into
-# a dictionary for access in your API function.  We pass this function as a parameter to your API setup.
-def process_request_data(request):
-    print('Processing data...')
-    return_values = {'image_bytes': None}
-    try:
-        # Attempt to load the body
-        return_values['image_bytes'] = BytesIO(request.data)
-    except:
-        log.log_error('Unable to load the request data')   # Log to Application Insights
-    return return_values
-
-# POST, async API endpoint example
+# When the server loads the app before forking its workers, the model is loaded once and its
+# CPU weights are shared by every worker. CUDA does not survive fork(), so on a GPU run one
+# worker process per GPU, or load the app in each worker (uWSGI --lazy-apps).
+model = model_loader.load_model('iNat_2018_InceptionV3', pytorch_classifier.load_model, model_path)
+
+# Run one synthetic image through the model in each worker before it reports ready on
+# API_PREFIX/health/ready, so the first real request does not pay for initialization.
+@ai4e_service.register_warmup
+def warm_up_classifier():
+    pytorch_classifier.classify_batch(model, [Image.new('RGB', pytorch_classifier.input_size)])
+
+# Run concurrent requests through the model together. Requests that arrive within
+# max_batch_wait_ms of each other are classified in one batch of up to max_batch_size images.
+def classify_batch(images):
+    return pytorch_classifier.classify_batch(model, images)
+
+# POST, sync API endpoint example
 @ai4e_service.api_sync_func(
     api_path = '/classify', 
     methods = ['POST'], 
-    request_processing_function = process_request_data, # This is the data process function that you created above.
     maximum_concurrent_requests = 5, # If the number of requests exceed this limit, a 503 is returned to the caller.
     content_types = ACCEPTED_CONTENT_TYPES,
     content_max_length = 10000, # In bytes
-    trace_name = 'post:classify')
+    trace_name = 'post:classify',
+    batch_function = classify_batch,
+    max_batch_size = 8,
+    max_batch_wait_ms = 10,
+    stream_request_body = True, # The image is passed as kwargs['request_body'] without extra copies.
+    response_cache = ResponseCache()) # Images that have already been classified are answered from the cache.
 def post(*args, **kwargs):
     print('Post called')
-    image_bytes = kwargs.get('image_bytes')
-    clss = pytorch_classifier.classify(model, image_bytes)
+    image_bytes = kwargs.get('request_body')
+    # Decode in the request thread, then wait for the batched model call.
+    clss = kwargs['batcher'].submit(pytorch_classifier.load_image(image_bytes))
     # in this example we simply return the numerical ID of the most likely category determined
     # by the model
     return clss
@@ -1,22 +1,24 @@
 # /ai4e_api_tools has been added to the PYTHONPATH, so we can reference those
 # libraries directly.
 import json
+import os
 from flask import Flask, request, abort
 from ai4e_app_insights_wrapper import AI4EAppInsights
 from ai4e_service import APIService
-from sas_blob import SasBlob
+from response_cache import ResponseCache
+import model_loader
 from PIL import Image
 import tf_detector
 from io import BytesIO
-from os import getenv
-import uuid
 import sys
 import numpy as np
 
 print("Creating Application")
 
 ACCEPTED_CONTENT_TYPES = ['image/png', 'application/octet-stream', 'image/jpeg']
-blob_access_duration_hrs = 1
+# Tiled detection is for images much larger than the model input, such as aerial images,
+# so it accepts much larger uploads.
+MAX_IMAGE_BYTES = int(os.getenv('MAX_IMAGE_BYTES', '500000000' if tf_detector.TF_DETECTOR_TILE_SIZE else '10000'))
 
 app = Flask(__name__)
 
@@ -31,66 +33,82 @@ with app.app_context():
 # Load the model
 # The model was copied to this location when the container was built; see ../Dockerfile
 model_path = '/app/tf_iNat_api/frozen_inference_graph.pb'
-detection_graph = tf_detector.load_model(model_path)
-
-# Define a function for processing request data, if appliciable.  This function loads data or files into
-# a dictionary for access in your API function.  We pass this function as a parameter to your API setup.
-def process_request_data(request):
-    return_values = {'image_bytes': None}
+# The detector keeps one TensorFlow session open for all requests. The graph is loaded
+# once before the server forks its workers, and each worker opens its own session.
+detector = model_loader.load_model('tf_iNat_detector', tf_detector.load_detector, model_path)
+# Run one synthetic image through the detector in each worker before it reports ready on
+# API_PREFIX/health/ready. This opens the worker's session and runs the graph's first,
+# slowest inference.
+@ai4e_service.register_warmup
+def warm_up_detector():
+    detector.detect(Image.new('RGB', (1024, 768)))
+
+# The renderer loads its font once and is shared by all requests.
+renderer = tf_detector.BoxRenderer()
+
+# Reads the options of a detect request from its query parameters:
+# ?confidence=0.5 sets the confidence threshold, and ?render=false returns the
+# detections as JSON instead of an annotated image.
+def process_request_options(request):
     try:
-        # Attempt to load the body
-        return_values['image_bytes'] = BytesIO(request.data)
-    except:
-        log.log_error('Unable to load the request data')   # Log to Application Insights
-    return return_values
+        confidence_threshold = float(request.args.get('confidence', '0.5'))
+    except ValueError:
+        abort(400, 'confidence must be a number.')
+    return {'confidence_threshold': confidence_threshold,
+            'render': request.args.get('render', 'true').lower() != 'false'}
 
 # POST, async API endpoint example
 @ai4e_service.api_async_func(
     api_path = '/detect', 
     methods = ['POST'], 
-    request_processing_function = process_request_data, # This is the data process function that you created above.
+    request_processing_function = process_request_options,
     maximum_concurrent_requests = 5, # If the number of requests exceed this limit, a 503 is returned to the caller.
     content_types = ACCEPTED_CONTENT_TYPES,
-    content_max_length = 10000, # In bytes
-    trace_name = 'post:detect')
+    content_max_length = MAX_IMAGE_BYTES, # In bytes
+    trace_name = 'post:detect',
+    stream_request_body = True, # The image is passed as kwargs['request_body'] without extra copies.
+    response_cache = ResponseCache(), # Resubmitted images get the TaskId of the first request for that image.
+    cache_key_params = ['confidence', 'render']) # The same image with other options is a different request.
 def detect(*args, **kwargs):
     print('runserver.py: detect() called, generating detections...')
-    image_bytes = kwargs.get('image_bytes')
+    image_bytes = kwargs.get('request_body')
     taskId = kwargs.get('taskId')
 
     # Update the task status, so the caller knows it has been accepted and is running.
     ai4e_service.api_task_manager.UpdateTaskStatus(taskId, 'running - generate_detections')
 
     try:
-        image = tf_detector.open_image(image_bytes)
-        boxes, scores, clsses, image = tf_detector.generate_detections(
-            detection_graph, image)
+        if tf_detector.TF_DETECTOR_TILE_SIZE:
+            # Large images are detected at full resolution, in overlapping tiles.
+            image = tf_detector.open_image(image_bytes, max_size=None)
+            boxes, scores, clsses = detector.detect_tiled(image, confidence_threshold=kwargs['confidence_threshold'])
+        else:
+            image = tf_detector.open_image(image_bytes)
+            boxes, scores, clsses = detector.detect(image)
+
+        # Thresholding and per-class non-maximum suppression, in numpy.
+        boxes, scores, clsses = tf_detector.filter_detections(
+            boxes, scores, clsses, confidence_threshold=kwargs['confidence_threshold'], iou_threshold=0.5)
+
+        if not kwargs['render']:
+            # The detections are returned by GET /task/<taskId>/result as JSON.
+            detections = tf_detector.detections_to_json(boxes, scores, clsses)
+            ai4e_service.api_task_manager.CompleteTask(taskId, 'completed', result={'detections': detections})
+            print('runserver.py: detect() finished.')
+            return
 
         ai4e_service.api_task_manager.UpdateTaskStatus(taskId, 'rendering boxes')
 
         # image is modified in place
-        # here confidence_threshold is hardcoded, but you can ask that as a input from the request
-        tf_detector.render_bounding_boxes(
-            boxes, scores, clsses, image, confidence_threshold=0.5)
+        renderer.render(image, boxes, tf_detector.format_labels(scores, clsses))
 
         print('runserver.py: detect(), rendering and saving result image...')
-        # save the PIL Image object to a ByteIO stream so that it can be written to blob storage
+        # save the PIL Image object to a ByteIO stream so that it can be stored as the task result
         output_img_stream = BytesIO()
         image.save(output_img_stream, format='jpeg')
-        output_img_stream.seek(0)
-
-        sas_blob_helper = SasBlob()
-        # Create a unique name for a blob container
-        container_name = str(uuid.uuid4()).replace('-','')
-
-        # Create a writable sas container and return its url
-        sas_url = sas_blob_helper.create_writable_container_sas(
-            getenv('STORAGE_ACCOUNT_NAME'), getenv('STORAGE_ACCOUNT_KEY'), container_name, blob_access_duration_hrs)
 
-        # Write the image to the blob
-        sas_blob_helper.write_blob(sas_url, 'detect_output.jpg', output_img_stream)
-        
-        ai4e_service.api_task_manager.CompleteTask(taskId, 'completed - output written to: ' + sas_url)
+        # The image is returned by GET /task/<taskId>/result.
+        ai4e_service.api_task_manager.CompleteTask(taskId, 'completed', result=output_img_stream.getbuffer(), content_type='image/jpeg')
         print('runserver.py: detect() finished.')
     except:
         log.log_exception(sys.exc_info()[0], taskId)
@@ -0,0 +1,24 @@
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License.
+# Shared setup for the tf_detector tests. Run them from the repository root with:
+#   python -m pytest Examples/tensorflow/tf_iNat_api/tests
+import os
+import sys
+
+_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..', '..', '..'))
+# In the container, tf_detector runs next to the ai4e_api_tools modules it imports.
+sys.path.insert(0, os.path.join(_ROOT, 'Containers', 'base-py', 'ai4e_api_tools'))
+sys.path.insert(0, os.path.join(_ROOT, 'Examples', 'tensorflow', 'tf_iNat_api'))
+
+try:
+    import tensorflow
+    _has_tf1 = hasattr(tensorflow, 'Session')
+except ImportError:
+    _has_tf1 = False
+
+if not _has_tf1:
+    # tf_detector uses the TensorFlow 1 API. Without it, the session tests run on a stand-in
+    # and the post-processing tests, which only use numpy and Pillow, run as they are.
+    sys.path.insert(0, os.path.dirname(__file__))
+    import fake_tensorflow
+    sys.modules['tensorflow'] = fake_tensorflow
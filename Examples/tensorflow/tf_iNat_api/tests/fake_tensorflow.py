@@ -0,0 +1,27 @@
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License.
+# A stand-in for the few TensorFlow 1 calls that TFDetector makes, used by conftest.py
+# when TensorFlow 1 is not installed, so the tf_detector tests still run.
+
+IS_STAND_IN = True
+
+
+class ConfigProto:
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+
+class Session:
+    """Runs a graph object that computes its outputs itself, such as StandInGraph in test_tf_detector."""
+    def __init__(self, graph=None, config=None):
+        self.graph = graph
+        self.config = config
+        self.closed = False
+
+    def run(self, fetches, feed_dict=None):
+        if self.closed:
+            raise RuntimeError('Attempted to use a closed Session.')
+        return self.graph.run(fetches, feed_dict or {})
+
+    def close(self):
+        self.closed = True
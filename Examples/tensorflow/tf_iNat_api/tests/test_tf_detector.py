@@ -0,0 +1,152 @@
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License.
+import threading
+
+import numpy as np
+import pytest
+# conftest.py replaces TensorFlow with fake_tensorflow when TensorFlow 1 is not installed.
+import tensorflow as tf
+from PIL import Image
+
+import tf_detector
+
+
+class StandInGraph:
+    """Computes the outputs of make_graph() with numpy, for fake_tensorflow.Session."""
+    def get_tensor_by_name(self, name):
+        return name
+
+    def run(self, fetches, feed_dict):
+        images = feed_dict['image_tensor:0']
+        batch_size = len(images)
+        mean = images.astype(np.float32).mean(axis=(1, 2, 3)) / 255.0
+        outputs = {
+            'detection_boxes:0': np.tile(np.array([[[0.1, 0.1, 0.5, 0.5], [0.2, 0.2, 0.6, 0.6]]], np.float32), (batch_size, 1, 1)),
+            'detection_scores:0': np.stack([mean, np.full(batch_size, 0.25, np.float32)], axis=1),
+            'detection_classes:0': np.ones((batch_size, 2), np.float32),
+            'num_detections:0': np.full(batch_size, 2.0, np.float32)}
+        return [outputs[name] for name in fetches]
+
+
+def make_graph():
+    """A stand-in for a detection graph, with the same input and output tensors.
+
+    Every image gets two boxes; the score of the first box is the mean pixel value / 255,
+    so results can be matched to their input image.
+    """
+    if getattr(tf, 'IS_STAND_IN', False):
+        return StandInGraph()
+
+    graph = tf.Graph()
+    with graph.as_default():
+        image_tensor = tf.placeholder(tf.uint8, [None, None, None, 3], name='image_tensor')
+        batch_size = tf.shape(image_tensor)[0]
+        mean = tf.reduce_mean(tf.cast(image_tensor, tf.float32), axis=[1, 2, 3]) / 255.0
+        tf.identity(tf.tile(tf.constant([[[0.1, 0.1, 0.5, 0.5], [0.2, 0.2, 0.6, 0.6]]]), [batch_size, 1, 1]), name='detection_boxes')
+        tf.identity(tf.stack([mean, tf.fill([batch_size], 0.25)], axis=1), name='detection_scores')
+        tf.identity(tf.ones([batch_size, 2]), name='detection_classes')
+        tf.identity(tf.fill([batch_size], 2.0), name='num_detections')
+    return graph
+
+
+def solid_image(value, size=(8, 6)):
+    return Image.new('RGB', size, (value, value, value))
+
+
+@pytest.fixture
+def detector():
+    detector = tf_detector.TFDetector(make_graph(), intra_op_threads=1, inter_op_threads=1)
+    yield detector
+    detector.close()
+
+
+def test_session_is_reused(detector):
+    session = detector.session
+    detector.detect(solid_image(0))
+    detector.detect(solid_image(0))
+    assert detector.session is session
+
+
+def test_detect(detector):
+    boxes, scores, classes = detector.detect(solid_image(255))
+    assert boxes.shape == (2, 4)
+    np.testing.assert_allclose(scores, [1.0, 0.25])
+    np.testing.assert_array_equal(classes, [1, 1])
+
+
+def test_detect_batch_keeps_input_order(detector):
+    images = [solid_image(255), solid_image(0, size=(4, 4)), solid_image(51)]
+    results = detector.detect_batch(images)
+    np.testing.assert_allclose([scores[0] for _, scores, _ in results], [1.0, 0.0, 0.2], atol=1e-6)
+
+
+def test_concurrent_detection(detector):
+    results = {}
+
+    def detect(value):
+        results[value] = detector.detect(solid_image(value))[1][0]
+
+    threads = [threading.Thread(target=detect, args=(value,)) for value in (0, 51, 255)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert results == pytest.approx({0: 0.0, 51: 0.2, 255: 1.0})
+
+
+def test_generate_detections_caches_detector():
+    graph = make_graph()
+    image = solid_image(255)
+    boxes, scores, classes, returned_image = tf_detector.generate_detections(graph, image)
+    assert returned_image is image
+    assert scores[0] == pytest.approx(1.0)
+    first = tf_detector._detectors[graph]
+    tf_detector.generate_detections(graph, image)
+    assert tf_detector._detectors[graph] is first
+
+
+BOXES = np.array([[0.1, 0.1, 0.5, 0.5], [0.12, 0.1, 0.5, 0.5], [0.6, 0.6, 0.9, 0.9], [0.0, 0.0, 1.0, 1.0]], np.float32)
+SCORES = np.array([0.8, 0.9, 0.6, 0.3], np.float32)
+CLASSES = np.array([1.0, 1.0, 2.0, 1.0], np.float32)
+
+
+def test_filter_detections():
+    boxes, scores, classes = tf_detector.filter_detections(BOXES, SCORES, CLASSES, confidence_threshold=0.5)
+    np.testing.assert_allclose(scores, [0.9, 0.8, 0.6])
+    np.testing.assert_array_equal(classes, [1, 1, 2])
+    assert classes.dtype == np.int64
+    np.testing.assert_array_equal(boxes, BOXES[[1, 0, 2]])
+
+    # The two overlapping boxes of class 1 are merged into the best one.
+    _, scores, _ = tf_detector.filter_detections(BOXES, SCORES, CLASSES, confidence_threshold=0.5, iou_threshold=0.5)
+    np.testing.assert_allclose(scores, [0.9, 0.6])
+    _, scores, _ = tf_detector.filter_detections(BOXES, SCORES, CLASSES, confidence_threshold=0.0, max_detections=2)
+    np.testing.assert_allclose(scores, [0.9, 0.8])
+
+
+def test_detections_to_json():
+    boxes, scores, classes = tf_detector.filter_detections(BOXES, SCORES, CLASSES, confidence_threshold=0.5)
+    detections = tf_detector.detections_to_json(boxes, scores, classes, {1: 'fox'}, image_size=(200, 100))
+    assert detections[0] == {'class': 1, 'label': 'fox', 'confidence': 0.9, 'bbox': [0.12, 0.1, 0.5, 0.5], 'bbox_pixels': [12, 20, 50, 100]}
+    assert detections[2]['label'] == '2'
+    assert tf_detector.format_labels(scores, classes, {1: 'fox'}) == ['fox: 90%', 'fox: 80%', '2: 60%']
+
+
+def test_render_bounding_boxes():
+    image = solid_image(0, size=(100, 100))
+    boxes, _, _ = tf_detector.render_bounding_boxes(BOXES, SCORES, CLASSES, image, confidence_threshold=0.5, renderer=tf_detector.BoxRenderer(color='White', thickness=2))
+    assert len(boxes) == 3
+    pixels = np.asarray(image)
+    # The top edge of the box at (0.6, 0.6) is drawn; the inside of the box is not filled.
+    assert pixels[60, 75].max() == 255
+    assert pixels[75, 75].max() == 0
+
+
+def test_detect_tiled(detector):
+    # Tiles start at x = 0, 2, 4 and y = 0, 2; the box the graph finds in each tile is its own object.
+    boxes, scores, classes = detector.detect_tiled(solid_image(255), tile_size=4, overlap=2, confidence_threshold=0.5)
+    assert len(boxes) == 6
+    np.testing.assert_allclose(scores, 1.0)
+    assert boxes.min() >= 0 and boxes.max() <= 1
+    # The box of the first tile, normalized to the 8 x 6 image.
+    np.testing.assert_allclose(boxes[0], [0.4 / 6, 0.4 / 8, 2.0 / 6, 2.0 / 8], rtol=1e-5)
@@ -1,3 +1,6 @@
+import os
+import threading
+
 import tensorflow as tf
 import numpy as np
 import PIL.Image as Image
@@ -5,6 +8,20 @@ import PIL.ImageColor as ImageColor
 import PIL.ImageDraw as ImageDraw
 import PIL.ImageFont as ImageFont
 
+from image_preprocessing import decode_image, to_batch
+from model_loader import PerProcess, map_file
+from tiling import DetectionStitcher, non_max_suppression, open_raster, raster_size, run_tiled
+
+
+# Session threading settings. 0 lets TensorFlow choose based on the number of cores.
+TF_INTRA_OP_THREADS = int(os.getenv('TF_INTRA_OP_THREADS', '0'))
+TF_INTER_OP_THREADS = int(os.getenv('TF_INTER_OP_THREADS', '0'))
+# Images are decoded with their longer side reduced to at most this many pixels. 0 keeps the full resolution.
+TF_DETECTOR_MAX_IMAGE_SIZE = int(os.getenv('TF_DETECTOR_MAX_IMAGE_SIZE', '1600'))
+# Images larger than this are detected in overlapping tiles of this size. 0 disables tiling.
+TF_DETECTOR_TILE_SIZE = int(os.getenv('TF_DETECTOR_TILE_SIZE', '0'))
+TF_DETECTOR_TILE_OVERLAP = int(os.getenv('TF_DETECTOR_TILE_OVERLAP', '128'))
+
 
 # Core detection functions
 
@@ -22,24 +39,30 @@ def load_model(checkpoint):
     detection_graph = tf.Graph()
     with detection_graph.as_default():
         od_graph_def = tf.GraphDef()
-        with tf.gfile.GFile(checkpoint, 'rb') as fid:
-            serialized_graph = fid.read()
-            od_graph_def.ParseFromString(serialized_graph)
-            tf.import_graph_def(od_graph_def, name='')
+        # The file is parsed from a read-only memory map instead of a copy read into a bytes object.
+        with map_file(checkpoint) as serialized_graph:
+            try:
+                od_graph_def.ParseFromString(serialized_graph)
+            except TypeError:
+                # Protobuf implementations that only parse bytes.
+                od_graph_def.ParseFromString(serialized_graph[:])
+        tf.import_graph_def(od_graph_def, name='')
     print('tf_detector.py: Detection graph loaded.')
 
     return detection_graph
 
 
-def open_image(image_bytes):
+def open_image(image_bytes, max_size=TF_DETECTOR_MAX_IMAGE_SIZE):
     """ Open an image in binary format using PIL.Image and convert to RGB mode
     Args:
         image_bytes: an image in binary format read from the POST request's body
+        max_size: the longer side of the returned image is reduced to at most this
+            many pixels, while the image is decoded. 0 or None keeps the full resolution.
 
     Returns:
         an PIL image object in RGB mode
     """
-    image = Image.open(image_bytes)
+    image = decode_image(image_bytes, max_size=max_size, mode=None)
     if image.mode not in ('RGBA', 'RGB'):
         raise AttributeError('Input image not in RGBA or RGB mode and cannot be processed.')
     if image.mode == 'RGBA':
@@ -48,42 +71,249 @@ def open_image(image_bytes):
     return image
 
 
+class TFDetector:
+    """Runs an object detection graph in one long-lived session.
+
+    The session and the input/output tensors are set up once, so each call only
+    pays for inference. tf.Session.run is thread-safe, so one detector can serve
+    concurrent request threads.
+
+    The graph can be loaded before the web server forks its workers. TensorFlow
+    sessions do not survive fork(), so each process opens its own session on first use.
+    """
+    def __init__(self, detection_graph, intra_op_threads=TF_INTRA_OP_THREADS, inter_op_threads=TF_INTER_OP_THREADS):
+        self.detection_graph = detection_graph
+
+        config = tf.ConfigProto(
+            intra_op_parallelism_threads=intra_op_threads,
+            inter_op_parallelism_threads=inter_op_threads)
+        self._session = PerProcess(lambda: tf.Session(graph=detection_graph, config=config))
+
+        # get the operators
+        self.image_tensor = detection_graph.get_tensor_by_name('image_tensor:0')
+        self.output_tensors = [
+            detection_graph.get_tensor_by_name('detection_boxes:0'),
+            detection_graph.get_tensor_by_name('detection_scores:0'),
+            detection_graph.get_tensor_by_name('detection_classes:0'),
+            detection_graph.get_tensor_by_name('num_detections:0')
+        ]
+
+    def detect(self, image):
+        """Generates bounding boxes, confidences and class predictions for one PIL image.
+
+        Returns:
+            boxes, scores, classes for the image
+        """
+        return self.detect_batch([image])[0]
+
+    def detect_batch(self, images):
+        """Generates detections for a list of PIL images.
+
+        Images of the same size are run through the graph together. Images of
+        different sizes need separate runs, because a batch has a single shape.
+
+        Returns:
+            a list with one (boxes, scores, classes) tuple per image, in input order
+        """
+        results = [None] * len(images)
+        indexes_by_shape = {}
+        image_arrays = []
+        for i, image in enumerate(images):
+            image_np = np.asarray(image, np.uint8)[:, :, :3] # Remove the alpha channel
+            image_arrays.append(image_np)
+            indexes_by_shape.setdefault(image_np.shape, []).append(i)
+
+        for indexes in indexes_by_shape.values():
+            # The graph takes uint8 N x H x W x C, so the images are copied into the batch unchanged.
+            image_batch = to_batch([image_arrays[i] for i in indexes], dtype=np.uint8, channels_first=False)
+
+            # performs inference
+            (box, score, clss, num_detections) = self.session.run(
+                self.output_tensors,
+                feed_dict={self.image_tensor: image_batch})
+
+            for batch_index, i in enumerate(indexes):
+                results[i] = (box[batch_index], score[batch_index], clss[batch_index])
+
+        return results
+
+    def detect_tiled(self, image, tile_size=TF_DETECTOR_TILE_SIZE, overlap=TF_DETECTOR_TILE_OVERLAP, confidence_threshold=0.0, iou_threshold=0.5):
+        """Generates detections for an image or raster larger than the model input, tile by tile.
+
+        The image is cut into overlapping tiles that are batched through the graph, and
+        the detections of all tiles are combined, with duplicates in the overlaps
+        removed by non-maximum suppression. Detections at or below
+        confidence_threshold are dropped from each tile before combining.
+
+        Args:
+            image: a PIL image, an H x W x 3 uint8 array (which may be memory-mapped),
+                or anything tiling.open_raster accepts.
+
+        Returns:
+            boxes (normalized to the whole image), scores, classes
+        """
+        raster = open_raster(image)
+        stitcher = DetectionStitcher(*raster_size(raster), iou_threshold=iou_threshold)
+        for window, (boxes, scores, classes) in run_tiled(raster, self.detect_batch, tile_size, overlap):
+            keep = scores > confidence_threshold
+            stitcher.add(window, boxes[keep], scores[keep], classes[keep])
+        return stitcher.result()
+
+    @property
+    def session(self):
+        return self._session.get()
+
+    def close(self):
+        session = self._session.get_if_created()
+        if session is not None:
+            session.close()
+
+
+def load_detector(checkpoint, intra_op_threads=TF_INTRA_OP_THREADS, inter_op_threads=TF_INTER_OP_THREADS):
+    """Loads a detection model from a .pb file and returns a TFDetector for it."""
+    return TFDetector(load_model(checkpoint), intra_op_threads, inter_op_threads)
+
+
+_detectors = {}
+_detectors_lock = threading.Lock()
+
 def generate_detections(detection_graph, image):
     """ Generates a set of bounding boxes with confidence and class prediction for one input image file.
 
+    Kept for existing callers; a TFDetector is created once per graph and reused.
+
     Args:
-        detection_graph: an already loaded object detection inference graph.
+        detection_graph: an already loaded object detection inference graph, or a TFDetector.
         image_file: a PIL Image object
 
     Returns:
         boxes, scores, classes, and the image loaded from the input image_file - for one image
     """
-    image_np = np.asarray(image, np.uint8)
-    image_np = image_np[:, :, :3] # Remove the alpha channel
+    detector = detection_graph
+    if not isinstance(detector, TFDetector):
+        with _detectors_lock:
+            detector = _detectors.get(detection_graph)
+            if detector is None:
+                detector = TFDetector(detection_graph)
+                _detectors[detection_graph] = detector
 
-    #with detection_graph.as_default():
-    with tf.Session(graph=detection_graph) as sess:
-        image_np = np.expand_dims(image_np, axis=0)
+    boxes, scores, classes = detector.detect(image)
+    return boxes, scores, classes, image  # these are lists of bboxes, scores etc
 
-        # get the operators
-        image_tensor = detection_graph.get_tensor_by_name('image_tensor:0')
-        box = detection_graph.get_tensor_by_name('detection_boxes:0')
-        score = detection_graph.get_tensor_by_name('detection_scores:0')
-        clss = detection_graph.get_tensor_by_name('detection_classes:0')
-        num_detections = detection_graph.get_tensor_by_name('num_detections:0')
 
-        # performs inference
-        (box, score, clss, num_detections) = sess.run(
-            [box, score, clss, num_detections],
-            feed_dict={image_tensor: image_np})
+# Post-processing functions
+
+
+def filter_detections(boxes, scores, classes, confidence_threshold=0.5, iou_threshold=None, max_detections=None):
+    """Keeps the detections above confidence_threshold, highest score first.
+
+    Args:
+        boxes, scores, classes: outputs of TFDetector.detect.
+        confidence_threshold: detections with a score at or below this are dropped.
+        iou_threshold: optional; if set, non_max_suppression is applied per class.
+        max_detections: optional limit on the number of detections returned.
+
+    Returns:
+        boxes ([N, 4] float32), scores ([N] float32) and classes ([N] int64)
+    """
+    boxes = np.asarray(boxes, np.float32).reshape(-1, 4)
+    scores = np.asarray(scores, np.float32).reshape(-1)
+    classes = np.asarray(classes).reshape(-1).astype(np.int64)
+
+    keep = np.flatnonzero(scores > confidence_threshold)
+    keep = keep[np.argsort(-scores[keep], kind='stable')]
+    if iou_threshold is not None and keep.size > 1:
+        keep = keep[non_max_suppression(boxes[keep], scores[keep], iou_threshold, classes[keep])]
+    if max_detections is not None:
+        keep = keep[:max_detections]
+    return boxes[keep], scores[keep], classes[keep]
+
 
-    return np.squeeze(box), np.squeeze(score), np.squeeze(clss), image  # these are lists of bboxes, scores etc
+def scale_boxes(boxes, image_size):
+    """Converts normalized (ymin, xmin, ymax, xmax) boxes to pixels of an image of image_size (width, height)."""
+    width, height = image_size
+    return np.asarray(boxes, np.float32) * np.array([height, width, height, width], np.float32)
+
+
+def format_labels(scores, classes, label_map={}):
+    """Returns one 'label: confidence%' string per detection."""
+    return ['{}: {}%'.format(label_map.get(clss, str(clss)), round(100 * score))
+            for score, clss in zip(np.asarray(scores).tolist(), np.asarray(classes).tolist())]
+
+
+def detections_to_json(boxes, scores, classes, label_map={}, image_size=None):
+    """Returns filtered detections as a list of JSON-serializable dicts.
+
+    Each detection has the numerical class, its label from label_map, the confidence
+    and the normalized bbox (ymin, xmin, ymax, xmax). If image_size (width, height)
+    is given, the box in pixels is added as bbox_pixels.
+    """
+    classes = np.asarray(classes).tolist()
+    scores = np.round(np.asarray(scores, np.float64), 4).tolist()
+    bboxes = np.round(np.asarray(boxes, np.float64), 4).tolist()
+    pixel_bboxes = np.round(scale_boxes(boxes, image_size)).astype(np.int64).tolist() if image_size else None
+
+    detections = []
+    for i, clss in enumerate(classes):
+        detection = {'class': clss, 'label': label_map.get(clss, str(clss)), 'confidence': scores[i], 'bbox': bboxes[i]}
+        if pixel_bboxes is not None:
+            detection['bbox_pixels'] = pixel_bboxes[i]
+        detections.append(detection)
+    return detections
 
 
 # Rendering functions
 
 
-def render_bounding_boxes(boxes, scores, classes, image, label_map={}, confidence_threshold=0.5):
+_fonts = {}
+
+def load_font(size=24, name='arial.ttf'):
+    """Loads a TrueType font once per process, falling back to PIL's default font."""
+    font = _fonts.get((name, size))
+    if font is None:
+        try:
+            font = ImageFont.truetype(name, size)
+        except IOError:
+            font = ImageFont.load_default()
+        _fonts[(name, size)] = font
+    return font
+
+
+def _get_text_size(font, text):
+    if hasattr(font, 'getbbox'):
+        left, top, right, bottom = font.getbbox(text)
+        return right, bottom
+    return font.getsize(text)
+
+
+class BoxRenderer:
+    """Draws bounding boxes and their labels on PIL images.
+
+    The font is loaded once, and all the boxes of an image are drawn with one ImageDraw.
+    """
+    def __init__(self, color='LimeGreen', thickness=4, font_size=24, font_name='arial.ttf'):
+        self.color = color
+        self.thickness = thickness
+        self.font = load_font(font_size, font_name)
+
+    def render(self, image, boxes, display_strs=()):
+        """Draws normalized (ymin, xmin, ymax, xmax) boxes on image, in place.
+
+        display_strs optionally has one label string per box.
+        """
+        boxes = np.asarray(boxes, np.float32).reshape(-1, 4)
+        if not boxes.shape[0]:
+            return
+        draw = ImageDraw.Draw(image)
+        for i, (ymin, xmin, ymax, xmax) in enumerate(scale_boxes(boxes, image.size).tolist()):
+            display_str_list = (display_strs[i],) if display_strs else ()
+            draw_bounding_box_on_image(image, ymin, xmin, ymax, xmax, self.color, self.thickness, display_str_list,
+                                       use_normalized_coordinates=False, draw=draw, font=self.font)
+
+
+_default_renderer = None
+
+def render_bounding_boxes(boxes, scores, classes, image, label_map={}, confidence_threshold=0.5, iou_threshold=None, renderer=None):
     """Renders bounding boxes, label and confidence on an image if confidence is above the threshold.
 
     Args:
@@ -91,27 +321,20 @@ def render_bounding_boxes(boxes, scores, classes, image, label_map={}, confidenc
         image: PIL.Image object, output of generate_detections.
         label_map: optional, mapping the numerical label to a string name.
         confidence_threshold: threshold above which the bounding box is rendered.
+        iou_threshold: optional, see filter_detections.
+        renderer: optional BoxRenderer. A shared default renderer is used otherwise.
 
-    image is modified in place!
+    image is modified in place! Returns the rendered boxes, scores and classes.
 
     """
-    display_boxes = []
-    display_strs = []  # list of list, one list of strings for each bounding box (to accommodate multiple labels)
-
-    for box, score, clss in zip(boxes, scores, classes):
-        if score > confidence_threshold:
-            print('Confidence of detection greater than threshold: ', score)
-            display_boxes.append(box)
-            clss = int(clss)
-            label = label_map[clss] if clss in label_map else str(clss)
-            displayed_label = '{}: {}%'.format(label, round(100*score))
-            display_strs.append([displayed_label])
-
-    display_boxes = np.array(display_boxes)
-    if display_boxes.shape == (0,): # no detections are above threshold
-        return
-    else:
-        draw_bounding_boxes_on_image(image, display_boxes, display_str_list_list=display_strs)
+    global _default_renderer
+    boxes, scores, classes = filter_detections(boxes, scores, classes, confidence_threshold, iou_threshold)
+    if renderer is None:
+        if _default_renderer is None:
+            _default_renderer = BoxRenderer()
+        renderer = _default_renderer
+    renderer.render(image, boxes, format_labels(scores, classes, label_map))
+    return boxes, scores, classes
 
 # the following two functions are from https://github.com/tensorflow/models/blob/master/research/object_detection/utils/visualization_utils.py
 
@@ -142,12 +365,15 @@ def draw_bounding_boxes_on_image(image,
     return
   if len(boxes_shape) != 2 or boxes_shape[1] != 4:
     raise ValueError('Input must be of size [N, 4]')
+  draw = ImageDraw.Draw(image)
+  font = load_font()
   for i in range(boxes_shape[0]):
     display_str_list = ()
     if display_str_list_list:
       display_str_list = display_str_list_list[i]
     draw_bounding_box_on_image(image, boxes[i, 0], boxes[i, 1], boxes[i, 2],
-                               boxes[i, 3], color, thickness, display_str_list)
+                               boxes[i, 3], color, thickness, display_str_list,
+                               draw=draw, font=font)
 
 
 def draw_bounding_box_on_image(image,
@@ -158,7 +384,9 @@ def draw_bounding_box_on_image(image,
                                color='red',
                                thickness=4,
                                display_str_list=(),
-                               use_normalized_coordinates=True):
+                               use_normalized_coordinates=True,
+                               draw=None,
+                               font=None):
   """Adds a bounding box to an image.
 
   Bounding box coordinates can be specified in either absolute (pixel) or
@@ -182,8 +410,11 @@ def draw_bounding_box_on_image(image,
     use_normalized_coordinates: If True (default), treat coordinates
       ymin, xmin, ymax, xmax as relative to the image.  Otherwise treat
       coordinates as absolute.
+    draw: optional ImageDraw.Draw of image, to reuse for several boxes.
+    font: optional font for the strings. Defaults to load_font().
   """
-  draw = ImageDraw.Draw(image)
+  if draw is None:
+    draw = ImageDraw.Draw(image)
   im_width, im_height = image.size
   if use_normalized_coordinates:
     (left, right, top, bottom) = (xmin * im_width, xmax * im_width,
@@ -192,15 +423,13 @@ def draw_bounding_box_on_image(image,
     (left, right, top, bottom) = (xmin, xmax, ymin, ymax)
   draw.line([(left, top), (left, bottom), (right, bottom),
              (right, top), (left, top)], width=thickness, fill=color)
-  try:
-    font = ImageFont.truetype('arial.ttf', 24)
-  except IOError:
-    font = ImageFont.load_default()
+  if font is None:
+    font = load_font()
 
   # If the total height of the display strings added to the top of the bounding
   # box exceeds the top of the image, stack the strings below the bounding box
   # instead of above.
-  display_str_heights = [font.getsize(ds)[1] for ds in display_str_list]
+  display_str_heights = [_get_text_size(font, ds)[1] for ds in display_str_list]
   # Each display_str has a top and bottom margin of 0.05x.
   total_display_str_height = (1 + 2 * 0.05) * sum(display_str_heights)
 
@@ -210,7 +439,7 @@ def draw_bounding_box_on_image(image,
     text_bottom = bottom + total_display_str_height
   # Reverse list and print from bottom to top.
   for display_str in display_str_list[::-1]:
-    text_width, text_height = font.getsize(display_str)
+    text_width, text_height = _get_text_size(font, display_str)
     margin = np.ceil(0.05 * text_height)
     draw.rectangle(
         [(left, text_bottom - text_height - 2 * margin), (left + text_width,